@@ -2,7 +2,8 @@
 %src - 0 (microcontroller, (4 byte messages))
 %      1 (sequencing engine (engine-specific messages))
 %      2 (comms process (control messages, etc.))
-%msg - variable type containing message information
+%msg - JSON array of one or more events from the same source (the process
+%      batches notifications)
 %message types:
 % log
 %   message - string
@@ -37,36 +38,33 @@ function result=RFIS_notify(src,msg)
     return;
   end
   handles=guidata(rfis);
+  try
+    events=jsondecode(msg);
+  catch E
+    disp('RFIS_notify: message format error')
+    return;
+  end
+  if ~iscell(events) %events with identical fields decode as a struct array
+    events=num2cell(events);
+  end
   switch src
-    case py.rfis.SRC_MCU
+    case py.rfis.MSG_TYPE_MCU
 %      disp('RFIS_notify: source=microcontroller')
 %      disp(msg)
       %handle E, A, ?
-      %expecting a vector, 4 elements
-    case py.rfis.SRC_SEQ
+      %each event has a packet field, a vector of 4 elements
+    case py.rfis.MSG_TYPE_SEQ
 %      disp('RFIS_notify: source=sequencer')
 %      disp(msg)
       
       %
-    case py.rfis.SRC_COM
-      disp('RFIS_notify: source=process')
-      disp(msg)
-      try
-        data=jsondecode(msg);
-      catch E
-        disp('RFIS_notify: process message format error')
-        return;
-      end
-      if strcmp(data.type,'log')
-        h=findobj('Tag','txeLog');
-%        try
-%          f=fileread('rfis_proc.log')
-          %str=strcat(strcat(data.message,'\n'),h.String);
-%          data.message
+    case py.rfis.MSG_TYPE_COM
+      h=findobj('Tag','txeLog');
+      for k=1:numel(events)
+        data=events{k};
+        if strcmp(data.type,'log')
           h.String={data.message,char(h.String)};%sprintf('%s\n%s',data.message,h.String);
-%        catch E
-%          disp('RFIS_notify: failed to load process log')
-%          return;
+        end
       end
     otherwise
       disp('RFIS_notify: invalid source')
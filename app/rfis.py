@@ -28,32 +28,112 @@
 #import asyncio
 #import serial_asyncio #nevermind, no windows support (TODO: check again - someone forked and updated it.)
 import sys #for byteorder
+import struct
+import collections
 #import binascii #for byte string printing (leave me alone, unicode)
-import datetime #for logs
 
-import serial
-from serial.tools import list_ports
 import socket
-import select
+import selectors
+import os
 #import matlab.engine #can't do this here - problems when API is instantiated from w/in MATLAB (can't have engine in itself)
 
-#for API.connect()/CommProcess
-import subprocess
-
 #for action sequencing programs:
 import time
 import threading
 import json
 import queue
+import array
+import types
+
+#Everything else is imported where it's used, so loading this module in
+#MATLAB (for API) doesn't pay for the relay's dependencies:
+#  serial             open_transport(), scan_serial_ports()
+#  subprocess         API.spawn()
+#  tempfile           lockfile_path(), find_relays()
+#  hashlib            ProgramCache.check()
+#  datetime           LogWriter
+#  numpy (optional)   _load_numpy(), from HardwareState
+#  msgpack (optional) _load_msgpack(), for binary control messages
+#  matlab.engine      MatlabSink.connect()
+#  argparse           main()
+#rfis_bench.py importtime checks none of these load with the module.
+numpy = None #see _load_numpy()
+_numpy_checked = False
+msgpack = None #see _load_msgpack()
+_msgpack_checked = False
 
 #default log file names
 RFIS_PROCESS_LOG="rfis_proc.log"
+RFIS_TRACE_LOG="rfis_trace.bin" #binary capture of relay traffic (see LogWriter, TraceReader)
+RFIS_SYMBOLS_FILE="rfis_symbols.json" #persistent symbols (calibrated positions), see SymbolTable
+RFIS_BATCH_JOURNAL="rfis_batch.jsonl" #progress of the current batch run, see BatchScheduler
+
+#log levels
+LOG_DEBUG=10 #hex dumps and other per-packet detail
+LOG_INFO=20
+LOG_WARN=30
+LOG_ERROR=40
+LOG_OFF=100
+#log channels: "proc" (process control), "mc" (microcontroller traffic),
+#"ui" (API socket traffic), "seq" (sequencer)
+#override with the RFIS_LOG environment variable, ex. RFIS_LOG="mc=debug,ui=debug"
+LOG_LEVELS_DEFAULT={'proc':LOG_INFO,'mc':LOG_INFO,'ui':LOG_INFO,'seq':LOG_INFO}
+LOG_MAX_BYTES=4*1024*1024 #rotate once a log file gets this big...
+LOG_MAX_AGE=24*60*60 #...or this old (seconds)
+LOG_BACKUPS=5 #rotated files kept
 
 #communication constants
 SERIAL_BAUD_RATE=115200
 SERIAL_PORT_DEFAULT="COM9"
+TRANSPORT_SIM="sim" #serial port names that select a stand-in transport (see open_transport())
+TRANSPORT_PTY="pty"
+TRANSPORT_LOOP="loop"
+SERIAL_PORT_AUTO="auto" #the first KL25Z found (see PortRegistry)
+KL25Z_USB_IDS=((0x1357,0x0707),(0x0D28,0x0204)) #(VID, PID): OpenSDA (P&E) and OpenSDA CMSIS-DAP/mbed firmware
+PORT_CACHE_TTL=2 #seconds a serial port scan is trusted
+PORT_SCAN_INTERVAL=1 #seconds between scans while watching for hot-plug
 SOCKET_PORT_DEFAULT=12345
+FRAME_BUFFER_SIZE=65536 #initial size of API stream buffer (grows to fit large frames)
+FRAME_RECV_SIZE=16384 #minimum free space offered to each recv
+FRAME_MAX_SIZE=16*1024*1024 #anything larger is a corrupt stream
+LOG_MSG_PREVIEW=200 #bytes of a control message shown in debug logs
+MC_QUEUE_SIZE=256 #packets waiting for the microcontroller before the API gets pushed back on
+SERIAL_TX_BURST=4 #bytes the serial writer may get ahead of the line rate (one packet)
+FIRMWARE_LOOP_TIME=0.006 #worst-case pass of kl25z/src/main.c's loop: motor 1 stepping alone, 2x Delay(20000) at 48 MHz
+SERIAL_TX_GAP=0.008 #least time between the starts of two packets, so the firmware has taken one before the next lands
+SERIAL_READ_TIMEOUT=0.5 #longest the serial reader blocks before checking for shutdown
+NOTIFY_MAX_RATE=20 #MATLAB engine calls per second
+NOTIFY_MAX_LATENCY=0.02 #seconds an event may wait for others to batch with
+NOTIFY_MAX_BATCH=256 #events per engine call
+NOTIFY_MAX_PENDING=10000 #events held while MATLAB is busy (oldest dropped after this)
+STATE_MAX_RATE=50 #highest state push rate (Hz) a subscriber can ask for
+STATE_DEFAULT_RATE=10
+CLIENT_WBUF_MAX=1<<20 #bytes queued for a slow client before messages are dropped
+CLIENT_MAX=16 #simultaneous API connections
+ROLE_CONTROLLER="controller" #may drive the hardware and sequencer (one client at a time)
+ROLE_OBSERVER="observer" #may only watch
+RETRY_INTERVAL=2 #seconds between attempts to re-open serial port/listen socket
+RECONNECT_BACKOFF_MIN=0.05 #first serial re-open wait after the link drops (doubles, jittered, up to RETRY_INTERVAL)
+RESYNC_REPLAY="replay" #after a reconnect, send what was queued when the link dropped
+RESYNC_ABORT="abort"   #drop queued moves/calibrations (and the program that sent them) instead
+RESYNC_AUTO="auto"     #replay after outages up to RESYNC_REPLAY_WINDOW, abort after longer ones
+RESYNC_REPLAY_WINDOW=1 #seconds
+RESYNC_MARGIN=0.25 #seconds of slack on a move's estimated end when settling it after a reconnect
+HIST_SUB_BITS=5 #latency histograms: 2**4 buckets per power of two (quantiles at most 1/16 high)...
+HIST_MAX_BITS=36 #...up to 2**36 us (19 hours)
+METRICS_QUANTILES=(0.5,0.9,0.99,0.999)
+METRICS_DUMP_INTERVAL=60 #seconds between --metrics-dump lines
+PROGRAM_DIR=os.path.join(os.path.dirname(os.path.abspath(__file__)),'programs')
+PROGRAM_CATALOG='_programs.json' #lists (in order) the programs to offer; all *.json if absent
+PROGRAM_RESCAN_INTERVAL=2 #seconds between checks for changed program files (while idle)
+PROGRAM_HANDOFF_POLL=0.01 #how often the main loop checks whether an overridden program has ended
 MATLAB_NAME="RFIS" #name of shared engine
+PROTOCOL_VERSION=1 #API <-> CommProcess protocol, checked in API.connect()'s handshake
+CONNECT_TIMEOUT=10 #seconds API.connect() waits for a relay to come up
+CONNECT_BACKOFF_MIN=0.005 #first wait between connection attempts (doubles each time)
+CONNECT_BACKOFF_MAX=0.25
+HELLO_TIMEOUT=2 #seconds to wait for the relay's hello after connecting
+API_SHUTDOWN_TIMEOUT=1 #longest API.shutdown() waits for the relay to hang up
 
 #indicate message types to MATLAB
 MSG_TYPE_MCU = 0 #4 byte message from the microcontroller
@@ -62,9 +142,35 @@ MSG_TYPE_COM = 2 #control data from the comms process
 MSG_TYPE_API = 3
 MSG_TYPE_GUI = 4
 
+_FRAME_HEADER=struct.Struct('>I') #API message size prefix
+_PACKET_FRAME_HEADER=_FRAME_HEADER.pack(4)
+
+#binary trace
+TRACE_MAGIC=b'RFISTRC2'
+TRACE_HEADER=struct.Struct('<dBI') #monotonic time, kind, payload size (payload follows)
+TRACE_MAGIC_V1=b'RFISTRC1' #older serial-only traces, still readable
+TRACE_RECORD_V1=struct.Struct('<dB4s') #monotonic time, kind, packet
+TRACE_MC_IN=0  #microcontroller -> process (4-byte packet)
+TRACE_MC_OUT=1 #process -> microcontroller (4-byte packet)
+TRACE_UI_IN=2  #API -> process (4-byte packet)
+TRACE_UI_MSG=3 #API -> process (control message, JSON or msgpack)
+TRACE_SEQ=4    #sequencer event (JSON: start, step, end)
+TRACE_LINK=5   #serial link event (JSON: lost, resynced)
+TRACE_PACKETS=(TRACE_MC_IN,TRACE_MC_OUT,TRACE_UI_IN)
+TRACE_LABELS={TRACE_MC_IN:'MC->',TRACE_MC_OUT:'MC<-',TRACE_UI_IN:'UI->',TRACE_UI_MSG:'UI=>',TRACE_SEQ:'SEQ ',TRACE_LINK:'LINK'}
+
 #mechanical constants
 MOTOR_COUNT=5
 
+#approximate step rates (steps/second), from the firmware's step delays
+MOTOR_STEP_RATE=(25,200,200,50,50)
+
+#neopixel ring lights, numbered 1-16 (light 0 is the done/clear indicator)
+LIGHT_COUNT=16
+
+#samples of (time, pos, target) kept per motor, see TelemetryRing
+TELEMETRY_HISTORY=4096
+
 #for array indexing
 MOTOR_1=0
 MOTOR_2=1
@@ -72,6 +178,33 @@ MOTOR_3=2
 MOTOR_4=3
 MOTOR_5=4
 
+#motor names usable in programs
+MOTOR_ALIASES={'IMAGING_Z':1,'IMAGING_PIN':1,
+               'ISOLATION_Z':2,'ISOLATION_PIN':2,
+               'STAGE_X':3,
+               'ARM_X':4,
+               'ARM_Y':5}
+
+#compiled program instruction ops (indices into ProgramThread's dispatch table)
+OP_SEND=0
+OP_SEND_SYM=1
+OP_MOVE=2
+OP_WAIT=3
+OP_GOTO=4
+OP_PROG=5
+OP_SYMS=6
+OP_MARK=7
+
+#wait conditions and timeout actions
+COND_TIME=0
+COND_IDLE=1
+COND_ERROR=2
+COND_SYMBOL=3
+COND_COMMAND=4
+ACTION_STOP=0
+ACTION_CONTINUE=1
+ACTION_GOTO=2
+
 #for making sense
 MOTOR_1_FUNCTION="Imaging Pin"
 MOTOR_2_FUNCTION="Isolation Pin"
@@ -79,40 +212,748 @@ MOTOR_3_FUNCTION="Stage Translation"
 MOTOR_4_FUNCTION="Arm Translation"
 MOTOR_5_FUNCTION="Arm Extension"
 
+#axes (indices) that must be idle before an axis moves, so the sequencer
+#never overlaps them (see pipeline_program()): the pins stick up into the
+#stage, and the isolation pin reaches the arm's path
+AXIS_CONFLICTS={MOTOR_1:(MOTOR_3,),
+                MOTOR_2:(MOTOR_3,MOTOR_4,MOTOR_5),
+                MOTOR_3:(MOTOR_1,MOTOR_2),
+                MOTOR_4:(MOTOR_2,),
+                MOTOR_5:(MOTOR_2,)}
+
+
+# Serial packet encoders
+# Each returns the 4-byte packet for the microcontroller (see the
+# command handling in kl25z/src/main.c), ready for API.send() or
+# API.send_batch(). Arguments are checked against what the firmware
+# accepts, ValueError is raised otherwise.
+# Motors may be given as 1-5 or '1'-'5' (MATLAB hands over chars).
+_PACKET=struct.Struct('>cBBB')
+_PACKET_STEPS=struct.Struct('>cBH') #command, motor, 16-bit argument
+_PACKET_STOP=_PACKET.pack(b'S',0,0,0)
+_PACKET_RESET=_PACKET.pack(b'R',0,0,0)
+_PACKET_CLEAR=_PACKET.pack(b'L',0,0,0)
+_PACKET_DONE=_PACKET.pack(b'L',1,0,0)
+_PACKET_SHUTDOWN=_PACKET.pack(b'X',0,0,0) #relay only, never reaches the board
+
+def _motor_number(motor):
+    if type(motor) == str or type(motor) == bytes:
+        if len(motor) != 1:
+            raise ValueError('invalid motor number: '+str(motor))
+        motor = ord(motor)-ord('0')
+    motor = int(motor)
+    if motor < 1 or motor > MOTOR_COUNT:
+        raise ValueError('invalid motor number: '+str(motor))
+    return motor
+
+def encode_calibrate(motor):
+    return _PACKET.pack(b'C',_motor_number(motor),0,0)
+
+#ticks - unsigned 16-bit step period
+def encode_delay(motor,ticks):
+    ticks = int(ticks)
+    if ticks < 0 or ticks > 0xffff:
+        raise ValueError('invalid delay: '+str(ticks))
+    return _PACKET_STEPS.pack(b'D',_motor_number(motor),ticks)
+
+# lightnum 0 (indicator: rgb ignored, use encode_clear()/encode_done()) or
+# 1-16 (ring), rgb tuple of 3 bytes (sent as 6 bits each)
+def encode_light(lightnum,rgb):
+    lightnum = int(lightnum)
+    if lightnum < 0 or lightnum > LIGHT_COUNT:
+        raise ValueError('invalid light number: '+str(lightnum))
+    r, g, b = [(int(c)>>2)&0x3f for c in rgb]
+    return _PACKET.pack(b'L',(lightnum<<2)|(r>>4),((r&0xf)<<4)|(g>>2),((g&3)<<6)|b)
+
+def encode_clear():
+    return _PACKET_CLEAR
+
+def encode_done():
+    return _PACKET_DONE
+
+#steps - relative move, sign-magnitude 15 bits
+def encode_move(motor,steps):
+    steps = int(steps)
+    if steps < -0x7fff or steps > 0x7fff:
+        raise ValueError('invalid step count: '+str(steps))
+    if steps < 0:
+        steps = 0x8000|-steps
+    return _PACKET_STEPS.pack(b'M',ord('0')+_motor_number(motor),steps)
+
+#pin - 0 (suction) or 1 (blower), state - 0 (off) or 1 (on)
+def encode_pin(pin,state):
+    pin = int(pin)
+    if pin < 0 or pin > 1:
+        raise ValueError('invalid pin number: '+str(pin))
+    return _PACKET.pack(b'P',pin,1 if state else 0,0)
+
+def encode_reset():
+    return _PACKET_RESET
+
+def encode_stop():
+    return _PACKET_STOP
+
+def encode_shutdown():
+    return _PACKET_SHUTDOWN
+
+#turn whatever MATLAB (or a caller) handed over into bytes:
+#bytes-like, a string of byte-valued chars, or a list of any of those and ints
+def to_bytes(rawmsg):
+    if type(rawmsg) == bytes:
+        return rawmsg
+    if type(rawmsg) == bytearray or type(rawmsg) == memoryview:
+        return bytes(rawmsg)
+    if type(rawmsg) == str:
+        return rawmsg.encode('latin-1')
+    out = bytearray()
+    for m in rawmsg:
+        if type(m) == str:
+            out += m.encode('latin-1')
+        elif type(m) == bytes or type(m) == bytearray:
+            out += m
+        else:
+            out.append(int(m)&0xff)
+    return bytes(out)
+
+#prefix a message with its size for the API socket
+def frame(msg):
+    return _FRAME_HEADER.pack(len(msg))+msg
+
+
+# Control messages (everything on the API socket but 4-byte serial packets)
+# are JSON objects, or the same objects in the msgpack wire format for
+# clients that want it compact and cheap to parse (ex. a detector streaming
+# FORAM_PRESENT, or a big program upload). The two are told apart by the
+# first byte: a msgpack map header (0x80-0x8f, 0xde, 0xdf) or JSON's '{'.
+# The msgpack package is used when installed; otherwise the subset below
+# (nil, bool, int, float, str, bin, array, map) is packed/unpacked here.
+def _load_msgpack():
+    global msgpack, _msgpack_checked
+    if not _msgpack_checked:
+        _msgpack_checked = True
+        try:
+            import msgpack
+        except ImportError:
+            msgpack = None
+    return msgpack
+
+def is_binary_message(p):
+    return len(p) > 0 and (p[0]&0xf0 == 0x80 or p[0] == 0xde or p[0] == 0xdf)
+
+#obj -> bytes, binary selects msgpack over JSON
+def encode_message(obj,binary=False):
+    if not binary:
+        return json.dumps(obj).encode()
+    if _load_msgpack():
+        return msgpack.packb(obj,use_bin_type=True)
+    out = bytearray()
+    _pack(obj,out)
+    return bytes(out)
+
+#bytes (or a memoryview) of either encoding -> obj; ValueError if it can't be decoded
+def decode_message(p):
+    if not is_binary_message(p):
+        return json.loads(bytes(p))
+    if _load_msgpack():
+        try:
+            return msgpack.unpackb(p,raw=False)
+        except Exception as e: #its errors don't share a base class
+            raise ValueError('bad msgpack message: '+str(e))
+    try:
+        obj, i = _unpack(p,0)
+    except (IndexError,struct.error):
+        raise ValueError('truncated msgpack message')
+    except (TypeError,RecursionError) as e: #unhashable key, absurd nesting
+        raise ValueError('bad msgpack message: '+str(e))
+    if i != len(p):
+        raise ValueError('extra data after msgpack message')
+    return obj
+
+_MP_UINT = ((0xff,0xcc,struct.Struct('>B')),(0xffff,0xcd,struct.Struct('>H')),
+            (0xffffffff,0xce,struct.Struct('>I')),(0xffffffffffffffff,0xcf,struct.Struct('>Q')))
+_MP_INT = ((0x7f,0xd0,struct.Struct('>b')),(0x7fff,0xd1,struct.Struct('>h')),
+           (0x7fffffff,0xd2,struct.Struct('>i')),(0x7fffffffffffffff,0xd3,struct.Struct('>q')))
+_MP_FLOAT = struct.Struct('>d')
+_MP_SIZE = (struct.Struct('>B'),struct.Struct('>H'),struct.Struct('>I'))
+
+#header for a str/bin/array/map of n items; fix - (fixed-size header base, its limit) or None
+def _pack_size(out,n,fix,codes):
+    if fix and n < fix[1]:
+        out.append(fix[0]|n)
+        return
+    for code, s, limit in zip(codes,_MP_SIZE,(0x100,0x10000,0x100000000)):
+        if code and n < limit:
+            out.append(code)
+            out += s.pack(n)
+            return
+    raise ValueError('too big for msgpack: '+str(n))
+
+def _pack(obj,out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True or obj is False:
+        out.append(0xc3 if obj else 0xc2)
+    elif isinstance(obj,int):
+        obj = int(obj)
+        if -32 <= obj < 0x80:
+            out.append(obj&0xff)
+            return
+        for limit, code, s in (_MP_UINT if obj > 0 else _MP_INT):
+            if -limit-1 <= obj <= limit:
+                out.append(code)
+                out += s.pack(obj)
+                return
+        raise ValueError('integer too big for msgpack: '+str(obj))
+    elif isinstance(obj,float):
+        out.append(0xcb)
+        out += _MP_FLOAT.pack(obj)
+    elif isinstance(obj,str):
+        b = obj.encode()
+        _pack_size(out,len(b),(0xa0,32),(0xd9,0xda,0xdb))
+        out += b
+    elif isinstance(obj,(bytes,bytearray,memoryview)):
+        _pack_size(out,len(obj),None,(0xc4,0xc5,0xc6))
+        out += obj
+    elif isinstance(obj,(list,tuple)):
+        _pack_size(out,len(obj),(0x90,16),(None,0xdc,0xdd))
+        for v in obj:
+            _pack(v,out)
+    elif isinstance(obj,dict):
+        _pack_size(out,len(obj),(0x80,16),(None,0xde,0xdf))
+        for k, v in obj.items():
+            _pack(k,out)
+            _pack(v,out)
+    else:
+        raise TypeError("can't pack "+type(obj).__name__)
+
+#(obj, index after it) for the message item starting at p[i]
+def _unpack(p,i):
+    c = p[i]
+    i += 1
+    if c < 0x80:
+        return c, i
+    if c >= 0xe0:
+        return c-0x100, i
+    if c < 0x90:
+        return _unpack_map(p,i,c&0x0f)
+    if c < 0xa0:
+        return _unpack_array(p,i,c&0x0f)
+    if c < 0xc0:
+        return _unpack_str(p,i,c&0x1f)
+    if c == 0xc0:
+        return None, i
+    if c == 0xc2 or c == 0xc3:
+        return c == 0xc3, i
+    if 0xcc <= c <= 0xd3:
+        limit, code, s = (_MP_UINT+_MP_INT)[c-0xcc]
+        return s.unpack_from(p,i)[0], i+s.size
+    if c == 0xcb:
+        return _MP_FLOAT.unpack_from(p,i)[0], i+8
+    if c == 0xca:
+        return struct.unpack_from('>f',p,i)[0], i+4
+    for codes, fn in (((0xd9,0xda,0xdb),_unpack_str),((0xc4,0xc5,0xc6),_unpack_bin),
+                      ((None,0xdc,0xdd),_unpack_array),((None,0xde,0xdf),_unpack_map)):
+        if c in codes:
+            s = _MP_SIZE[codes.index(c)]
+            return fn(p,i+s.size,s.unpack_from(p,i)[0])
+    raise ValueError('unsupported msgpack type 0x%02X' % c)
+
+def _unpack_str(p,i,n):
+    if i+n > len(p):
+        raise IndexError(i+n)
+    return bytes(p[i:i+n]).decode(), i+n
+
+def _unpack_bin(p,i,n):
+    if i+n > len(p):
+        raise IndexError(i+n)
+    return bytes(p[i:i+n]), i+n
+
+def _unpack_array(p,i,n):
+    out = []
+    for k in range(n):
+        v, i = _unpack(p,i)
+        out.append(v)
+    return out, i
+
+def _unpack_map(p,i,n):
+    out = {}
+    for k in range(n):
+        key, i = _unpack(p,i)
+        out[key], i = _unpack(p,i)
+    return out, i
+
 
 #kept in HardwareState
 #represents state for a motor (as reported by encoder)
+#A view onto one column of HardwareState's arrays, so per-motor code
+#(state.motors[m].target_pos) and whole-array code see the same values.
 class MotorState:
-    def __init__(self):
-        self.step_per_dist=1 #conversion between steps and linear distance of attached mechanism
-        self.pos=0 #current position
-        self.maxpos=0 #limits
-        self.minpos=0
-        self.target_pos=0 #goal position
-        self.x=1
+    def __init__(self,state,index):
+        self.state = state
+        self.index = index
+
+    def __getattr__(self,name):
+        if name in _MOTOR_FIELDS:
+            return getattr(self.state,_MOTOR_FIELDS[name])[self.index]
+        raise AttributeError(name)
+
+    def __setattr__(self,name,value):
+        if name in _MOTOR_FIELDS:
+            getattr(self.state,_MOTOR_FIELDS[name])[self.index] = value
+        else:
+            object.__setattr__(self,name,value)
 
     def pos_to_mm(self):
         return self.pos*self.step_per_dist
 
     def mm_to_pos(self,mm):
-        return self.pos/self.self.step_per_dist
+        return int(round(mm/self.step_per_dist))
+
+#MotorState attribute -> HardwareState array
+_MOTOR_FIELDS={'pos':'pos','target_pos':'target','running':'running','calibrated':'calibrated',
+               'step_per_dist':'step_per_dist','maxpos':'maxpos','minpos':'minpos','stale':'stale'}
+
+
+#immutable copy of the state, replaced (not modified) on every update so
+#any thread can read HardwareState.snapshot without taking the lock
+StateSnapshot=collections.namedtuple('StateSnapshot','version time pos target running calibrated error lights pins indicator stale')
+
+#numpy if it's installed (None if not), imported on first use
+def _load_numpy():
+    global numpy, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+def _zeros(typecode,n):
+    if numpy:
+        return numpy.zeros(n,dtype=_NUMPY_TYPES[typecode])
+    return array.array(typecode,bytes(array.array(typecode).itemsize*n))
+
+_NUMPY_TYPES={'q':'int64','d':'float64','b':'int8'}
+
+def _tolist(a):
+    return a.tolist() if numpy else list(a)
+
+
+# Motor telemetry
+# Fixed-size ring of (time, pos, target) samples per motor, stored as
+# MOTOR_COUNT x size arrays (numpy when available, array.array if not) so
+# minutes of history cost no per-sample objects. Written only by
+# HardwareState under its lock; history() copies out in time order.
+class TelemetryRing:
+    def __init__(self,size=TELEMETRY_HISTORY):
+        _load_numpy()
+        self.size = size
+        self.t = [_zeros('d',size) for ii in range(MOTOR_COUNT)]
+        self.pos = [_zeros('q',size) for ii in range(MOTOR_COUNT)]
+        self.target = [_zeros('q',size) for ii in range(MOTOR_COUNT)]
+        self.count = [0]*MOTOR_COUNT #samples ever written, per motor
+
+    def add(self,m,t,pos,target):
+        ii = self.count[m]%self.size
+        self.t[m][ii] = t
+        self.pos[m][ii] = pos
+        self.target[m][ii] = target
+        self.count[m] += 1
+
+    #(times, positions, targets) for motor m (index), oldest first; last n samples if given
+    def history(self,m,n=None):
+        count = self.count[m]
+        have = min(count,self.size)
+        if n is not None:
+            have = min(have,n)
+        end = count%self.size
+        out = []
+        for a in (self.t[m],self.pos[m],self.target[m]):
+            if have <= end:
+                part = a[end-have:end]
+                out.append(part.copy() if numpy else part)
+            elif numpy:
+                out.append(numpy.concatenate((a[self.size-(have-end):],a[:end])))
+            else:
+                out.append(a[self.size-(have-end):]+a[:end])
+        return tuple(out)
+
+
+# Symbol table
+# Values programs refer to by name (STAGE_X_ISOLATION, FORAM_PRESENT...),
+# from program metadata defaults, "s" commands and API clients. Every
+# update builds a new read-only mapping (copy on write) with a new
+# version, so readers - ProgramThread.resolve(), state pushes - just
+# take `snapshot` without locking. Updates are batches: one version, one
+# notify of `changed` (waking waits on symbol conditions) and one call
+# to each watcher, however many names change; an update that changes
+# nothing does none of that.
+# Names set with persist (ex. positions taught from the UI) are written to
+# `path` on every change and loaded back by load(), so they survive
+# restarts; defaults from a program's metadata never override them.
+# Saves run after the lock is released, possibly on several threads at
+# once: each writes the newest snapshot and one that finds nothing newer
+# than the last write (by version) leaves the file alone, so the file
+# never goes back to an older version.
+SymbolSnapshot=collections.namedtuple('SymbolSnapshot','version values')
+SYMBOLS_FORMAT=1 #version of the persistence file layout
+
+class SymbolTable:
+    def __init__(self,changed=None,path=None,log=print):
+        self.changed = changed or threading.Condition() #writers hold it, waiters are notified on it
+        self.path = path
+        self.log = log
+        self.persistent = frozenset() #names saved to path
+        self.watchers = []
+        self.save_lock = threading.Lock()
+        self.saved = (-1,None) #(version, names) last written to path
+        self.snapshot = SymbolSnapshot(0,types.MappingProxyType({}))
+
+    #lock-free reads of the current snapshot
+    def get(self,name,default=0):
+        return self.snapshot.values.get(name,default)
+
+    def __contains__(self,name):
+        return name in self.snapshot.values
+
+    def __len__(self):
+        return len(self.snapshot.values)
+
+    #symbols - {name:value}; defaults_only leaves already defined symbols alone,
+    #persist saves these names from now on; returns {name:value} that changed
+    def update(self,symbols,defaults_only=False,persist=False):
+        with self.changed:
+            snap = self.snapshot
+            old = snap.values
+            changed = {}
+            for k, v in symbols.items():
+                if k in old and (defaults_only or old[k] == v):
+                    continue
+                changed[k] = v
+            save = False
+            if persist and not self.persistent.issuperset(symbols):
+                self.persistent = self.persistent.union(symbols)
+                save = True
+            if changed:
+                values = dict(old)
+                values.update(changed)
+                snap = self.snapshot = SymbolSnapshot(snap.version+1,types.MappingProxyType(values))
+                save = save or not self.persistent.isdisjoint(changed)
+                self.changed.notify_all()
+        if changed:
+            for fn in list(self.watchers):
+                fn(snap,changed)
+        if save and self.path:
+            self.save()
+        return changed
+
+    #fn(snapshot, {name:value} changed) after each update, on the updating thread
+    def watch(self,fn):
+        if fn not in self.watchers:
+            self.watchers.append(fn)
+
+    def unwatch(self,fn):
+        if fn in self.watchers:
+            self.watchers.remove(fn)
+
+    #persistent symbols from path (names and values), returns how many; missing file: 0
+    def load(self,path=None):
+        self.path = path or self.path
+        try:
+            with open(self.path) as fp:
+                doc = json.load(fp)
+        except FileNotFoundError:
+            return 0
+        except (OSError,ValueError) as e:
+            self.log('rfis.SymbolTable.load: '+self.path+': '+str(e))
+            return 0
+        syms = doc.get('symbols') if type(doc) == dict else None
+        if type(syms) != dict:
+            self.log('rfis.SymbolTable.load: '+self.path+': no "symbols" object')
+            return 0
+        syms = dict((k,v) for k, v in syms.items() if _is_number(v))
+        with self.changed:
+            self.persistent = self.persistent.union(syms)
+        self.update(syms)
+        return len(syms)
+
+    #write the persistent symbols (atomically: a crash leaves the old file)
+    #returns False if there was nothing newer than the last save, or it failed
+    def save(self):
+        with self.save_lock:
+            with self.changed:
+                snap = self.snapshot
+                names = self.persistent
+            if snap.version < self.saved[0] or (snap.version,names) == self.saved:
+                return False
+            syms = dict((k,snap.values[k]) for k in sorted(names) if k in snap.values)
+            tmp = self.path+'.'+str(os.getpid())
+            try:
+                with open(tmp,'w') as fp:
+                    json.dump({'format':SYMBOLS_FORMAT,'version':snap.version,'symbols':syms},fp,indent=1)
+                os.replace(tmp,self.path)
+            except OSError as e:
+                self.log('rfis.SymbolTable.save: '+self.path+': '+str(e))
+                return False
+            self.saved = (snap.version,names)
+            return True
 
 
 #kept in CommProcess
 #maintains overall state of hardware
+#updated from every packet sent to (sent()) and received from (received()) the micro
+#Every update notifies `changed`, so anything waiting on the hardware
+#(see ProgramThread.op_wait) re-checks the moment a packet lands instead
+#of polling. Waiters hold `changed` (which owns `lock`) while checking.
+#Per-motor values are arrays indexed by motor (MOTOR_1..MOTOR_5), for
+#whole-machine math (steps_to_mm(), mm_to_steps()); motors[m] views one.
+#Readers that don't need to wait should use `snapshot` instead of the lock.
 class HardwareState:
-    def __init__(self):
-        self.motors=[MotorState() for ii in range(MOTOR_COUNT)]
-        
+    def __init__(self,history=TELEMETRY_HISTORY):
+        _load_numpy()
+        self.pos=_zeros('q',MOTOR_COUNT) #current position
+        self.target=_zeros('q',MOTOR_COUNT) #goal position
+        self.running=_zeros('b',MOTOR_COUNT) #moving toward target
+        self.calibrated=_zeros('b',MOTOR_COUNT)
+        self.step_per_dist=_zeros('d',MOTOR_COUNT) #conversion between steps and linear distance of attached mechanism
+        self.maxpos=_zeros('q',MOTOR_COUNT) #limits
+        self.minpos=_zeros('q',MOTOR_COUNT)
+        self.stale=_zeros('b',MOTOR_COUNT) #moving when the serial link dropped, end not yet confirmed (see resync()), or position only estimated
+        self.stopped=_zeros('b',MOTOR_COUNT) #stopped mid-move: pos is an estimate until calibrated, reset or reported
+        self.eta=_zeros('d',MOTOR_COUNT) #estimated monotonic time the current move ends (at MOTOR_STEP_RATE)
+        self.lights=[(0,0,0)]*(LIGHT_COUNT+1) #rgb last sent to each ring light (index 0 unused)
+        self.pins=[0,0] #suction, blower
+        self.indicator=0 #0 clear, 1 done
+        for ii in range(MOTOR_COUNT):
+            self.step_per_dist[ii]=1
+        self.motors=[MotorState(self,ii) for ii in range(MOTOR_COUNT)]
+        self.error=None #last error code reported
+        self.telemetry=TelemetryRing(history)
+        self.version=0
+        self.lock=threading.Lock()
+        self.changed=threading.Condition(self.lock)
+        self.symbols=SymbolTable(self.changed) #values set by programs and the UI (ex. FORAM_PRESENT)
+        self.snapshot=None
+        self.publish()
+
+    #call holding lock: new snapshot for lock-free readers
+    def publish(self):
+        self.version += 1
+        self.snapshot = StateSnapshot(self.version,time.monotonic(),tuple(_tolist(self.pos)),tuple(_tolist(self.target)),
+                                      tuple(bool(r) for r in self.running),tuple(bool(c) for c in self.calibrated),self.error,
+                                      tuple(self.lights),tuple(self.pins),self.indicator,tuple(bool(s) for s in self.stale))
+
+    #call holding lock
+    def record(self,m,t=None):
+        self.telemetry.add(m,time.monotonic() if t is None else t,self.pos[m],self.target[m])
+
+    #positions (steps) -> distances, all axes at once; default current positions
+    def steps_to_mm(self,steps=None):
+        if steps is None:
+            steps = self.snapshot.pos
+        if numpy:
+            return numpy.asarray(steps)*self.step_per_dist
+        return [s*d for s, d in zip(steps,self.step_per_dist)]
+
+    def mm_to_steps(self,mm):
+        if numpy:
+            return numpy.rint(numpy.asarray(mm)/self.step_per_dist).astype('int64')
+        return [int(round(x/d)) for x, d in zip(mm,self.step_per_dist)]
+
+    #(times, positions, targets) recorded for motor m (index)
+    def history(self,m,n=None):
+        with self.lock:
+            return self.telemetry.history(m,n)
+
+    #symbols - {name:value}; defaults_only leaves already defined symbols alone
+    #(see SymbolTable.update()); symbol changes don't touch `version`
+    def set_symbols(self,symbols,defaults_only=False,persist=False):
+        return self.symbols.update(symbols,defaults_only,persist)
+
+    #position motor m (index) should have reached at monotonic time t, going
+    #from pos to target at MOTOR_STEP_RATE and due there at eta (lock held)
+    def estimate(self,m,t):
+        dist = self.target[m]-self.pos[m]
+        left = (self.eta[m]-t)*MOTOR_STEP_RATE[m]
+        if left >= abs(dist):
+            return self.pos[m]
+        return self.target[m]-int(round(left)) if dist > 0 else self.target[m]+int(round(left))
+
+    #wake all waiters without changing anything (ex. a program being stopped)
+    def poke(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    #t - time.monotonic() the packet was sent/received, for telemetry
+    def sent(self,p,t=None):
+        c = p[0]
+        with self.lock:
+            if c == ord('M'):
+                m = p[1]-ord('1')
+                if 0 <= m < MOTOR_COUNT:
+                    steps = ((p[2]&0x7f)<<8)|p[3]
+                    #a new move replaces the current one, relative to where the motor is headed
+                    self.target[m] += -steps if p[2]&0x80 else steps
+                    self.running[m] = 1
+                    self.eta[m] = (time.monotonic() if t is None else t)+abs(self.target[m]-self.pos[m])/MOTOR_STEP_RATE[m]
+                    self.record(m,t)
+            elif c == ord('S'):
+                #the board stops where it is and still reports "A<n>00": aim at
+                #an estimate of where that is, so the report doesn't land on the
+                #old target, and keep the motor stale since nothing confirms it
+                now = time.monotonic() if t is None else t
+                for m in range(MOTOR_COUNT):
+                    if self.running[m] and self.eta[m] > now:
+                        self.target[m] = self.estimate(m,now)
+                        self.eta[m] = now
+                        self.stopped[m] = 1
+                        self.stale[m] = 1
+                        self.record(m,t)
+            elif c == ord('C'):
+                m = p[1]-1
+                if 0 <= m < MOTOR_COUNT:
+                    self.pos[m] = self.target[m] = 0
+                    self.calibrated[m] = 1
+                    self.stale[m] = 0
+                    self.stopped[m] = 0
+                    self.record(m,t)
+            elif c == ord('R'):
+                for m in range(MOTOR_COUNT):
+                    self.pos[m] = self.target[m] = 0
+                    self.running[m] = 0
+                    self.calibrated[m] = 0
+                    self.stale[m] = 0
+                    self.stopped[m] = 0
+                    self.record(m,t)
+                self.error = None
+            elif c == ord('L'):
+                light = p[1]>>2
+                if light == 0:
+                    self.indicator = p[1]&3
+                elif light <= LIGHT_COUNT: #6 bits per colour, see encode_light()
+                    r = ((p[1]&3)<<4)|(p[2]>>4)
+                    g = ((p[2]&0xf)<<2)|(p[3]>>6)
+                    b = p[3]&0x3f
+                    self.lights[light] = (r<<2,g<<2,b<<2)
+            elif c == ord('P'):
+                if p[1] < 2:
+                    self.pins[p[1]] = 1 if p[2] else 0
+            else:
+                return
+            self.publish()
+            self.changed.notify_all()
+
+    def received(self,p,t=None):
+        c = p[0]
+        with self.lock:
+            if c == ord('A'):
+                m = p[1]-ord('1')
+                if 0 <= m < MOTOR_COUNT:
+                    self.running[m] = 0
+                    if p[2:4] == b'00': #plain arrival report (at target, or where a stop left it)
+                        self.pos[m] = self.target[m]
+                        self.stale[m] = self.stopped[m]
+                    else: #with encoder position, signed magnitude
+                        pos = ((p[2]&0x7f)<<8)|p[3]
+                        self.pos[m] = self.target[m] = -pos if p[2]&0x80 else pos
+                        self.stale[m] = self.stopped[m] = 0
+                    self.record(m,t)
+            elif c == ord('E'):
+                self.error = p[1:4].decode('latin-1')
+            else:
+                return
+            self.publish()
+            self.changed.notify_all()
+
+    #undo sent() for a packet that never reached the board (aborted after a reconnect,
+    #or turned away by the full serial queue)
+    def unsend(self,p):
+        c = p[0]
+        with self.lock:
+            if c == ord('M'):
+                m = p[1]-ord('1')
+                if 0 <= m < MOTOR_COUNT:
+                    steps = ((p[2]&0x7f)<<8)|p[3]
+                    self.target[m] -= -steps if p[2]&0x80 else steps
+                    self.running[m] = 1 if self.target[m] != self.pos[m] else 0
+                    self.record(m)
+            elif c == ord('C'):
+                m = p[1]-1
+                if 0 <= m < MOTOR_COUNT: #sent() zeroed it, but the board never homed
+                    self.calibrated[m] = 0
+                    self.stale[m] = 1
+            else:
+                return
+            self.publish()
+            self.changed.notify_all()
+
+    #the serial link is back: settle moves whose arrival reports may have been
+    #lost while it was down. The board finishes every move it was given, so a
+    #move estimated to have ended (eta+margin) already is taken as done, and one
+    #that clearly ends later will still report. Anything in between is stale
+    #until its report comes or settle() gives up on it. Motors that were idle
+    #when the link dropped haven't moved and need nothing.
+    #pending - motors with a move still queued: it starts now, whatever sent() estimated
+    #returns {'derived':[...],'moving':[...],'stale':[...]} (motor indices)
+    def resync(self,now=None,pending=(),margin=RESYNC_MARGIN):
+        now = time.monotonic() if now is None else now
+        out = {'derived':[],'moving':[],'stale':[]}
+        with self.lock:
+            for m in range(MOTOR_COUNT):
+                if not self.running[m]:
+                    continue
+                if m in pending:
+                    self.eta[m] = now+abs(self.target[m]-self.pos[m])/MOTOR_STEP_RATE[m]
+                    out['moving'].append(m)
+                elif self.eta[m]+margin <= now:
+                    self.pos[m] = self.target[m]
+                    self.running[m] = 0
+                    self.stale[m] = self.stopped[m]
+                    self.record(m,now)
+                    out['derived'].append(m)
+                elif self.eta[m]-margin > now:
+                    out['moving'].append(m)
+                else:
+                    self.stale[m] = 1
+                    out['stale'].append(m)
+            self.publish()
+            self.changed.notify_all()
+        return out
+
+    #finish stale moves that are past eta+margin without a report
+    #returns (motor indices settled, monotonic time of the next deadline or None)
+    def settle(self,now=None,margin=RESYNC_MARGIN):
+        now = time.monotonic() if now is None else now
+        done = []
+        deadline = None
+        with self.lock:
+            for m in range(MOTOR_COUNT):
+                if not (self.stale[m] and self.running[m]):
+                    continue
+                if self.eta[m]+margin <= now:
+                    self.pos[m] = self.target[m]
+                    self.running[m] = 0
+                    self.stale[m] = self.stopped[m]
+                    self.record(m,now)
+                    done.append(m)
+                elif deadline is None or self.eta[m]+margin < deadline:
+                    deadline = self.eta[m]+margin
+            if done:
+                self.publish()
+                self.changed.notify_all()
+        return done, deadline
+
 
-# --- INCOMPLETE --- don't take the following as authoritative
 # Action programs are defined as JSON arrays.
+# (compile_program() below is the reference for what's accepted)
 #
 # The first element is always an object containing zero or more fields 
 # for program metadata.
 #   Defined fields are as follows:
 #    "description"
-#      (optional) String used to describe entire program.
+#      (optional) String (or array of strings, one per line) used to
+#      describe entire program.
 #    "symbols"
 #      (optional) Object containing zero or more key-value pairs
 #      defining the default value of symbols.
@@ -126,6 +967,9 @@ class HardwareState:
 #  It is helpful to have a consistent and distinct formatting for
 #  symbol names (ex. SOME_SYMBOL1, OTHER_SYM2, etc)
 #
+#  Motors are numbered 1-5, and may also be given by name (see
+#  MOTOR_ALIASES, ex. "STAGE_X"), as an array of either, or as "all".
+#
 # The remaining elements (zero or more) are command objects.
 # There are two types of commands:
 #   'Remote' - messages to microcontroller (see serial protocol spec)
@@ -148,9 +992,9 @@ class HardwareState:
 # Verbose form, while an object, should still be written in order for
 # readability. Required fields are a unique "name", the specific
 # "command" (which may be written using the single-character as in 
-# compact form, or the full lower-case word), and the named arguments.
+# compact form, or the full word, in any case), and the named arguments.
 #   Verbose examples:
-#     {"name":"command":"move","motors":1,"positions":-100}
+#     {"name":"move_1","command":"move","motors":1,"positions":-100}
 #
 # Not all messages defined in the serial protocol are supported.
 # Remote commands:
@@ -161,12 +1005,19 @@ class HardwareState:
 #       "motors" - single integer 1-5, or array of the same.
 #       "ticks"  - unsigned 16-bit integer, representing the number of
 #                  clock cycles of delay (approx 1/48E6 seconds/tick)
-#    "light" ("L")
-#    "move" ("M") 
-#    "pin" ("P")
-#    "stop" ("S")
-#    "trigger" ("T")
-#    "reset" ("R")
+#       (compact "D" with no arguments is shorthand for "DONE")
+#     "L" "light"
+#       "light" - 1-16 (ring pixel)
+#       "rgb"   - array of 3 values 0-255
+#     "M" "move"
+#       "motors"    - as above
+#       "positions" - absolute target position, or array of one per motor
+#     "P" "pin"
+#       "pin"   - 0 (suction) or 1 (blower)
+#       "state" - 0 (off) or 1 (on)
+#     "S" "stop"
+#     "R" "reset"
+#     "T" "trigger" - not supported by the firmware, rejected
 #    Special case commands, like clear and done (implemented in the
 #    "Light" command), have a shorthand form:
 #      "DONE" ("DONE")
@@ -175,106 +1026,2740 @@ class HardwareState:
 #        Removes the Done and Error conditions to return the indicator
 #        LED to either green or yellow (calibrated or not).
 # Local commands:
-#  "w" "wait" - conditions: time, arrive, error val, error code, symbol value (or not), timeout
-#      defaults: ["name","w",timeout_seconds,"timeout message"] - waits for all motors to go idle
-#  "g" "goto"
+#  "w" "wait" - waits for all of its conditions, or its timeout
+#      compact: ["name","w",timeout_seconds,timeout_action,"timeout message"]
+#        waits for all motors to go idle
+#      verbose: "conditions" - object with any of
+#                 "time"          - seconds to wait
+#                 "arrive"        - motors that must go idle (default for compact form)
+#                 "error"         - error code to wait for
+#                 "symbol_values" - object of symbol:value that must all match
+#                 "symbol_not"    - object of symbol:value that must all differ
+#                 "command"       - UI command to wait for (ex. "clear")
+#               "timeout", "timeout_message", "timeout_action"
+#      timeout_action: "STOP" (stop motors, end program, the default),
+#        "CONTINUE", or a goto (["g","label"])
+#  "g" "goto" - ["name","g","label"], verbose "label"
 #  "p" "prog" - chain execution of programs, or specify self to loop
+#      ["name","p","program_name"], verbose "program"
 #  "s" "syms" update symbol(s)
+#      ["name","s",{"SYMBOL":value,...}], verbose "symbols"
 #
 
+# Compiled programs
+# compile_program() checks a whole program once and turns it into a flat
+# list of Instructions, so ProgramThread never looks at JSON while
+# motors are moving: command letters/words are resolved to an op,
+# motors to indices, goto labels to instruction indices, and packets
+# with constant arguments are built up front. Only symbol lookups (and
+# move step counts, which depend on where the motor is) are left for
+# run time. Malformed programs raise ProgramError.
 #
-# Commands may read symbolic values defined in the UI.
-#
+# Instruction args by op:
+#   OP_SEND     () - packets are ready to go
+#   OP_SEND_SYM ((encoder,(arg,...)),...) - args may be symbol names
+#   OP_MOVE     (motor indices,positions) - positions may be symbol names
+#   OP_WAIT     (conditions,timeout,timeout_action,message,mark)
+#               conditions: tuple of (COND_*,...) (see ProgramThread.check())
+#               timeout_action: (ACTION_STOP,), (ACTION_CONTINUE,) or (ACTION_GOTO,index)
+#               mark: OP_MARK slot the timeout counts from, None for "now"
+#   OP_GOTO     (index,)
+#   OP_PROG     (program name,) - None restarts this program
+#   OP_SYMS     ({symbol:value},)
+#   OP_MARK     (slot,) - notes the time (see pipeline_program())
+Instruction=collections.namedtuple('Instruction','op name args packets')
+
+class ProgramError(ValueError):
+    pass
+
+
+# Compiled form of one program; see compile_program()
+class CompiledProgram:
+    def __init__(self,name,description,symbols,code,labels,overlap=True):
+        self.name = name
+        self.description = description
+        self.symbols = symbols #defaults from metadata
+        self.code = code #list of Instructions
+        self.labels = labels #name -> index into code
+        self.overlap = overlap #metadata "overlap": false keeps moves strictly in sequence
+        self._pipelined = None
+
+    #the version ProgramThread runs: overlapped unless the program opts out
+    def runnable(self):
+        if not self.overlap:
+            return self
+        if self._pipelined is None:
+            self._pipelined = pipeline_program(self)
+        return self._pipelined
+
+    def __len__(self):
+        return len(self.code)
+
+
+#command names (compact letter or verbose word) -> compiler method
+_COMMAND_NAMES={'C':'calibrate','D':'delay','L':'light','M':'move','P':'pin','S':'stop',
+                'T':'trigger','R':'reset','DONE':'done','CLEAR':'clear',
+                'w':'wait','g':'goto','p':'prog','s':'syms'}
+_COMMAND_WORDS=set(_COMMAND_NAMES.values())
+
+#positional (compact form) argument names by command
+_COMPACT_ARGS={'calibrate':('motors',),'delay':('motors','ticks'),'light':('light','rgb'),
+               'move':('motors','positions'),'pin':('pin','state'),'stop':(),'trigger':(),
+               'reset':(),'done':(),'clear':(),
+               'wait':('timeout','timeout_action','timeout_message'),
+               'goto':('label',),'prog':('program',),'syms':('symbols',)}
+
+#verbose spellings accepted for argument names
+_ARG_ALIASES={'motor':'motors','position':'positions','target':'label','color':'rgb'}
+
+def compile_program(doc,name=None):
+    return _ProgramCompiler(doc,name).compile()
+
+
+class _ProgramCompiler:
+    def __init__(self,doc,name):
+        self.doc = doc
+        self.name = name
+        self.labels = {}
+        self.gotos = [] #(instruction index, label, field) to resolve at the end
+        self.code = []
+
+    def error(self,msg,index=None,name=None):
+        where = ''
+        if index is not None:
+            where = 'command '+str(index)
+            if name:
+                where += ' ("'+str(name)+'")'
+            where += ': '
+        raise ProgramError(where+msg)
+
+    def compile(self):
+        doc = self.doc
+        if type(doc) != list:
+            self.error('program must be an array')
+        if len(doc) == 0:
+            self.error('program is empty')
+        if type(doc[0]) != dict:
+            self.error('first element must be an object')
+        meta = doc[0]
+        description = meta.get('description','')
+        if type(description) == list:
+            description = '\n'.join(str(d) for d in description)
+        symbols = meta.get('symbols',{})
+        if type(symbols) != dict:
+            self.error('"symbols" must be an object')
+        for k, v in symbols.items():
+            if not _is_number(v):
+                self.error('default for symbol "'+k+'" must be numeric')
+        #first pass: names, so gotos can point forward
+        parsed = []
+        for ii, cmd in enumerate(doc[1:]):
+            name, word, args = self.parse(ii,cmd)
+            if name in self.labels:
+                self.error('duplicate name',ii,name)
+            self.labels[name] = ii
+            parsed.append((name,word,args))
+        for ii, (name, word, args) in enumerate(parsed):
+            self.index = ii
+            self.cmd_name = name
+            getattr(self,'c_'+word)(name,args)
+        for ii, label in self.gotos:
+            if label not in self.labels:
+                self.error('unknown label "'+str(label)+'"',ii,self.code[ii].name)
+        #gotos were compiled with label names, swap in indices
+        for ii, label in self.gotos:
+            ins = self.code[ii]
+            if ins.op == OP_GOTO:
+                self.code[ii] = ins._replace(args=(self.labels[label],))
+            else: #wait with a goto timeout action
+                conds, timeout, action, msg, mark = ins.args
+                self.code[ii] = ins._replace(args=(conds,timeout,(ACTION_GOTO,self.labels[label]),msg,mark))
+        overlap = meta.get('overlap',True)
+        if type(overlap) != bool:
+            self.error('"overlap" must be true or false')
+        return CompiledProgram(self.name,description,dict(symbols),self.code,dict(self.labels),overlap)
+
+    #returns (name, command word, {argument:value})
+    def parse(self,ii,cmd):
+        if type(cmd) == list:
+            if len(cmd) < 2 or type(cmd[0]) != str or type(cmd[1]) != str:
+                self.error('compact form is ["name","command",arguments...]',ii)
+            name = cmd[0]
+            word = self.command_word(cmd[1],ii,name)
+            if word == 'delay' and len(cmd) == 2: #["done","D"]
+                word = 'done'
+            names = _COMPACT_ARGS[word]
+            if len(cmd)-2 > len(names):
+                self.error('too many arguments',ii,name)
+            args = dict(zip(names,cmd[2:]))
+        elif type(cmd) == dict:
+            name = cmd.get('name')
+            if type(name) != str:
+                self.error('verbose form needs a "name"',ii)
+            if 'command' not in cmd:
+                self.error('verbose form needs a "command"',ii,name)
+            word = self.command_word(cmd['command'],ii,name)
+            args = {}
+            for k, v in cmd.items():
+                if k not in ('name','command'):
+                    args[_ARG_ALIASES.get(k,k)] = v
+        else: #program was tampered with
+            self.error('program command must be given as array or object',ii)
+        return name, word, args
+
+    def command_word(self,c,ii,name):
+        if type(c) != str:
+            self.error('invalid command',ii,name)
+        if c in _COMMAND_NAMES:
+            return _COMMAND_NAMES[c]
+        if c.lower() in _COMMAND_WORDS:
+            return c.lower()
+        if c.upper() in _COMMAND_NAMES:
+            return _COMMAND_NAMES[c.upper()]
+        self.error('unknown command "'+c+'"',ii,name)
+
+    def emit(self,op,name,args=(),packets=()):
+        self.code.append(Instruction(op,name,args,packets))
+
+    def require(self,args,key):
+        if key not in args:
+            self.error('missing "'+key+'"',self.index,self.cmd_name)
+        return args[key]
+
+    #motors -> tuple of indices (0-4)
+    def motors(self,m):
+        if m == 'all':
+            return tuple(range(MOTOR_COUNT))
+        if type(m) != list:
+            m = [m]
+        out = []
+        for x in m:
+            if type(x) == str and x in MOTOR_ALIASES:
+                x = MOTOR_ALIASES[x]
+            try:
+                x = _motor_number(x)
+            except (ValueError,TypeError):
+                self.error('invalid motor '+json.dumps(x),self.index,self.cmd_name)
+            out.append(x-1)
+        if not out:
+            self.error('no motors given',self.index,self.cmd_name)
+        return tuple(out)
+
+    #numeric value or symbol name
+    def value(self,v):
+        if _is_number(v) or type(v) == str:
+            return v
+        self.error('expected a number or symbol, got '+json.dumps(v),self.index,self.cmd_name)
+
+    #precompute packets if every argument is constant
+    def remote(self,name,encoder,arglists):
+        try:
+            if all(_is_number(a) for args in arglists for a in args):
+                self.emit(OP_SEND,name,(),tuple(encoder(*args) for args in arglists))
+            else:
+                self.emit(OP_SEND_SYM,name,tuple((encoder,tuple(args)) for args in arglists))
+        except ValueError as e:
+            self.error(str(e),self.index,name)
+
+    def c_calibrate(self,name,args):
+        self.remote(name,encode_calibrate,[(m+1,) for m in self.motors(self.require(args,'motors'))])
+
+    def c_delay(self,name,args):
+        ticks = self.value(self.require(args,'ticks'))
+        self.remote(name,encode_delay,[(m+1,ticks) for m in self.motors(self.require(args,'motors'))])
+
+    def c_light(self,name,args):
+        light = self.value(self.require(args,'light'))
+        rgb = self.require(args,'rgb')
+        if type(rgb) != list or len(rgb) != 3:
+            self.error('"rgb" must be an array of 3 values',self.index,name)
+        rgb = [self.value(c) for c in rgb]
+        if _is_number(light) and light == 0:
+            self.error('light 0 is the indicator, use DONE/CLEAR',self.index,name)
+        self.remote(name,_encode_light_values,[(light,)+tuple(rgb)])
+
+    def c_move(self,name,args):
+        motors = self.motors(self.require(args,'motors'))
+        pos = self.require(args,'positions')
+        if type(pos) == list:
+            if len(pos) != len(motors):
+                self.error('need one position per motor',self.index,name)
+            pos = tuple(self.value(p) for p in pos)
+        else:
+            pos = (self.value(pos),)*len(motors)
+        for p in pos:
+            if _is_number(p) and (p < -0x7fff or p > 0x7fff):
+                self.error('position out of range: '+str(p),self.index,name)
+        self.emit(OP_MOVE,name,(motors,pos))
+
+    def c_pin(self,name,args):
+        self.remote(name,encode_pin,[(self.value(self.require(args,'pin')),self.value(self.require(args,'state')))])
+
+    def c_stop(self,name,args):
+        self.emit(OP_SEND,name,(),(encode_stop(),))
+
+    def c_reset(self,name,args):
+        self.emit(OP_SEND,name,(),(encode_reset(),))
+
+    def c_done(self,name,args):
+        self.emit(OP_SEND,name,(),(encode_done(),))
+
+    def c_clear(self,name,args):
+        self.emit(OP_SEND,name,(),(encode_clear(),))
+
+    def c_trigger(self,name,args):
+        self.error('"trigger" is not supported by the firmware',self.index,name)
+
+    def c_wait(self,name,args):
+        timeout = args.get('timeout')
+        if timeout is not None and (not _is_number(timeout) or timeout < 0):
+            self.error('"timeout" must be a number of seconds',self.index,name)
+        message = str(args.get('timeout_message',''))
+        action = args.get('timeout_action','STOP')
+        if action == 'STOP':
+            action = (ACTION_STOP,)
+        elif action == 'CONTINUE':
+            action = (ACTION_CONTINUE,)
+        elif type(action) == list and len(action) == 2 and _COMMAND_NAMES.get(action[0],action[0]) == 'goto':
+            self.gotos.append((len(self.code),action[1]))
+            action = (ACTION_GOTO,action[1])
+        else:
+            self.error('invalid timeout_action '+json.dumps(action),self.index,name)
+        spec = args.get('conditions',{'arrive':'all'})
+        if type(spec) != dict:
+            self.error('"conditions" must be an object',self.index,name)
+        conds = []
+        for k, v in spec.items():
+            if k == 'time':
+                if not _is_number(v):
+                    self.error('"time" must be a number of seconds',self.index,name)
+                conds.append((COND_TIME,v))
+            elif k == 'arrive':
+                conds.append((COND_IDLE,self.motors(v)))
+            elif k == 'error':
+                conds.append((COND_ERROR,v))
+            elif k == 'symbol_values' or k == 'symbol_not':
+                if type(v) != dict:
+                    self.error('"'+k+'" must be an object',self.index,name)
+                for sym, val in v.items():
+                    conds.append((COND_SYMBOL,sym,self.value(val),k == 'symbol_values'))
+            elif k == 'command':
+                conds.append((COND_COMMAND,str(v)))
+            else:
+                self.error('unknown wait condition "'+k+'"',self.index,name)
+        self.emit(OP_WAIT,name,(tuple(conds),timeout,action,message,None))
+
+    def c_goto(self,name,args):
+        self.gotos.append((len(self.code),self.require(args,'label')))
+        self.emit(OP_GOTO,name,(None,))
+
+    def c_prog(self,name,args):
+        prog = self.require(args,'program')
+        if type(prog) != str:
+            self.error('"program" must be a name',self.index,name)
+        if prog == 'self' or (self.name is not None and prog == self.name):
+            prog = None
+        self.emit(OP_PROG,name,(prog,))
+
+    def c_syms(self,name,args):
+        syms = self.require(args,'symbols')
+        if type(syms) != dict or not all(_is_number(v) for v in syms.values()):
+            self.error('"symbols" must be an object of numeric values',self.index,name)
+        self.emit(OP_SYMS,name,(dict(syms),))
+
+def _is_number(v):
+    return (type(v) == int or type(v) == float) and type(v) != bool
+
+def _encode_light_values(light,r,g,b):
+    return encode_light(light,(r,g,b))
+
+
+# Overlapped motion
+# Programs are written as "move, wait for arrival" pairs, which keeps
+# every axis idle while any other one moves. pipeline_program() rewrites
+# a compiled program so an arrival wait is put off until an instruction
+# actually needs those axes: a later move waits only for its own axes
+# and the axes AXIS_CONFLICTS says it can't move alongside, anything
+# else (sends, other waits, jumps, jump targets, the end) waits for
+# everything still outstanding, in the original order.
+# A deferred wait leaves an OP_MARK where it was so its timeout still
+# counts from there. Only waits that are purely "arrive" with a STOP or
+# CONTINUE timeout action are deferred.
+def pipeline_program(program,conflicts=None):
+    if conflicts is None:
+        conflicts = AXIS_CONFLICTS
+    code = program.code
+    #instructions a goto (or a wait's goto timeout action) can land on are
+    #barriers; labels are every command's name, so they aren't all targets
+    jumped = set(ins.args[0] for ins in code if ins.op == OP_GOTO)
+    jumped |= set(ins.args[2][1] for ins in code if ins.op == OP_WAIT and ins.args[2][0] == ACTION_GOTO)
+    out = []
+    where = [] #old index -> new index
+    pending = [] #[axes still deferred, wait instruction, mark slot]
+    marks = 0
+
+    def settle(axes):
+        for d in pending:
+            need = d[0] & axes if axes is not None else d[0]
+            if need:
+                a = d[1].args #(conditions,timeout,action,message,mark): same timeout, counted from its mark
+                out.append(d[1]._replace(args=(((COND_IDLE,tuple(sorted(need))),),a[1],a[2],a[3],d[2])))
+                d[0] = d[0]-need
+        pending[:] = [d for d in pending if d[0]]
+
+    for ii, ins in enumerate(code):
+        if ii in jumped:
+            settle(None)
+        where.append(len(out))
+        if ins.op == OP_MOVE:
+            axes = set(ins.args[0])
+            for m in ins.args[0]:
+                axes |= set(conflicts.get(m,()))
+            settle(axes)
+            out.append(ins)
+        elif (ins.op == OP_WAIT and len(ins.args[0]) == 1 and ins.args[0][0][0] == COND_IDLE
+              and ins.args[2][0] != ACTION_GOTO):
+            pending.append([set(ins.args[0][0][1]),ins,marks])
+            out.append(Instruction(OP_MARK,ins.name,(marks,),()))
+            marks += 1
+        else:
+            settle(None)
+            out.append(ins)
+    settle(None)
+    #re-point jumps
+    for jj, ins in enumerate(out):
+        if ins.op == OP_GOTO:
+            out[jj] = ins._replace(args=(where[ins.args[0]],))
+        elif ins.op == OP_WAIT and ins.args[2][0] == ACTION_GOTO:
+            a = ins.args
+            out[jj] = ins._replace(args=(a[0],a[1],(ACTION_GOTO,where[a[2][1]]),a[3],a[4]))
+    labels = dict((k,where[v]) for k, v in program.labels.items())
+    return CompiledProgram(program.name,program.description,program.symbols,out,labels,program.overlap)
+
+
+# Dry run
+# Walks a compiled program once, top to bottom (jumps are not followed),
+# with every motor moving at MOTOR_STEP_RATE from `positions` (all 0 by
+# default) and symbols at their defaults, and returns:
+#   {"time": estimated seconds,
+#    "steps": [(name,start,end)] per instruction that takes time,
+#    "critical": [(name,motor,start,end)] - the moves that set the finish time}
+# Waits on anything but time and arrival are taken as already satisfied.
+def dry_run(program,positions=None,step_rates=MOTOR_STEP_RATE,symbols=None):
+    syms = dict(program.symbols)
+    if symbols:
+        syms.update(symbols)
+    def value(v):
+        return syms.get(v,0) if type(v) == str else v
+    pos = list(positions) if positions else [0]*MOTOR_COUNT
+    busy = [0.0]*MOTOR_COUNT #time each motor arrives
+    last = [None]*MOTOR_COUNT #move that motor is doing: (name,motor,start,end,cause)
+    marks = {}
+    t = 0.0
+    cause = None #move whose arrival released the current time
+    steps = []
+    for ins in program.code:
+        if ins.op == OP_MOVE:
+            for m, p in zip(*ins.args):
+                p = int(value(p))
+                #a move sent to a running motor replaces its move, from where it is now
+                if busy[m] > t and last[m]:
+                    done = (t-last[m][2])/(last[m][3]-last[m][2])
+                    pos[m] = int(last[m][5]+(pos[m]-last[m][5])*done)
+                d = abs(p-pos[m])/float(step_rates[m])
+                last[m] = (ins.name,m+1,t,t+d,cause,pos[m])
+                pos[m] = p
+                busy[m] = t+d
+            steps.append((ins.name,t,max(busy[m] for m in ins.args[0])))
+        elif ins.op == OP_WAIT:
+            conds, timeout, action, message = ins.args[:4]
+            start = marks.get(ins.args[4],t) if len(ins.args) > 4 and ins.args[4] is not None else t
+            end = t
+            for c in conds:
+                if c[0] == COND_IDLE:
+                    for m in c[1]:
+                        if busy[m] > end:
+                            end = busy[m]
+                            cause = last[m]
+                elif c[0] == COND_TIME and start+c[1] > end:
+                    end = start+c[1]
+                    cause = (ins.name,None,start,end,cause,None)
+            steps.append((ins.name,t,end))
+            t = end
+        elif ins.op == OP_MARK:
+            marks[ins.args[0]] = t
+        elif ins.op == OP_SYMS:
+            syms.update(ins.args[0])
+        elif ins.op in (OP_GOTO,OP_PROG):
+            break
+    #finish: everything still moving
+    for m in range(MOTOR_COUNT):
+        if busy[m] > t:
+            t = busy[m]
+            cause = last[m]
+    critical = []
+    while cause:
+        critical.append(cause[:4])
+        cause = cause[4]
+    critical.reverse()
+    return {'time':t,'steps':steps,'critical':critical}
+
+#text report comparing a program's sequential and overlapped timing
+#symbols - {name:value} on top of the program's defaults (ex. the relay's persistent ones)
+def dry_run_report(program,positions=None,symbols=None):
+    lines = ['program: '+str(program.name)]
+    for label, prog in (('sequential',program),('overlapped',pipeline_program(program))):
+        r = dry_run(prog,positions,symbols=symbols)
+        lines.append(label+': '+'{:.2f}'.format(r['time'])+' s')
+        for name, motor, start, end in r['critical']:
+            what = 'motor '+str(motor) if motor else 'delay'
+            lines.append('  '+'{:7.2f} - {:7.2f}  {} ({})'.format(start,end,name,what))
+    return '\n'.join(lines)
+
+
+# Sequencer
+# Runs one compiled program against a relay: `api` must provide
+# send(packet) (thread-safe) and `state` (the HardwareState to read
+# positions from), which CommProcess does.
+# Each step is a lookup in a dispatch table indexed by op; each handler
+# returns the index of the next instruction.
+# Control messages go through post(): "stop" ends the program, "step"
+# releases the next instruction when autostep is off, anything else
+# (ex. "clear") satisfies a wait for that command.
+# Waits sleep on state.changed, which every hardware/symbol update and
+# every post() notifies, with a timeout only for time conditions and
+# the wait's own timeout.
+# Symbols live in state.symbols (a SymbolTable) so the UI can change them
+# mid-program; reading one doesn't take a lock.
 class ProgramThread(threading.Thread):
-    def __init__(self, api, autostep, stepdelay): 
-        threading.Thread.__init__(self)
-        self.msgi = None
+    def __init__(self, api, autostep=True, stepdelay=0, log=print): 
+        threading.Thread.__init__(self,daemon=True)
+        self.msgi = collections.deque() #control messages in, see post()
         self.msgo = None
         self.api = api
+        self.log = log #program errors, timeouts and descriptions
+        self.state = getattr(api,'state',None) or HardwareState()
         self.filename=None
         self.progname=None
-        self.program = None
+        self.program = None #CompiledProgram
+        self.source = None #program JSON string/array for run() to load (keeps compiling off the caller's thread)
+        self.code = None #instructions being run, see select()
         self.autostep = autostep
         self.stepdelay=stepdelay
         self.running=False
+        self.stopping=False
+        self.commands=[] #UI commands received, for command waits
+        self.result=None #how the program ended
+        self.overlap = True #run moves on independent axes together (see pipeline_program())
+        self.marks = {} #OP_MARK slot -> time
+        self.pc = 0 #instruction about to run
+        self.watch = False #wake the relay on every step, for "program" subscribers
+        self.capture = None #records sequencer events, {event:...} -> None (see CommProcess.capture())
+        self.step_time = None #LatencyHistograms for instruction run times, waits in wait_time
+        self.wait_time = None
+        self.ops = (self.op_send,self.op_send_sym,self.op_move,self.op_wait,self.op_goto,self.op_prog,self.op_syms,self.op_mark)
 
+    #progname - catalog name (isfile) or program JSON string/array
     def load(self,progname,isfile):
         if isfile:
-            self.filename='programs/'+progname+'.json'
-            self.progname=progname
-            try:
-                print('attempting to open "programs/'+self.filename+'.json')
-                fp = open('programs/'+self.filename+'.json')
-                print('attempting to load "programs/'+self.filename+'.json')
-                self.program = json.load(fp)
-                fp.close()
-            except Exception as e:
+            #compiled ahead of time by the cache, no disk access here
+            cache = getattr(self.api,'programs',None)
+            entry = cache.entry(progname) if cache else None
+            if not entry or not entry.program:
                 self.filename=None
                 self.progname=None
-                print(str(e))
-                return False
-        else: #not a file, should be string containing json
-            self.filename=None #in case this thread gets reused, clear any lingering details
-            self.progname=None
-            try:
-                print('attempting to load string')
-                self.program = json.loads(progname)
-            except Exception as e:
-                print(str(e))
+                self.log('SEQ: program "'+str(progname)+'" unavailable'+(': '+entry.error if entry else ''))
                 return False
+            self.filename=entry.path
+            self.progname=entry.name
+            self.program=entry.program
+            self.state.set_symbols(self.program.symbols,True)
+            return True
+        self.filename=None #in case this thread gets reused, clear any lingering details
+        self.progname=None
+        try:
+            doc = json.loads(progname) if type(progname) == str else progname
+        except Exception as e:
+            self.log('SEQ: invalid program JSON: '+str(e))
+            return False
         #have valid JSON, examine structure and fields to validate
-        if type(self.program) != list:
-            print('program must be an array')
+        try:
+            self.program = compile_program(doc,self.progname)
+        except ProgramError as e:
+            self.log('SEQ: invalid program: '+str(e))
             self.program = None
             return False
-        if len(self.program) == 0:
-            print('program is empty')
-            self.program = None
+        self.state.set_symbols(self.program.symbols,True)
+        return True
+
+    def stop(self):
+        self.stopping = True
+        self.state.poke()
+
+    #instructions to run for a program
+    def select(self,program):
+        return program.runnable().code if self.overlap else program.code
+
+    #thread-safe: queue a control message and wake the program if it's waiting
+    def post(self,m):
+        with self.state.changed:
+            self.msgi.append(m)
+            self.state.changed.notify_all()
+
+    #value of a constant or symbol
+    def resolve(self,v):
+        if type(v) == str:
+            return self.state.symbols.get(v)
+        return v
+
+    def run(self):
+        if self.source is not None:
+            source, self.source = self.source, None
+            if not self.load(source,False):
+                self.result = 'rejected'
+                if self.capture:
+                    self.capture({'event':'end','program':None,'result':self.result})
+                wake = getattr(self.api,'wake',None)
+                if wake:
+                    wake()
+                return
+        if not self.program:
+            self.log('SEQ: no program loaded')
+            return
+        if self.program.description:
+            self.log('SEQ: '+self.program.description)
+        self.running = True
+        self.result = 'done'
+        self.code = self.select(self.program)
+        ops = self.ops
+        capture = self.capture
+        if capture:
+            capture({'event':'start','program':self.progname,'overlap':self.overlap})
+        pc = 0
+        try:
+            while 0 <= pc < len(self.code) and not self.stopping:
+                if not self.autostep and not self.wait_step():
+                    break
+                ins = self.code[pc]
+                t = time.monotonic()
+                pc = ops[ins.op](ins,pc)
+                if self.step_time:
+                    (self.wait_time if ins.op == OP_WAIT else self.step_time).record(time.monotonic()-t)
+                self.pc = pc
+                if capture:
+                    capture({'event':'step','name':ins.name,'next':pc})
+                if self.watch:
+                    self.api.wake()
+                if self.stepdelay:
+                    time.sleep(self.stepdelay)
+        except ProgramError as e:
+            self.log('SEQ: program error: '+str(e))
+            self.api.send(encode_stop())
+            self.result = 'error'
+        if self.stopping and self.result == 'done':
+            self.result = 'stopped'
+        if capture:
+            capture({'event':'end','program':self.progname,'result':self.result})
+        self.running = False
+        wake = getattr(self.api,'wake',None)
+        if wake:
+            wake()
+
+    def wait_step(self):
+        with self.state.changed:
+            while not self.stopping:
+                while self.msgi:
+                    m = self.msgi.popleft()
+                    if m == 'step':
+                        return True
+                    self.control(m)
+                if not self.stopping:
+                    self.state.changed.wait()
+        return False
+
+    #handle a control message that isn't a step
+    def control(self,m):
+        if m == 'stop':
+            self.stopping = True
+        else:
+            self.commands.append(m)
+
+    #call holding state.changed
+    def drain_control(self):
+        while self.msgi:
+            self.control(self.msgi.popleft())
+
+    # --- op handlers: (instruction, index) -> next index ---
+
+    def op_send(self,ins,pc):
+        for p in ins.packets:
+            self.api.send(p)
+        return pc+1
+
+    def op_send_sym(self,ins,pc):
+        for encoder, args in ins.args:
+            try:
+                self.api.send(encoder(*[self.resolve(a) for a in args]))
+            except ValueError as e:
+                raise ProgramError(ins.name+': '+str(e))
+        return pc+1
+
+    def op_move(self,ins,pc):
+        motors, positions = ins.args
+        for m, p in zip(motors,positions):
+            steps = int(self.resolve(p))-int(self.state.target[m])
+            if steps:
+                try:
+                    self.api.send(encode_move(m+1,steps))
+                except ValueError as e:
+                    raise ProgramError(ins.name+': '+str(e))
+        return pc+1
+
+    def op_wait(self,ins,pc):
+        conds, timeout, action, message, mark = ins.args
+        start = time.monotonic() if mark is None else self.marks[mark]
+        deadline = start+timeout if timeout is not None else None
+        #only time conditions need a timed wakeup, everything else is notified
+        timed = [start+c[1] for c in conds if c[0] == COND_TIME]
+        cv = self.state.changed
+        with cv:
+            while not self.stopping:
+                self.drain_control()
+                if all(self.check(c,start) for c in conds):
+                    return pc+1
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+                wake = [t for t in timed if t > now]
+                if deadline is not None:
+                    wake.append(deadline)
+                cv.wait(min(wake)-now if wake else None)
+        if self.stopping:
+            return -1
+        self.log('SEQ: timeout: '+(message or ins.name))
+        if action[0] == ACTION_GOTO:
+            return action[1]
+        if action[0] == ACTION_CONTINUE:
+            return pc+1
+        self.api.send(encode_stop())
+        self.result = 'timeout'
+        return -1
+
+    #call holding state.changed
+    def check(self,c,start):
+        kind = c[0]
+        if kind == COND_IDLE:
+            running = self.state.running
+            return not any(running[m] for m in c[1])
+        if kind == COND_TIME:
+            return time.monotonic()-start >= c[1]
+        if kind == COND_SYMBOL:
+            return (self.resolve(c[1]) == self.resolve(c[2])) == c[3]
+        if kind == COND_ERROR:
+            return self.state.error == c[1]
+        if kind == COND_COMMAND:
+            if c[1] in self.commands:
+                self.commands.remove(c[1])
+                return True
             return False
-        if type(self.program[0]) != dict:
-            print('first element must be an object')
-            self.program = None
+        return False
+
+    def op_goto(self,ins,pc):
+        return ins.args[0]
+
+    def op_prog(self,ins,pc):
+        if ins.args[0] is None: #loop
+            return 0
+        cache = getattr(self.api,'programs',None)
+        entry = cache.entry(ins.args[0]) if cache else None
+        if not entry or not entry.program:
+            raise ProgramError(ins.name+': program "'+ins.args[0]+'" unavailable')
+        #chained program starts with its own defaults on top of current symbols
+        self.program = entry.program
+        self.progname = entry.name
+        self.filename = entry.path
+        self.state.set_symbols(self.program.symbols,True)
+        self.code = self.select(self.program)
+        return 0
+
+    def op_mark(self,ins,pc):
+        self.marks[ins.args[0]] = time.monotonic()
+        return pc+1
+
+    def op_syms(self,ins,pc):
+        self.state.set_symbols(ins.args[0])
+        return pc+1
+
+
+# Program cache
+# Programs named in the catalog are read and compiled once, up front, so
+# starting one (or chaining to one) is just entry() - a dict lookup.
+# refresh() re-stats the catalog and its files, and recompiles only those
+# whose mtime/size changed and whose content hash differs from what was
+# compiled. Files that fail to load keep their error for reporting.
+ProgramEntry=collections.namedtuple('ProgramEntry','name path mtime size digest program error')
+
+class ProgramCache:
+    def __init__(self,directory=PROGRAM_DIR,catalog=PROGRAM_CATALOG,log=print):
+        self.directory = directory
+        self.catalog = catalog
+        self.log = log
+        self.entries = {} #name -> ProgramEntry
+        self.order = [] #names in catalog order
+        self.default = None
+        self.catalog_key = None
+        self.compiled = 0 #number of compiles done, for checking the cache works
+
+    #name - catalog name with or without ".json"
+    def entry(self,name):
+        if name.endswith('.json'):
+            name = name[:-5]
+        return self.entries.get(name)
+
+    def get(self,name):
+        e = self.entry(name)
+        return e.program if e else None
+
+    def names(self):
+        return [n for n in self.order if self.entries[n].program]
+
+    #[{"name","description","error"}] in catalog order
+    def listing(self):
+        out = []
+        for n in self.order:
+            e = self.entries[n]
+            out.append({'name':n,'description':e.program.description if e.program else '','error':e.error})
+        return out
+
+    def refresh(self):
+        files = self.read_catalog()
+        if files is None: #no catalog: everything in the directory
+            try:
+                files = sorted(f for f in os.listdir(self.directory) if f.endswith('.json') and not f.startswith('_'))
+            except OSError as e:
+                files = []
+        order = []
+        entries = {}
+        for f in files:
+            name = f[:-5] if f.endswith('.json') else f
+            entries[name] = self.check(name,os.path.join(self.directory,name+'.json'))
+            order.append(name)
+        self.entries = entries
+        self.order = order
+
+    #list of file names from the catalog, None if there isn't one
+    def read_catalog(self):
+        path = os.path.join(self.directory,self.catalog)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.catalog_key = None
+            return None
+        key = (st.st_mtime_ns,st.st_size)
+        if self.catalog_key and self.catalog_key[0] == key:
+            return self.catalog_key[1]
+        try:
+            with open(path,'rb') as fp:
+                cat = json.loads(fp.read())
+            files = [str(f) for f in cat['programs']]
+            self.default = cat.get('default')
+            if self.default and self.default.endswith('.json'):
+                self.default = self.default[:-5]
+        except Exception as e:
+            self.log('Programs: bad catalog: '+str(e))
+            files = None
+        self.catalog_key = (key,files)
+        return files
+
+    #entry for one file, compiling only if it changed
+    def check(self,name,path):
+        old = self.entries.get(name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            if not old or old.mtime is not None:
+                self.log('Programs: '+name+': file not found')
+            return ProgramEntry(name,path,None,None,None,None,'file not found')
+        if old and old.path == path and old.mtime == st.st_mtime_ns and old.size == st.st_size:
+            return old
+        try:
+            with open(path,'rb') as fp:
+                data = fp.read()
+        except OSError as e:
+            return ProgramEntry(name,path,None,None,None,None,str(e))
+        import hashlib
+        digest = hashlib.sha1(data).hexdigest()
+        if old and old.path == path and old.digest == digest: #touched, not changed
+            return old._replace(mtime=st.st_mtime_ns,size=st.st_size)
+        program = None
+        error = None
+        self.compiled += 1
+        try:
+            program = compile_program(json.loads(data),name)
+        except ValueError as e: #json and program errors
+            error = str(e)
+            self.log('Programs: '+name+': '+error)
+        else:
+            self.log('Programs: '+name+' compiled ('+str(len(program))+' instructions)')
+        return ProgramEntry(name,path,st.st_mtime_ns,st.st_size,digest,program,error)
+
+
+# Batch runs
+# A batch is `count` specimen cycles, each running the catalog programs in
+# `stages` in turn, the way a "p" command chains them: the compiled
+# catalog entry, its symbol defaults under whatever is already defined.
+# Before every stage the batch's symbols are set, plus SPECIMEN, TRAY and
+# SLOT (1-based, TRAY/SLOT from tray_size) and the specimen's own entry in
+# `specimens` if given, so one set of programs can walk a whole tray. A
+# name some specimens set and this one doesn't goes back to its batch
+# value (0 if none), so one specimen's values never leak into the next.
+# CommProcess.run_batch() drives it from the main loop: start the next
+# stage when nothing else is running, report its result when it ends.
+# A failed stage (error, timeout, rejected) pauses the batch
+# (on_error "pause", resume re-runs it) or gives up on that specimen
+# (on_error "skip"); a stopped one always pauses. After every tray_size
+# specimens the batch waits for tray_loaded().
+# Every stage result goes to an append-only journal (JSON lines, synced),
+# so after a crash recover() picks up at the first stage that didn't
+# finish - paused, unless the batch was started with autoresume - with
+# counts and stage timings intact.
+BATCH_IDLE='idle'
+BATCH_RUNNING='running'
+BATCH_PAUSED='paused'
+BATCH_TRAY='tray' #waiting for the operator to load the next tray
+BATCH_DONE='done'
+BATCH_CANCELLED='cancelled'
+BATCH_ON_ERROR=('pause','skip')
+BATCH_RATE_WINDOW=20 #specimens the recent throughput is taken over
+BATCH_FAILED_SHOWN=20 #failed specimen numbers listed in report()
+
+class BatchScheduler:
+    def __init__(self,journal=None,log=print):
+        self.journal = journal #path, None: progress isn't kept
+        self.log = log
+        self.fp = None
+        self.reset()
+
+    def reset(self):
+        self.name = None
+        self.spec = None #as given to start(), kept in the journal
+        self.stages = []
+        self.count = 0
+        self.tray_size = 0
+        self.state = BATCH_IDLE
+        self.reason = None #why it's paused
+        self.specimens = None #per-specimen {symbol:value}, optional
+        self.specimen_keys = () #every name in specimens
+        self.specimen = 0 #next (or running) specimen, 0-based
+        self.stage = 0 # " stage index
+        self.loaded = 0 #specimen the last tray_loaded() was for
+        self.current = None #(specimen, stage, start monotonic) while a stage runs
+        self.cycle_start = None #monotonic start of the current specimen's first stage
+        self.done = 0
+        self.failed = []
+        self.timings = [] #LatencyHistogram per stage
+        self.cycle = LatencyHistogram('cycle')
+        self.active = 0.0 #seconds spent running, up to active_since
+        self.active_since = None
+        self.finished = collections.deque(maxlen=BATCH_RATE_WINDOW) #monotonic completion times
+        self.version = 0 #bumped on every change, for state pushes
+
+    def active_batch(self):
+        return self.state in (BATCH_RUNNING,BATCH_PAUSED,BATCH_TRAY)
+
+    #spec - {"stages":[program names],"count":n,"tray_size":n,"symbols":{},"specimens":[{}],
+    #        "on_error":"pause"/"skip","autoresume":bool,"name":str}; ValueError if it's no good
+    def start(self,spec,now):
+        if self.active_batch():
+            raise ValueError('batch "'+str(self.name)+'" is '+self.state)
+        stages = spec.get('stages')
+        if type(stages) != list or not stages or not all(type(s) == str for s in stages):
+            raise ValueError('"stages" must be a list of program names')
+        specimens = spec.get('specimens')
+        if specimens is not None and (type(specimens) != list or not all(type(s) == dict for s in specimens)):
+            raise ValueError('"specimens" must be a list of {symbol:value}')
+        count = spec.get('count',len(specimens) if specimens else None)
+        if type(count) != int or count < 1:
+            raise ValueError('"count" must be a positive integer')
+        tray_size = spec.get('tray_size',0)
+        if type(tray_size) != int or tray_size < 0:
+            raise ValueError('"tray_size" must be a non-negative integer')
+        if type(spec.get('symbols',{})) != dict:
+            raise ValueError('"symbols" must be an object')
+        if spec.get('on_error','pause') not in BATCH_ON_ERROR:
+            raise ValueError('"on_error" must be one of '+', '.join(BATCH_ON_ERROR))
+        spec = dict(spec,name=str(spec.get('name') or time.strftime('%Y%m%d-%H%M%S')),count=count)
+        self.reset()
+        self.apply_spec(spec)
+        self.open_journal('w')
+        self.write({'event':'batch','spec':spec})
+        self.set_state(BATCH_RUNNING,None,now)
+
+    def apply_spec(self,spec):
+        self.spec = spec
+        self.name = spec['name']
+        self.stages = spec['stages']
+        self.specimens = spec.get('specimens')
+        self.count = spec.get('count',len(self.specimens) if self.specimens else 0)
+        self.tray_size = spec.get('tray_size',0)
+        self.specimen_keys = sorted(set(k for s in self.specimens or () for k in s))
+        self.timings = [LatencyHistogram(s) for s in self.stages]
+
+    #(program name, {symbol:value}) to run next, None if nothing should start now
+    def next_job(self):
+        if self.state != BATCH_RUNNING or self.current:
+            return None
+        i = self.specimen
+        base = self.spec.get('symbols') or {}
+        syms = dict((k,0) for k in self.specimen_keys)
+        syms.update(base)
+        syms['SPECIMEN'] = i+1
+        if self.tray_size:
+            syms['TRAY'] = i//self.tray_size+1
+            syms['SLOT'] = i%self.tray_size+1
+        if self.specimens and i < len(self.specimens):
+            syms.update(self.specimens[i])
+        return self.stages[self.stage], syms
+
+    def stage_started(self,now):
+        if self.stage == 0:
+            self.cycle_start = now
+        self.current = (self.specimen,self.stage,now)
+        self.version += 1
+
+    #result - ProgramThread.result ("done", "error", "timeout", "stopped", "rejected")
+    def stage_ended(self,result,now):
+        if not self.current:
+            return
+        i, j, start = self.current
+        self.current = None
+        seconds = now-start
+        self.record({'event':'stage','specimen':i,'stage':j,'program':self.stages[j],'result':result,'seconds':seconds},now)
+        if result == 'done':
+            if self.stage == 0 and self.cycle_start is not None: #specimen complete
+                self.cycle.record(now-self.cycle_start)
+                self.cycle_start = None
+        elif result == 'stopped':
+            self.pause(self.stages[j]+' stopped',now)
+        elif self.spec.get('on_error','pause') == 'skip':
+            self.record({'event':'specimen','specimen':i,'result':'failed','reason':self.stages[j]+' '+result},now)
+        else:
+            self.pause(self.stages[j]+' '+result+' (specimen '+str(i+1)+')',now)
+        self.check_progress(now)
+
+    #give up on the current specimen and go on with the next
+    def skip(self,now):
+        if self.current or not self.active_batch() or self.specimen >= self.count:
+            return False
+        self.record({'event':'specimen','specimen':self.specimen,'result':'skipped'},now)
+        self.cycle_start = None
+        self.check_progress(now)
+        return True
+
+    #journal and apply a progress record
+    def record(self,rec,now):
+        self.write(rec)
+        self.apply(rec,now)
+
+    #a journal record's effect on progress (also used by recover())
+    def apply(self,rec,now=None):
+        ev = rec.get('event')
+        if ev == 'stage' and rec.get('specimen') == self.specimen and rec.get('stage') == self.stage:
+            if rec.get('result') != 'done':
+                return
+            self.timings[self.stage].record(rec.get('seconds',0))
+            self.stage += 1
+            if self.stage == len(self.stages):
+                self.done += 1
+                if now is not None:
+                    self.finished.append(now)
+                self.specimen += 1
+                self.stage = 0
+        elif ev == 'specimen' and rec.get('specimen') == self.specimen:
+            self.failed.append(self.specimen)
+            self.specimen += 1
+            self.stage = 0
+        elif ev == 'tray':
+            self.loaded = rec.get('specimen',0)
+        self.version += 1
+
+    #after progress: finished, or at a tray boundary?
+    def check_progress(self,now):
+        if self.specimen >= self.count:
+            self.finish(BATCH_DONE,now)
+        elif self.at_tray_boundary() and self.state == BATCH_RUNNING:
+            self.set_state(BATCH_TRAY,'load tray '+str(self.specimen//self.tray_size+1),now)
+
+    def at_tray_boundary(self):
+        return bool(self.tray_size) and self.stage == 0 and self.specimen > 0 and \
+               self.specimen%self.tray_size == 0 and self.loaded != self.specimen
+
+    def tray_loaded(self,now):
+        if self.state != BATCH_TRAY:
+            return False
+        self.record({'event':'tray','specimen':self.specimen},now)
+        self.set_state(BATCH_RUNNING,None,now)
+        return True
+
+    def pause(self,reason,now):
+        if self.state == BATCH_RUNNING:
+            self.set_state(BATCH_PAUSED,reason,now)
+            return True
+        return False
+
+    def resume(self,now):
+        if self.state != BATCH_PAUSED:
+            return False
+        self.set_state(BATCH_TRAY if self.at_tray_boundary() else BATCH_RUNNING,None,now)
+        return True
+
+    def cancel(self,now):
+        if not self.active_batch():
+            return False
+        self.current = None
+        self.finish(BATCH_CANCELLED,now)
+        return True
+
+    def finish(self,state,now):
+        self.set_state(state,None,now)
+        self.write({'event':'end','state':state})
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+    def set_state(self,state,reason,now):
+        if self.state == BATCH_RUNNING and state != BATCH_RUNNING:
+            self.active += now-self.active_since
+            self.active_since = None
+        elif state == BATCH_RUNNING and self.state != BATCH_RUNNING:
+            self.active_since = now
+        self.state = state
+        self.reason = reason
+        self.version += 1
+        if state in (BATCH_PAUSED,BATCH_TRAY,BATCH_RUNNING):
+            self.write({'event':'state','state':state,'reason':reason})
+        self.log('Batch: '+str(self.name)+' '+state+(': '+reason if reason else ''))
+
+    def active_time(self,now):
+        return self.active+(now-self.active_since if self.active_since is not None else 0)
+
+    #specimens/hour of running time
+    def rate(self,now):
+        active = self.active_time(now)
+        return self.done/active*3600 if active > 0 else 0.0
+
+    def report(self,now):
+        active = self.active_time(now)
+        rate = self.rate(now)
+        f = self.finished
+        recent = (len(f)-1)/(f[-1]-f[0])*3600 if len(f) > 1 and f[-1] > f[0] else rate
+        left = self.count-self.specimen
+        stages = []
+        for name, h in zip(self.stages,self.timings):
+            p50, p90 = h.quantiles((0.5,0.9))
+            stages.append({'program':name,'count':h.count,'mean':h.total/h.count/1000000.0 if h.count else 0.0,
+                           'p50':p50,'p90':p90,'max':h.max/1000000.0})
+        return {'name':self.name,'state':self.state,'reason':self.reason,
+                'specimen':min(self.specimen+1,self.count),'stage':self.stages[self.stage] if self.specimen < self.count and self.stages else None,
+                'running':self.current is not None,'count':self.count,'done':self.done,'failed':len(self.failed),
+                'failed_specimens':[i+1 for i in self.failed[-BATCH_FAILED_SHOWN:]],
+                'active_seconds':active,'specimens_per_hour':rate,'recent_per_hour':recent,
+                'eta_seconds':left/recent*3600 if recent > 0 and self.active_batch() else None,
+                'cycle':{'mean':self.cycle.total/self.cycle.count/1000000.0 if self.cycle.count else 0.0,
+                         'p90':self.cycle.quantiles((0.9,))[0]},
+                'stages':stages}
+
+    # --- journal ---
+
+    def open_journal(self,mode):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+        if self.journal:
+            try:
+                self.fp = open(self.journal,mode)
+            except OSError as e:
+                self.log('Batch: journal '+self.journal+': '+str(e))
+
+    def write(self,rec):
+        if not self.fp:
+            return
+        rec['time'] = time.time()
+        try:
+            self.fp.write(json.dumps(rec)+'\n')
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+        except OSError as e:
+            self.log('Batch: journal write failed: '+str(e))
+
+    #pick up an unfinished batch from the journal, True if there was one
+    def recover(self,now):
+        if not self.journal:
             return False
-     #   for
+        try:
+            with open(self.journal) as fp:
+                lines = fp.readlines()
+        except OSError:
+            return False
+        recs = []
+        for line in lines:
+            try:
+                recs.append(json.loads(line))
+            except ValueError: #torn last line from a crash
+                continue
+        if not recs or recs[0].get('event') != 'batch' or recs[-1].get('event') == 'end':
+            return False
+        self.reset()
+        self.apply_spec(recs[0]['spec'])
+        for rec in recs[1:]:
+            self.apply(rec)
+            if rec.get('event') == 'stage':
+                self.active += rec.get('seconds',0)
+        self.open_journal('a')
+        if self.specimen >= self.count:
+            self.finish(BATCH_DONE,now)
+            return False
+        if self.spec.get('autoresume'):
+            self.set_state(BATCH_TRAY if self.at_tray_boundary() else BATCH_RUNNING,None,now)
+        else:
+            self.set_state(BATCH_PAUSED,'recovered after a restart',now)
+        return True
+
+
+# Serial port enumeration
+PortInfo=collections.namedtuple('PortInfo','device description hwid vid pid serial_number kl25z')
+
+#every serial port the OS lists, KL25Zs first (slow: hundreds of ms with many USB devices)
+def scan_serial_ports():
+    from serial.tools import list_ports
+    found = []
+    for p in list_ports.comports():
+        found.append(PortInfo(p.device,p.description,p.hwid,p.vid,p.pid,p.serial_number,
+                              (p.vid,p.pid) in KL25Z_USB_IDS))
+    found.sort(key=lambda p: (not p.kl25z,p.device))
+    return found
+
+# Cached, background serial port scans
+# get() answers from the last scan; once that is older than ttl it also
+# starts a rescan on a worker thread, so callers only ever block when
+# nothing has been scanned yet (or on refresh(wait=True)). start() keeps
+# rescanning every interval seconds and calls each watch() callback (on
+# the scanning thread) with the (added, removed) PortInfo lists whenever
+# devices come or go.
+class PortRegistry:
+    def __init__(self,ttl=PORT_CACHE_TTL,interval=PORT_SCAN_INTERVAL,scan=scan_serial_ports):
+        self.ttl = ttl
+        self.interval = interval
+        self.scan_ports = scan
+        self.ports = None #last scan, None until one succeeds
+        self.seen = set() #every device any scan has listed
+        self.scanned = 0 #when (monotonic)
+        self.scans = 0 #scans finished, successful or not
+        self.error = None #exception from the last scan
+        self.scanning = False
+        self.watchers = []
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        self.thread = None #poller, after start()
+        self.stopped = threading.Event()
+
+    def get(self,max_age=None):
+        with self.lock:
+            ports = self.ports
+            age = time.monotonic()-self.scanned
+        if ports is None:
+            return self.refresh(True) or []
+        if age > (self.ttl if max_age is None else max_age) and not self.thread:
+            self.refresh()
+        return ports
+
+    #start a scan (unless one is running); wait=True blocks until a scan finishes
+    def refresh(self,wait=False,timeout=None):
+        with self.lock:
+            seen = self.scans
+            if not self.scanning:
+                self.scanning = True
+                threading.Thread(target=self.scan,daemon=True).start()
+            if wait:
+                self.finished.wait_for(lambda: self.scans > seen,timeout)
+            return self.ports
+
+    def kl25z(self):
+        return [p for p in self.get() if p.kl25z]
+
+    #is device plugged in? None if no scan has ever listed it (not yet scanned,
+    #or a name the OS doesn't enumerate, ex. a symlink or virtual port)
+    def present(self,device):
+        with self.lock:
+            if self.ports is None or device not in self.seen:
+                return None
+            return any(p.device == device for p in self.ports)
+
+    def watch(self,callback):
+        with self.lock:
+            self.watchers.append(callback)
+
+    def unwatch(self,callback):
+        with self.lock:
+            if callback in self.watchers:
+                self.watchers.remove(callback)
+
+    #runs with scanning already claimed
+    def scan(self):
+        try:
+            found, error = self.scan_ports(), None
+        except Exception as e:
+            found, error = None, e
+        with self.lock:
+            old = self.ports
+            if found is not None:
+                self.ports = found
+                self.seen.update(p.device for p in found)
+                self.scanned = time.monotonic()
+            self.error = error
+            self.scanning = False
+            self.scans += 1
+            self.finished.notify_all()
+            watchers = list(self.watchers)
+        if old is None or found is None: #nothing to compare with
+            return
+        added = [p for p in found if p not in old]
+        removed = [p for p in old if p not in found]
+        if not (added or removed):
+            return
+        for callback in watchers:
+            try:
+                callback(added,removed)
+            except Exception: #a broken watcher mustn't stop hot-plug detection for the rest
+                pass
+
+    def start(self):
+        if not self.thread:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.poll,daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def poll(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                busy = self.scanning
+                self.scanning = True
+            if not busy:
+                self.scan()
+            self.stopped.wait(self.interval)
+
+_port_registry = None
+
+#the registry shared by everything in this process
+def port_registry():
+    global _port_registry
+    if _port_registry is None:
+        _port_registry = PortRegistry()
+    return _port_registry
+
+
+# Transports
+# CommProcess talks to the microcontroller through anything that behaves
+# like a pyserial port: read(n) (honouring .timeout), write(), in_waiting,
+# cancel_read() and close(). open_transport() picks one by port name:
+#   "sim"  - a SimulatedKL25Z in this process, over a LoopbackTransport pair
+#   "pty"  - a SimulatedKL25Z behind a pseudo-terminal, opened with pyserial
+#            exactly like the real port (posix only)
+#   "loop" - loopback, everything written is read back
+#   anything else is a real serial port (ex. "COM9", "/dev/ttyACM0")
+# A transport object (ex. a ReplayTransport) is used as it is.
+def open_transport(port,baud=SERIAL_BAUD_RATE,timeout=None):
+    if type(port) != str:
+        return port
+    if port == TRANSPORT_SIM:
+        a, b = LoopbackTransport.pair(timeout)
+        SimulatedKL25Z(b,baud).start()
+        return a
+    import serial
+    if port == TRANSPORT_PTY:
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+        try:
+            com = serial.Serial(os.ttyname(slave),baud,timeout=timeout)
+        finally:
+            os.close(slave) #pyserial has its own descriptor now
+        SimulatedKL25Z(FdTransport(master),baud).start()
+        return com
+    if port == TRANSPORT_LOOP:
+        a = LoopbackTransport(timeout)
+        a.peer = a
+        return a
+    return serial.Serial(port,baud,timeout=timeout)
+
+
+# In-process byte pipe; pair() makes two connected ends
+class LoopbackTransport:
+    def __init__(self,timeout=None):
+        self.timeout = timeout
+        self.peer = None
+        self.buf = bytearray()
+        self.cond = threading.Condition()
+        self.is_open = True
+        self.cancelled = False
+
+    @staticmethod
+    def pair(timeout=None):
+        a = LoopbackTransport(timeout)
+        b = LoopbackTransport(timeout)
+        a.peer = b
+        b.peer = a
+        return a, b
+
+    @property
+    def in_waiting(self):
+        return len(self.buf)
+
+    def read(self,size=1):
+        with self.cond:
+            if self.timeout is None:
+                while len(self.buf) < size and self.is_open and not self.cancelled:
+                    self.cond.wait()
+            elif len(self.buf) < size:
+                end = time.monotonic()+self.timeout
+                while len(self.buf) < size and self.is_open and not self.cancelled:
+                    wait = end-time.monotonic()
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+            self.cancelled = False
+            d = bytes(self.buf[0:size])
+            del self.buf[0:size]
+            return d
+
+    def write(self,d):
+        if not self.is_open:
+            raise OSError('transport closed')
+        with self.peer.cond:
+            self.peer.buf += d
+            self.peer.cond.notify_all()
+        return len(d)
+
+    def cancel_read(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    #closing either end closes both
+    def close(self):
+        for end in (self,self.peer):
+            with end.cond:
+                end.is_open = False
+                end.cond.notify_all()
+
+
+# pyserial-style wrapper for a raw file descriptor (the simulator's side of a pty)
+class FdTransport:
+    def __init__(self,fd,timeout=None):
+        self.fd = fd
+        self.timeout = timeout
+        self.is_open = True
+
+    @property
+    def in_waiting(self):
+        import fcntl, termios
+        return struct.unpack('I',fcntl.ioctl(self.fd,termios.FIONREAD,b'\0\0\0\0'))[0]
+
+    def read(self,size=1):
+        import select
+        out = b''
+        end = None if self.timeout is None else time.monotonic()+self.timeout
+        while len(out) < size and self.is_open:
+            wait = None if end is None else max(0,end-time.monotonic())
+            r, w, x = select.select([self.fd],[],[],wait)
+            if not r:
+                break
+            try:
+                d = os.read(self.fd,size-len(out))
+            except OSError: #other side went away
+                self.is_open = False
+                break
+            out += d
+        return out
+
+    def write(self,d):
+        return os.write(self.fd,d)
+
+    def cancel_read(self):
+        pass
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            os.close(self.fd)
+
+
+# Simulated microcontroller
+# Follows the 4-byte command handling in kl25z/src/main.c closely enough
+# to drive the relay, sequencer and API without the rig:
+#   C - calibrate (zero) a motor         M - relative move
+#   D - set a motor's step period        P - pump on/off
+#   L - indicator state or ring pixel    R - reset
+#   S - stop, reporting every motor that was running
+# Moves take steps/MOTOR_STEP_RATE seconds (times time_scale, 0 makes
+# everything instant), and finish with the firmware's arrival report
+# "A<n>00". With report_positions set, arrival reports carry the encoder
+# position instead: "A", motor, then signed-magnitude 16 bits (as
+# described in RFIS_notify.m). Invalid commands get "E010".
+# Replies are paced to the baud rate unless time_scale is 0.
+# Positions are the firmware's encoder counts: a move with the direction
+# bit set counts up. encode_move() sets that bit for negative steps, so
+# the relay's positions are the negated counts (position reports are
+# negated to match).
+# The firmware only takes a packet when exactly 4 bytes are waiting in
+# its Rx queue; with more, it never reads the queue again. After each
+# packet the board is busy for loop_time (times time_scale) while a
+# motor is moving, like the firmware's loop stepping it, so a packet
+# landing before the previous one was taken merges with it in the Rx
+# queue. Whenever more than 4 bytes are waiting, overruns is counted.
+# With strict_framing (the default) the board then stops taking
+# commands like the firmware does (wedged); otherwise it carries on in
+# 4-byte packets.
+class SimulatedKL25Z(threading.Thread):
+    def __init__(self,port,baud=SERIAL_BAUD_RATE,step_rates=MOTOR_STEP_RATE,time_scale=1.0,report_positions=False,strict_framing=True,
+                 loop_time=FIRMWARE_LOOP_TIME):
+        threading.Thread.__init__(self,daemon=True)
+        self.port = port
+        self.byte_time = 10/baud*time_scale
+        self.step_rates = step_rates
+        self.time_scale = time_scale
+        self.report_positions = report_positions
+        self.strict_framing = strict_framing
+        self.loop_time = loop_time*time_scale
+        self.wedged = False #more than 4 bytes were waiting, with strict_framing
+        self.lock = threading.Lock()
+        self.tx_ready = 0
+        #hardware state
+        self.start_pos = [0]*MOTOR_COUNT #position when the current move started
+        self.start_time = [0]*MOTOR_COUNT
+        self.steps = [0]*MOTOR_COUNT #signed steps of current move (0: idle)
+        self.delay = [0]*MOTOR_COUNT #step period ticks (stored, not simulated)
+        self.calibrated = [False]*MOTOR_COUNT
+        self.indicator = 'uncalibrated' #uncalibrated, calibrated, done
+        self.ring = [(0,0,0)]*16
+        self.pins = [False,False] #suction, blower
+        #counters
+        self.commands = 0
+        self.errors = 0
+        self.overruns = 0 #times more than 4 bytes were waiting
+
+    def run(self):
+        buf = bytearray() #the firmware's Rx queue
+        while self.port.is_open:
+            self.port.timeout = self.next_arrival()
+            d = self.port.read(max(1,self.port.in_waiting))
+            with self.lock:
+                if d:
+                    buf += d
+                    if len(buf) > 4:
+                        self.overruns += 1
+                        if self.strict_framing:
+                            self.wedged = True
+                    while len(buf) >= 4 and not self.wedged:
+                        self.handle(bytes(buf[0:4]))
+                        del buf[0:4]
+                self.arrive()
+                busy = self.loop_time if d and any(self.steps) else 0
+            if busy:
+                time.sleep(busy)
+
+    #seconds until the next motor finishes (None: nothing moving)
+    def next_arrival(self):
+        now = time.monotonic()
+        wait = None
+        with self.lock:
+            for ii in range(MOTOR_COUNT):
+                if self.steps[ii]:
+                    t = max(0,self.finish_time(ii)-now)
+                    wait = t if wait is None else min(wait,t)
+        return wait
+
+    def finish_time(self,ii):
+        return self.start_time[ii]+abs(self.steps[ii])/self.step_rates[ii]*self.time_scale
+
+    #current encoder position of motor ii
+    def position(self,ii):
+        if not self.steps[ii]:
+            return self.start_pos[ii]
+        if self.time_scale:
+            done = min(abs(self.steps[ii]),int((time.monotonic()-self.start_time[ii])*self.step_rates[ii]/self.time_scale))
+        else:
+            done = abs(self.steps[ii])
+        return self.start_pos[ii]+(done if self.steps[ii] > 0 else -done)
+
+    def positions(self):
+        with self.lock:
+            return [self.position(ii) for ii in range(MOTOR_COUNT)]
+
+    def send(self,p):
+        if self.byte_time:
+            now = time.monotonic()
+            self.tx_ready = max(self.tx_ready,now)+len(p)*self.byte_time
+            if self.tx_ready > now:
+                time.sleep(self.tx_ready-now)
+        try:
+            self.port.write(p)
+        except OSError:
+            pass
+
+    #stop motor ii where it is, reporting arrival if report is set
+    def halt(self,ii,report=True):
+        pos = self.position(ii)
+        was_running = self.steps[ii] != 0
+        self.start_pos[ii] = pos
+        self.steps[ii] = 0
+        if report and was_running:
+            if self.report_positions: #in the relay's sign convention
+                mag = min(abs(pos),0x7fff)
+                self.send(_PACKET_STEPS.pack(b'A',ord('1')+ii,mag|(0x8000 if pos > 0 else 0)))
+            else:
+                self.send(b'A'+bytes([ord('1')+ii])+b'00')
+
+    def arrive(self):
+        now = time.monotonic()
+        for ii in range(MOTOR_COUNT):
+            if self.steps[ii] and self.finish_time(ii) <= now:
+                self.halt(ii)
+
+    def error(self):
+        self.errors += 1
+        self.send(b'E010')
+
+    def handle(self,p):
+        self.commands += 1
+        c, a, b, d = p[0], p[1], p[2], p[3]
+        if c == ord('S'):
+            for ii in range(MOTOR_COUNT):
+                self.halt(ii)
+        elif c == ord('C'):
+            if 0 < a <= MOTOR_COUNT:
+                self.halt(a-1,False)
+                self.start_pos[a-1] = 0
+                self.calibrated[a-1] = True
+                if all(self.calibrated) and self.indicator == 'uncalibrated':
+                    self.indicator = 'calibrated'
+            else:
+                self.error()
+        elif c == ord('M'):
+            ii = a-ord('1')
+            if 0 <= ii < MOTOR_COUNT:
+                steps = ((b&0x7f)<<8)|d
+                self.halt(ii,False) #new instructions replace the current move
+                self.steps[ii] = steps if b&0x80 else -steps #direction bit set: forward, the encoder counts up
+                self.start_time[ii] = time.monotonic()
+            else:
+                self.error()
+        elif c == ord('P'):
+            if a: #blower, turning it on turns off suction
+                self.pins = [self.pins[0] and not b,bool(b)]
+            else:
+                self.pins = [bool(b),self.pins[1] and not b]
+        elif c == ord('L'):
+            if a>>2 == 0:
+                if a&3:
+                    self.indicator = 'done'
+                else:
+                    self.indicator = 'calibrated' if all(self.calibrated) else 'uncalibrated'
+            else:
+                self.ring[(a>>2)-1] = (((a&3)<<4)|(b>>4),((b&0xf)<<2)|(d>>6),d&0x3f)
+        elif c == ord('D'):
+            if 0 < a <= MOTOR_COUNT:
+                self.delay[a-1] = (b<<8)|d
+            else:
+                self.error()
+        elif c == ord('R'):
+            for ii in range(MOTOR_COUNT):
+                self.halt(ii,False)
+                self.start_pos[ii] = 0
+                self.calibrated[ii] = False
+            self.indicator = 'uncalibrated'
+            self.ring = [(0,0,0)]*16
+        else:
+            self.error()
+
+
+# Threaded serial relay between process and micro
+# The reader blocks on the port and splits what arrives into 4-byte
+# packets, stamping each with the monotonic time the read returned, and
+# appends (time, packet) pairs to `inbound` (a deque: appends and
+# popleft()s don't need a lock). The writer takes packets from
+# `outbound` (a PacketQueue) one at a time, paced to what the line can
+# carry: a token bucket refilled at baud/10 bytes per second and holding
+# at most SERIAL_TX_BURST bytes. Packets stay queued until they can
+# actually go out, so a stop still overtakes any backlog.
+# The firmware's main loop only takes a packet when Rx_Chars_Available()
+# is exactly 4: a packet landing before it has taken the previous one
+# leaves it waiting on a queue that never matches again. The line rate
+# alone doesn't prevent that (the loop can be busy stepping a motor for
+# FIRMWARE_LOOP_TIME), so packets are also spaced at least gap seconds
+# apart (SERIAL_TX_GAP; 0 for anything that isn't the firmware).
+# wake() is called whenever there's something for the owner to look at:
+# new packets, the outbound queue draining below half after drain_wanted
+# was set, or a failure (failed is then set; stop() and re-open).
+class SerialThread:
+    def __init__(self,port,inbound,outbound,wake,log=None,baud=SERIAL_BAUD_RATE,gap=SERIAL_TX_GAP):
+        self.port = port
+        self.inbound = inbound
+        self.outbound = outbound
+        self.wake = wake
+        self.log = log
+        self.byte_time = 10/baud #start + 8 data + stop bits
+        self.gap = gap
+        self.cond = threading.Condition() #writer waits here for packets
+        self.done = False
+        self.failed = None #exception that ended a thread
+        self.unsent = None #packet the writer had taken when the port failed
+        self.latency = None #LatencyHistogram for queued -> written, if wanted
+        self.drain_wanted = False #owner wants a wake() when outbound is half empty
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.reader = threading.Thread(target=self.read_loop,daemon=True)
+        self.writer = threading.Thread(target=self.write_loop,daemon=True)
+
+    def start(self):
+        self.reader.start()
+        self.writer.start()
+
+    def stop(self):
+        self.done = True
+        with self.cond:
+            self.cond.notify()
+        try:
+            self.port.cancel_read()
+        except (AttributeError,OSError):
+            pass
+        for t in (self.reader,self.writer):
+            if t.is_alive() and t is not threading.current_thread():
+                t.join(2*SERIAL_READ_TIMEOUT)
+
+    #outbound has something new
+    def kick(self):
+        with self.cond:
+            self.cond.notify()
+
+    def fail(self,e):
+        if not self.done:
+            self.failed = e
+            self.done = True
+            with self.cond:
+                self.cond.notify()
+            self.wake()
+
+    def read_loop(self):
+        buf = bytearray()
+        while not self.done:
+            try: #returns on SERIAL_READ_TIMEOUT with whatever arrived, so stop() is noticed
+                d = self.port.read(max(self.port.in_waiting,4-len(buf)))
+            except Exception as e: #pyserial raises SerialException when the device goes away
+                self.fail(e)
+                return
+            if not d:
+                continue
+            t = time.monotonic()
+            self.bytes_in += len(d)
+            buf += d
+            n = len(buf)-len(buf)%4
+            for ii in range(0,n,4):
+                p = bytes(buf[ii:ii+4])
+                self.inbound.append((t,p))
+                if self.log:
+                    self.log.trace('mc',TRACE_MC_IN,p,t)
+            del buf[0:n]
+            if n:
+                self.wake()
+
+    def write_loop(self):
+        burst = SERIAL_TX_BURST*self.byte_time
+        ready = time.monotonic() #when the bucket has room for another packet
+        while not self.done:
+            with self.cond:
+                while not len(self.outbound) and not self.done:
+                    self.cond.wait()
+            now = time.monotonic()
+            if ready > now:
+                time.sleep(ready-now)
+            #pick the packet only now, after pacing, so a stop queued meanwhile goes first
+            p = self.outbound.get()
+            if p is None or self.done:
+                continue
+            try:
+                self.port.write(p)
+            except Exception as e:
+                self.unsent = p
+                self.fail(e)
+                return
+            self.bytes_out += len(p)
+            if self.latency:
+                self.latency.record(time.monotonic()-self.outbound.taken)
+            if self.log:
+                self.log.trace('mc',TRACE_MC_OUT,p)
+            now = time.monotonic()
+            ready = max(max(ready,now-burst)+len(p)*self.byte_time,now+self.gap)
+            if self.drain_wanted and len(self.outbound.normal) <= self.outbound.maxlen//2:
+                self.drain_wanted = False
+                self.wake()
+
+
+# Append-only file that rolls over to name.1, name.2, ... once it
+# passes max_bytes or has been open for max_age seconds
+class RotatingFile:
+    def __init__(self,name,max_bytes=LOG_MAX_BYTES,max_age=LOG_MAX_AGE,backups=LOG_BACKUPS,header=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.header = header #written at the top of every new binary file
+        self.fp = None
+        self.size = 0
+        self.opened = 0
+        self.open()
+
+    def open(self):
+        self.fp = open(self.name,'ab' if self.header is not None else 'at')
+        self.size = self.fp.tell()
+        self.opened = time.time()
+        if self.header is not None and not self.size:
+            self.fp.write(self.header)
+            self.size = len(self.header)
+
+    def rotate(self):
+        self.fp.close()
+        for ii in range(self.backups-1,0,-1):
+            if os.path.exists(self.name+'.'+str(ii)):
+                os.replace(self.name+'.'+str(ii),self.name+'.'+str(ii+1))
+        if self.backups:
+            os.replace(self.name,self.name+'.1')
+        else:
+            os.remove(self.name)
+        self.open()
+
+    def write(self,data):
+        if self.size >= self.max_bytes or (self.max_age and time.time()-self.opened >= self.max_age):
+            self.rotate()
+        self.fp.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+
+# Write-behind log for CommProcess
+# Callers only check the channel's level and drop a record on a queue;
+# this thread does the formatting, the console echo and the disk writes,
+# flushing whenever it catches up. Records can carry raw packets instead
+# of text (see trace()), in which case the hex dump is only ever built if
+# the channel is logging at LOG_DEBUG, and the record also goes to the
+# binary trace (capture) file when one is enabled.
+# Binary trace format: TRACE_MAGIC, then per record a TRACE_HEADER
+# (monotonic seconds, TRACE_* kind, payload size) and the payload: the
+# 4-byte packet for TRACE_PACKETS kinds, UTF-8 JSON for the rest. Files
+# are append-only and read back with TraceReader.
+class LogWriter(threading.Thread):
+    def __init__(self,name=RFIS_PROCESS_LOG,levels=None,echo=True,trace=None):
+        threading.Thread.__init__(self,daemon=True)
+        self.levels = dict(LOG_LEVELS_DEFAULT)
+        self.levels.update(levels or {})
+        self.echo = echo #copy text records to stdout
+        import datetime
+        self.fromtimestamp = datetime.datetime.fromtimestamp
+        self.records = queue.SimpleQueue()
+        self.file = RotatingFile(name)
+        self.trace_file = RotatingFile(trace,header=TRACE_MAGIC) if trace else None
+        self.start()
+
+    def enabled(self,channel,level):
+        return level >= self.levels.get(channel,LOG_INFO)
+
+    def log(self,channel,level,msg,end="\n"):
+        if level >= self.levels.get(channel,LOG_INFO):
+            self.records.put((time.time(),channel,msg+end))
+
+    #direction - TRACE_* kind, p - packet (or JSON bytes), t - monotonic time it was seen (default: now)
+    def trace(self,channel,direction,p,t=None):
+        if self.trace_file or (direction in TRACE_PACKETS and level_debug(self.levels.get(channel,LOG_INFO))):
+            self.records.put((time.time(),channel,(direction,p,t or time.monotonic())))
+
+    def close(self):
+        self.records.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            r = self.records.get()
+            while r is not None:
+                self.write(r)
+                try:
+                    r = self.records.get_nowait()
+                except queue.Empty:
+                    break
+            self.file.flush()
+            if self.trace_file:
+                self.trace_file.flush()
+            if r is None: #closing
+                self.file.close()
+                if self.trace_file:
+                    self.trace_file.close()
+                return
+
+    def write(self,r):
+        t, channel, msg = r
+        if type(msg) == tuple: #raw packet
+            direction, p, tm = msg
+            if self.trace_file:
+                self.trace_file.write(TRACE_HEADER.pack(tm,direction,len(p))+p)
+            if direction not in TRACE_PACKETS or not level_debug(self.levels.get(channel,LOG_INFO)):
+                return
+            msg = TRACE_LABELS[direction]+' '.join("{:02X}".format(c) for c in p)+'\n'
+        if self.echo:
+            print(msg,end="")
+        self.file.write(self.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]+' ['+channel+'] '+msg)
+
+def level_debug(level):
+    return level <= LOG_DEBUG
+
+#"mc=debug,ui=info" -> {'mc':LOG_DEBUG,'ui':LOG_INFO}
+def parse_log_levels(spec):
+    names = {'debug':LOG_DEBUG,'info':LOG_INFO,'warn':LOG_WARN,'error':LOG_ERROR,'off':LOG_OFF}
+    levels = {}
+    for item in spec.split(','):
+        if '=' in item:
+            channel, name = item.split('=',1)
+            levels[channel.strip()] = names[name.strip().lower()]
+    return levels
+
+
+# Capture reader
+# Maps a trace file (see LogWriter) read-only and walks it in place:
+# records() yields TraceRecords without reading the file through Python
+# file objects. A record cut short (the relay died mid-write) ends the
+# walk and is counted in truncated. Reads both TRACE_MAGIC and the older
+# serial-only TRACE_MAGIC_V1 files.
+TraceRecord=collections.namedtuple('TraceRecord','t kind payload')
+
+class TraceReader:
+    def __init__(self,name):
+        import mmap
+        self.name = name
+        self.fp = open(name,'rb')
+        size = os.fstat(self.fp.fileno()).st_size
+        self.map = mmap.mmap(self.fp.fileno(),0,access=mmap.ACCESS_READ) if size else b''
+        magic = bytes(self.map[0:len(TRACE_MAGIC)])
+        if magic == TRACE_MAGIC:
+            self.version = 2
+        elif magic == TRACE_MAGIC_V1:
+            self.version = 1
+        else:
+            self.close()
+            raise ValueError(name+' is not an RFIS trace')
+        self.truncated = 0
+
+    def close(self):
+        if type(self.map) != bytes:
+            self.map.close()
+        self.map = b''
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    #kinds - TRACE_* kinds to keep (None: all)
+    def records(self,kinds=None):
+        m = self.map
+        end = len(m)
+        off = len(TRACE_MAGIC)
+        if self.version == 1:
+            size = TRACE_RECORD_V1.size
+            unpack = TRACE_RECORD_V1.unpack_from
+            while off+size <= end:
+                t, kind, p = unpack(m,off)
+                off += size
+                if kinds is None or kind in kinds:
+                    yield TraceRecord(t,kind,p)
+        else:
+            size = TRACE_HEADER.size
+            unpack = TRACE_HEADER.unpack_from
+            while off+size <= end:
+                t, kind, n = unpack(m,off)
+                if off+size+n > end:
+                    break
+                if kinds is None or kind in kinds:
+                    yield TraceRecord(t,kind,m[off+size:off+size+n])
+                off += size+n
+        if off != end:
+            self.truncated += 1
+
+    #one line per record, times relative to the first
+    def dump(self,out=None):
+        t0 = None
+        for r in self.records():
+            t0 = r.t if t0 is None else t0
+            if r.kind in TRACE_PACKETS:
+                text = ' '.join("{:02X}".format(c) for c in r.payload)
+            elif r.kind == TRACE_UI_MSG and is_binary_message(r.payload):
+                try:
+                    text = 'msgpack '+json.dumps(decode_message(r.payload),default=repr)
+                except ValueError as e:
+                    text = 'msgpack ('+str(e)+')'
+            else:
+                text = r.payload.decode('utf-8','replace')
+            print('%12.6f %s %s' % (r.t-t0,TRACE_LABELS.get(r.kind,'?%02X' % r.kind),text),file=out)
+
+
+# Microcontroller stand-in that answers from a capture
+# Hands the relay the captured MC->process packets in order, each once
+# the relay has written as many packets as had gone out before it in the
+# capture, plus the captured delay since the last of those (divided by
+# speed; 0 is as fast as possible). So an arrival report still follows
+# the move that caused it, however fast the replay runs. What the relay
+# writes is compared with the captured packets (mismatches, first_mismatch).
+class ReplayTransport:
+    def __init__(self,records,speed=1.0,timeout=None):
+        self.timeout = timeout
+        self.speed = speed
+        self.expected = [] #captured MC_OUT packets
+        self.replies = [] #(MC_OUT count before it, delay after the last of them, packet)
+        last_out = None
+        for r in records:
+            if r.kind == TRACE_MC_OUT:
+                self.expected.append(bytes(r.payload))
+                last_out = r.t
+            elif r.kind == TRACE_MC_IN:
+                delay = r.t-last_out if last_out is not None else 0
+                self.replies.append((len(self.expected),delay,bytes(r.payload)))
+        self.written = 0 #packets written by the relay
+        self.written_at = [time.monotonic()] #when the n-th packet was written (index 0: start)
+        self.delivered = 0 #replies read by the relay
+        self.mismatches = 0
+        self.first_mismatch = None #(index, expected, got) in hex
+        self.wbuf = bytearray()
+        self.cond = threading.Condition()
+        self.is_open = True
+        self.cancelled = False
+
+    def done(self):
+        return self.delivered == len(self.replies)
+
+    #seconds until the next reply is due (None: it's waiting for writes, or there are none left)
+    def due(self):
+        if self.delivered == len(self.replies):
+            return None
+        after, delay, p = self.replies[self.delivered]
+        if self.written < after:
+            return None
+        return max(0,self.written_at[after]+(delay/self.speed if self.speed else 0)-time.monotonic())
+
+    @property
+    def in_waiting(self):
+        with self.cond:
+            return 4 if self.due() == 0 else 0
+
+    def read(self,size=1):
+        end = None if self.timeout is None else time.monotonic()+self.timeout
+        out = bytearray()
+        with self.cond:
+            while len(out) < size and self.is_open and not self.cancelled:
+                wait = self.due()
+                if wait == 0:
+                    out += self.replies[self.delivered][2]
+                    self.delivered += 1
+                    continue
+                if out: #hand over what's due now, like a serial port would
+                    break
+                if end is not None:
+                    left = end-time.monotonic()
+                    if left <= 0:
+                        break
+                    wait = left if wait is None else min(wait,left)
+                self.cond.wait(wait)
+            self.cancelled = False
+            self.cond.notify_all()
+        return bytes(out)
+
+    def write(self,d):
+        if not self.is_open:
+            raise OSError('transport closed')
+        with self.cond:
+            self.wbuf += d
+            now = time.monotonic()
+            while len(self.wbuf) >= 4:
+                p = bytes(self.wbuf[0:4])
+                del self.wbuf[0:4]
+                if self.written >= len(self.expected) or self.expected[self.written] != p:
+                    self.mismatches += 1
+                    if self.first_mismatch is None:
+                        expected = self.expected[self.written] if self.written < len(self.expected) else None
+                        self.first_mismatch = (self.written,expected.hex() if expected else None,p.hex())
+                self.written += 1
+                self.written_at.append(now)
+            self.cond.notify_all()
+        return len(d)
+
+    def cancel_read(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.is_open = False
+            self.cond.notify_all()
+
+
+# Replays a capture through a CommProcess in this process
+# The relay talks to a ReplayTransport; the captured API traffic (serial
+# packets and JSON messages, so also sequencer runs) is sent over a real
+# API connection. Each API record waits for the microcontroller replies
+# captured before it to have been delivered, then for its captured delay
+# after the last of them (/speed). Shutdown packets in the capture are
+# skipped; the replay ends once everything has been delivered and the
+# relay has gone quiet for idle seconds (or after timeout).
+# run() returns a summary dict.
+class TraceReplayer:
+    def __init__(self,records,speed=1.0,socket_port=SOCKET_PORT_DEFAULT+1,idle=0.5,timeout=None):
+        self.records = list(records)
+        self.speed = speed
+        self.socket_port = socket_port
+        self.idle = idle
+        self.timeout = timeout
+        self.transport = ReplayTransport(self.records,speed,SERIAL_READ_TIMEOUT)
+        self.ui = [] #(MC_IN count before it, delay after the last of them, frame)
+        replies = 0
+        last_in = self.records[0].t if self.records else 0
+        for r in self.records:
+            if r.kind == TRACE_MC_IN:
+                replies += 1
+                last_in = r.t
+            elif r.kind in (TRACE_UI_IN,TRACE_UI_MSG):
+                if r.kind == TRACE_UI_IN and r.payload[0:1] == b'X':
+                    continue
+                self.ui.append((replies,r.t-last_in,frame(bytes(r.payload))))
+
+    def run(self):
+        tr = self.transport
+        cp = CommProcess(tr,self.socket_port,log_levels={'proc':LOG_WARN,'seq':LOG_WARN,'ui':LOG_WARN},
+                         notify_sink=LocalSink(),resync_policy=RESYNC_REPLAY,tx_gap=0)
+        relay = threading.Thread(target=cp.run,daemon=True)
+        t0 = time.monotonic()
+        relay.start()
+        sock = None
+        while sock is None and relay.is_alive() and time.monotonic()-t0 < CONNECT_TIMEOUT:
+            try:
+                sock = socket.create_connection(('localhost',self.socket_port),timeout=HELLO_TIMEOUT)
+            except OSError:
+                time.sleep(CONNECT_BACKOFF_MIN)
+        if sock is None:
+            cp.done = True
+            return {'error':'relay did not start'}
+        listener = StateListener(sock) #keeps the relay's replies from backing up
+        listener.start()
+        end = None if self.timeout is None else t0+self.timeout
+        sent = 0
+        for replies, delay, data in self.ui:
+            with tr.cond:
+                while tr.delivered < replies and (end is None or time.monotonic() < end):
+                    tr.cond.wait(0.1)
+            if self.speed and delay > 0:
+                time.sleep(delay/self.speed)
+            sock.sendall(data)
+            sent += 1
+        #let the relay finish what the capture says it should
+        quiet = time.monotonic()
+        seen = -1
+        while end is None or time.monotonic() < end:
+            if tr.written != seen:
+                seen = tr.written
+                quiet = time.monotonic()
+            if tr.done() and tr.written >= len(tr.expected) or time.monotonic()-quiet > self.idle and tr.due() is None:
+                break
+            time.sleep(0.01)
+        elapsed = time.monotonic()-t0
+        cp.done = True
+        cp.wake()
+        relay.join(CONNECT_TIMEOUT)
+        listener.stop()
+        sock.close()
+        span = self.records[-1].t-self.records[0].t if self.records else 0
+        return {'elapsed':elapsed,'captured':span,'ui_sent':sent,'ui_total':len(self.ui),
+                'mc_written':tr.written,'mc_expected':len(tr.expected),
+                'mc_delivered':tr.delivered,'mc_replies':len(tr.replies),
+                'mismatches':tr.mismatches,'first_mismatch':tr.first_mismatch}
+
+
+# Notification sinks for NotifyDispatcher: called as sink(src,msg), where
+# src is one of the MSG_TYPE_* values and msg is a JSON array of events
+# Without an engine, MatlabSink connects to the shared session `name` on
+# first use (from the dispatcher thread, so the relay is serving clients
+# while MATLAB answers), retrying every RETRY_INTERVAL seconds.
+class MatlabSink:
+    def __init__(self,engine=None,name=MATLAB_NAME):
+        self.engine = engine
+        self.name = name
+        self.next_try = 0
+
+    def connect(self):
+        if time.monotonic() < self.next_try:
+            raise RuntimeError('MATLAB not connected')
+        self.next_try = time.monotonic()+RETRY_INTERVAL
+        import matlab.engine #was getting an error when this was a global import (b/c nesting in matlab via api?)
+        #^seems to work ok here as this is only called in separate process
+        self.engine = matlab.engine.connect_matlab(self.name)
+
+    def __call__(self,src,msg):
+        if self.engine is None:
+            self.connect()
+        self.engine.RFIS_notify(src,msg,nargout=0)
+
+    def close(self):
+        if self.engine:
+            try:
+                self.engine.exit()
+            except Exception:
+                pass
+            self.engine = None
+
+
+# Stand-in for MATLAB: keeps the most recent calls (and optionally prints them)
+class LocalSink:
+    def __init__(self,keep=1000,echo=False):
+        self.calls = collections.deque(maxlen=keep)
+        self.echo = echo
+
+    def __call__(self,src,msg):
+        self.calls.append((src,msg))
+        if self.echo:
+            print('notify '+str(src)+': '+msg)
+
+
+# Batched, rate-limited notifications to MATLAB
+# Engine calls take milliseconds, so the relay only ever post()s events
+# here and this thread makes the calls. Events pile up for at most
+# max_latency seconds (or until max_batch of them are waiting), calls are
+# spaced at least 1/max_rate seconds apart, and each call carries every
+# event waiting for that source as a single JSON array. Past max_pending
+# waiting events the oldest are dropped, so a stalled MATLAB can't grow
+# the process without bound.
+class NotifyDispatcher(threading.Thread):
+    def __init__(self,sink,max_rate=NOTIFY_MAX_RATE,max_latency=NOTIFY_MAX_LATENCY,max_batch=NOTIFY_MAX_BATCH,max_pending=NOTIFY_MAX_PENDING):
+        threading.Thread.__init__(self,daemon=True)
+        self.sink = sink
+        self.interval = 1/max_rate
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.pending = collections.deque(maxlen=max_pending)
+        self.first = 0 #when the oldest pending event arrived
+        self.cond = threading.Condition()
+        self.closing = False
+        #counters
+        self.events = 0
+        self.calls = 0
+        self.dropped = 0
+        self.errors = 0
+        self.call_time = None #LatencyHistograms (set by the owner): sink call...
+        self.latency = None #...and oldest event posted -> delivered
+        self.start()
+
+    #src - MSG_TYPE_*, event - anything json.dumps() takes
+    def post(self,src,event):
+        with self.cond:
+            if not self.pending:
+                self.first = time.monotonic()
+                self.cond.notify()
+            elif len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append((src,event))
+            self.events += 1
+            if len(self.pending) == self.max_batch:
+                self.cond.notify()
+
+    #deliver whatever is pending and stop
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.join()
+
+    def run(self):
+        last = -self.interval
+        while True:
+            with self.cond:
+                while not self.pending and not self.closing:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                #let the batch fill, then respect the rate limit
+                deadline = max(self.first+self.max_latency,last+self.interval)
+                while not self.closing and len(self.pending) < self.max_batch:
+                    wait = deadline-time.monotonic()
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+                if len(self.pending) >= self.max_batch and not self.closing: #full batches still wait for the rate limit
+                    wait = last+self.interval-time.monotonic()
+                    if wait > 0:
+                        self.cond.wait(wait)
+                batch = self.pending.copy()
+                self.pending.clear()
+                first = self.first
+            last = time.monotonic()
+            self.deliver(batch)
+            if self.latency:
+                self.latency.record(time.monotonic()-first)
+
+    def deliver(self,batch):
+        bysrc = {}
+        for src, event in batch:
+            bysrc.setdefault(src,[]).append(event)
+        for src, events in bysrc.items():
+            t = time.monotonic()
+            try:
+                self.sink(src,json.dumps(events))
+                self.calls += 1
+            except Exception as e:
+                self.errors += 1
+            if self.call_time:
+                self.call_time.record(time.monotonic()-t)
+
+    def stats(self):
+        return {'events':self.events,'calls':self.calls,'dropped':self.dropped,'errors':self.errors,'pending':len(self.pending)}
+
+
+# Bounded outbound packet queue with a priority lane
+# Packets whose command byte is in `priority` (stop and reset by default)
+# go in their own lane and always leave before anything in the normal
+# lane, so a stop never waits behind a backlog of moves. The normal lane
+# holds at most maxlen packets: put() refuses anything past that and
+# counts it as a drop, which is the caller's cue to push back on whoever
+# is producing. The priority lane is bounded too, but sheds its oldest
+# entry instead (the newest stop is the one that matters). requeue()
+# keeps both bounds as well, shedding whatever that same rule says goes.
+class PacketQueue:
+    def __init__(self,maxlen,priority=b'SR'):
+        self.maxlen = maxlen
+        self.priority = frozenset(priority)
+        self.lock = threading.Lock() #put() is on the relay thread, get() on the serial writer
+        self.normal = collections.deque() #(packet, monotonic time it was put)
+        self.urgent = collections.deque(maxlen=maxlen)
+        self.taken = None #put time of the packet get() last returned
+        self.queued = 0  #packets accepted
+        self.dropped = 0 #packets refused or shed
+        self.peak = 0    #deepest the queue has been
+
+    def __len__(self):
+        return len(self.normal)+len(self.urgent)
+
+    def full(self):
+        return len(self.normal) >= self.maxlen
+
+    #t - when the packet was accepted (default: now), for latency
+    #returns False if the packet was dropped
+    def put(self,p,t=None):
+        if t is None:
+            t = time.monotonic()
+        with self.lock:
+            if p[0] in self.priority:
+                if len(self.urgent) == self.maxlen:
+                    self.dropped += 1
+                self.urgent.append((p,t))
+            elif len(self.normal) >= self.maxlen:
+                self.dropped += 1
+                return False
+            else:
+                self.normal.append((p,t))
+            self.queued += 1
+            n = len(self.normal)+len(self.urgent)
+            if n > self.peak:
+                self.peak = n
+        return True
+
+    #next packet to send, or None
+    def get(self):
+        with self.lock:
+            lane = self.urgent or self.normal
+            if not lane:
+                return None
+            p, self.taken = lane.popleft()
+            return p
+
+    def clear(self):
+        with self.lock:
+            self.normal.clear()
+            self.urgent.clear()
+
+    #packets in the normal lane, oldest first
+    def pending(self):
+        with self.lock:
+            return [p for p, t in self.normal]
+
+    #put a packet that couldn't be sent back at the head of its lane
+    #if the lane filled up meanwhile, its newest packet makes room (p itself
+    #for a full priority lane, being the oldest stop); returns what was shed, or None
+    def requeue(self,p,t=None):
+        t = self.taken if t is None else t
+        with self.lock:
+            lane = self.urgent if p[0] in self.priority else self.normal
+            shed = None
+            if len(lane) >= self.maxlen:
+                self.dropped += 1
+                if lane is self.urgent:
+                    return p
+                shed = lane.pop()[0]
+            lane.appendleft((p,t))
+            return shed
+
+    #take out every packet whose command is in commands, returns them in order
+    def remove(self,commands):
+        out = []
+        with self.lock:
+            for lane in (self.urgent,self.normal):
+                keep = [e for e in lane if e[0][0] not in commands]
+                out += [e[0] for e in lane if e[0][0] in commands]
+                lane.clear()
+                lane.extend(keep)
+        return out
+
+    def stats(self):
+        return {'depth':len(self),'urgent':len(self.urgent),'queued':self.queued,'dropped':self.dropped,'peak':self.peak,'max':self.maxlen}
+
+
+# Decoder for the length-prefixed API socket stream
+# Every message is a 4-byte big-endian size followed by that many bytes.
+# Received bytes land straight in a preallocated buffer (see recv_into()),
+# and frames() hands back each complete message as a memoryview slice of
+# that buffer - nothing is copied on the way through. Leftover partial
+# frames are moved back to the front of the buffer only when it runs out
+# of room, and the buffer is replaced by a bigger one if a single frame
+# doesn't fit.
+# Views are only valid until the next recv_into()/feed() call: use
+# bytes(view) to keep one around.
+class FrameDecoder:
+    def __init__(self,size=FRAME_BUFFER_SIZE,max_frame=FRAME_MAX_SIZE):
+        self.max_frame = max_frame
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.rpos = 0 #start of unparsed data
+        self.wpos = 0 #end of received data
+
+    def __len__(self): #bytes received but not yet handed out as frames
+        return self.wpos-self.rpos
+
+    def reset(self):
+        self.rpos = 0
+        self.wpos = 0
+
+    #make room for at least n more bytes, returns the free space
+    def writable(self,n=1):
+        if len(self.buf)-self.wpos >= n:
+            return self.view[self.wpos:]
+        pending = self.wpos-self.rpos
+        if pending+n > len(self.buf): #won't fit even after compacting, grow
+            size = len(self.buf)
+            while size < pending+n:
+                size *= 2
+            buf = bytearray(size)
+            buf[0:pending] = self.view[self.rpos:self.wpos]
+            self.buf = buf #outstanding views keep the old buffer alive
+            self.view = memoryview(buf)
+        elif pending:
+            self.view[0:pending] = self.view[self.rpos:self.wpos]
+        self.rpos = 0
+        self.wpos = pending
+        return self.view[self.wpos:]
+
+    #receive directly into the buffer, returns the byte count (0: peer closed)
+    def recv_into(self,sock,n=FRAME_RECV_SIZE):
+        #ask for room for the rest of a partially received frame, so big
+        #frames (programs) grow the buffer once instead of every read
+        pending = self.wpos-self.rpos
+        if pending >= 4:
+            size = min(_FRAME_HEADER.unpack_from(self.buf,self.rpos)[0],self.max_frame)
+            n = max(n,size+4-pending)
+        count = sock.recv_into(self.writable(n))
+        self.wpos += count
+        return count
+
+    #for data that didn't come from a socket
+    def feed(self,data):
+        n = len(data)
+        self.writable(n)[0:n] = data
+        self.wpos += n
+
+    #yields every complete frame currently buffered
+    def frames(self):
+        while self.wpos-self.rpos >= 4:
+            size = _FRAME_HEADER.unpack_from(self.buf,self.rpos)[0]
+            if size > self.max_frame:
+                raise ValueError('frame size '+str(size)+' exceeds limit of '+str(self.max_frame))
+            start = self.rpos+4
+            end = start+size
+            if end > self.wpos: #wait for the rest
+                return
+            self.rpos = end
+            if self.rpos == self.wpos: #drained - cheap time to rewind
+                self.rpos = 0
+                self.wpos = 0
+            yield self.view[start:end]
+
+
+# Relay instrumentation
+# Counters and latency histograms cheap enough for the hot paths: an
+# observation is a bucket index and a few increments, no locks, so each
+# histogram or counter must only ever be updated from one thread. Readers
+# (snapshot(), render()) may miss an observation in flight, nothing worse.
+# Histograms are HDR-style: exact below 2**HIST_SUB_BITS microseconds,
+# then 2**HIST_SUB_BITS/2 buckets per power of two, each 1/16 of its lower
+# edge wide. A quantile reports its bucket's upper edge (capped at the max
+# seen), so it's never low and at most 6.25% high whatever the range.
+class LatencyHistogram:
+    def __init__(self,name,help=''):
+        self.name = name
+        self.help = help
+        self.sub = 1<<HIST_SUB_BITS
+        self.counts = array.array('q',bytes(8*(self.bucket((1<<HIST_MAX_BITS)-1)+1)))
+        self.count = 0
+        self.total = 0 #microseconds
+        self.max = 0
+
+    #bucket index for a value in microseconds
+    def bucket(self,us):
+        if us < self.sub:
+            return us
+        shift = us.bit_length()-HIST_SUB_BITS
+        return self.sub+(shift-1)*(self.sub>>1)+(us>>shift)-(self.sub>>1)
+
+    #highest value (microseconds) that lands in bucket ii
+    def bound(self,ii):
+        if ii < self.sub:
+            return ii
+        shift, top = divmod(ii-self.sub,self.sub>>1)
+        return ((top+(self.sub>>1)+1)<<(shift+1))-1
+
+    def record(self,seconds):
+        us = int(seconds*1000000) if seconds > 0 else 0
+        ii = self.bucket(us)
+        if ii >= len(self.counts):
+            ii = len(self.counts)-1
+        self.counts[ii] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    #seconds, for each q in qs (0-1), of a consistent copy of the counts
+    def quantiles(self,qs=METRICS_QUANTILES):
+        counts = self.counts[:]
+        n = sum(counts)
+        out = []
+        for q in qs:
+            if not n:
+                out.append(0.0)
+                continue
+            rank = max(1,int(q*n+0.5))
+            seen = 0
+            for ii, c in enumerate(counts):
+                seen += c
+                if seen >= rank:
+                    break
+            out.append(min(self.bound(ii),self.max)/1000000.0)
+        return out
+
+    def snapshot(self):
+        out = {'count':self.count,'sum':self.total/1000000.0,'max':self.max/1000000.0}
+        for q, v in zip(METRICS_QUANTILES,self.quantiles()):
+            out['p'+('%g' % (q*100)).replace('.','_')] = v
+        return out
+
+
+class Counter:
+    def __init__(self,name,help='',fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn #read the value from elsewhere instead of counting here
+        self.value = 0
+
+    def inc(self,n=1):
+        self.value += n
+
+    def get(self):
+        return self.fn() if self.fn else self.value
+
+
+# Named metrics, in registration order, with Prometheus text and dict views
+class Metrics:
+    def __init__(self,prefix='rfis_'):
+        self.prefix = prefix
+        self.items = [] #(prometheus type, metric)
+        self.started = time.monotonic()
+
+    def counter(self,name,help='',fn=None):
+        c = Counter(name,help,fn)
+        self.items.append(('counter',c))
+        return c
+
+    def gauge(self,name,help,fn):
+        g = Counter(name,help,fn)
+        self.items.append(('gauge',g))
+        return g
+
+    def histogram(self,name,help=''):
+        h = LatencyHistogram(name,help)
+        self.items.append(('summary',h))
+        return h
+
+    def snapshot(self):
+        out = {'uptime':time.monotonic()-self.started}
+        for kind, m in self.items:
+            out[m.name] = m.snapshot() if kind == 'summary' else m.get()
+        return out
+
+    #Prometheus text exposition format
+    def render(self):
+        lines = []
+        for kind, m in self.items:
+            name = self.prefix+m.name
+            lines.append('# HELP '+name+' '+m.help)
+            lines.append('# TYPE '+name+' '+kind)
+            if kind != 'summary':
+                lines.append(name+' '+repr(m.get()))
+                continue
+            for q, v in zip(METRICS_QUANTILES,m.quantiles()):
+                lines.append('%s{quantile="%g"} %r' % (name,q,v))
+            lines.append(name+'_sum '+repr(m.total/1000000.0))
+            lines.append(name+'_count '+str(m.count))
+            lines.append('# TYPE '+name+'_max gauge')
+            lines.append(name+'_max '+repr(m.max/1000000.0))
+        return '\n'.join(lines)+'\n'
+
+
+# Serves Metrics.render() at http://localhost:port/metrics (any path, really)
+class MetricsServer:
+    def __init__(self,metrics,port):
+        import http.server
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                body = metrics.render().encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type','text/plain; version=0.0.4')
+                handler.send_header('Content-Length',str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+            def log_message(handler,*args):
+                pass
+        self.server = http.server.ThreadingHTTPServer(('localhost',port),Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# State subscriptions
+# A client subscribes to topics (see state_topics()) and CommProcess
+# pushes changes at most `rate` times a second, each as one frame:
+#   {"type":"state","seq":n,"time":wall clock,"full":bool,<topic>:{field:value,...},...}
+# Only fields that changed since the last push are included; "full"
+# pushes (the first one, and the one after any dropped push) carry every
+# field of every topic. seq counts pushes, so a gap means one was lost.
+STATE_TOPICS=('motors','calibration','lights','pins','error','program','symbols','batch')
+
+#{topic:{field:value}} for a snapshot and the running program (if any)
+#batch - BatchScheduler.report()
+def state_topics(snap,prog=None,symbols=None,batch=None):
+    out = {'motors':{'pos':snap.pos,'target':snap.target,'running':snap.running,'stale':snap.stale},
+           'calibration':{'calibrated':snap.calibrated},
+           'lights':{'lights':snap.lights[1:],'indicator':snap.indicator},
+           'pins':{'pins':snap.pins},
+           'error':{'error':snap.error}}
+    if prog is not None:
+        code = prog.code
+        pc = prog.pc
+        out['program'] = {'name':prog.progname,'running':prog.running,'result':prog.result,
+                          'step':code[pc].name if code and 0 <= pc < len(code) else None}
+    else:
+        out['program'] = {'name':None,'running':False,'result':None,'step':None}
+    if symbols is not None:
+        out['symbols'] = dict(symbols)
+    if batch is not None:
+        out['batch'] = batch
+    return out
+
+
+class StateSubscription:
+    def __init__(self,topics,rate=STATE_DEFAULT_RATE):
+        self.topics = [t for t in topics if t in STATE_TOPICS]
+        self.rate = max(0.1,min(float(rate),STATE_MAX_RATE))
+        self.interval = 1.0/self.rate
+        self.seq = 0
+        self.last = {} #topic -> fields as last pushed
+        self.last_time = 0
+        self.key = None #what the last push was built from, to skip unchanged state
+        self.full = True
+
+    #push message with what changed (None: nothing did)
+    def delta(self,values,now):
+        msg = {'type':'state','seq':self.seq+1,'time':now,'full':self.full}
+        changed = False
+        for t in self.topics:
+            fields = values.get(t)
+            if fields is None:
+                continue
+            old = self.last.get(t) if not self.full else None
+            diff = fields if old is None else dict((k,v) for k, v in fields.items() if old.get(k) != v)
+            if diff:
+                msg[t] = diff
+                changed = True
+            self.last[t] = fields
+        if not changed and not self.full:
+            return None
+        self.seq += 1
+        self.full = False
+        return msg
 
-    def do_cmd(self,cmd):
-        pass
+    #the push was dropped: the client needs everything again
+    def lost(self):
+        self.full = True
 
-    def run(self):
-#        if not self.program:
-#            print('no program loaded')
-#            return
-#        if 'description' in self.program.keys():
-#            print(self.program['description'])
-#        cmdn=0
-#        for cmd in self.program:
-#            #check queue for control messages
-#            if type(cmd) == list: #array (compact) form
-#                pass
-#            elif type(cmd) == dict: #object (verbose) form
-#                pass
-#            else: #program was tampered with
-#                print('program command must be given as array or object ('+str)
-#            cmdn += 1
-#            if self.stepdelay:
-#                time.sleep(stepdelay)
-        count = 5
-        while count:
-            print(count)
-            self.api.send([b'M','1',0,10])
-            count -= 1
-            time.sleep(0.5)
-
-
-# NOT IMPLEMENTED - threaded communication implementation
-# Intended to be standalone relay between process and micro via serial
-class SerialThread():
-    pass
 
+# API connections
+# One per accepted socket, with its own read decoder, write buffer and
+# subscription, so a slow or chatty client only ever holds up itself.
+class ClientSession:
+    def __init__(self,sock,addr,ident,role):
+        self.sock = sock
+        self.addr = addr
+        self.id = ident
+        self.role = role
+        self.dec = FrameDecoder() #messages from the client
+        self.wbuf = bytearray() #frames the client hasn't taken yet
+        self.subscription = None #StateSubscription
+        self.dropped = 0 #messages dropped because the client wasn't reading
+        self.binary = False #answer in msgpack: the client's last control message was (see encode_message())
 
-# Intended to be standalone relay between process and MATLAB via socket
-class SocketThread():
-    pass
+    def __str__(self):
+        return 'client '+str(self.id)+' ('+self.role+')'
 
 
 # Implementation of persistent communication relay and state storage
@@ -285,320 +3770,1162 @@ class SocketThread():
 # and delays (given by A and D cmds, 
 # light state/values, done/error, pin states, 
 class CommProcess:
-    def __init__(self,serial_port=SERIAL_PORT_DEFAULT,socket_port=SOCKET_PORT_DEFAULT):
+    #log_levels - {channel:level} on top of LOG_LEVELS_DEFAULT and $RFIS_LOG
+    #trace - file name for a binary serial trace (None: no trace)
+    #notify_sink - where notifications go instead of MATLAB (ex. LocalSink()), None: connect to MATLAB
+    #symbols_file - where persistent symbols are kept across restarts (None: not kept)
+    #batch_journal - where batch progress is kept, so a restart resumes it (None: not kept)
+    def __init__(self,serial_port=SERIAL_PORT_DEFAULT,socket_port=SOCKET_PORT_DEFAULT,log_levels=None,trace=None,notify_sink=None,resync_policy=RESYNC_AUTO,
+                 metrics_port=None,metrics_dump=None,baud=SERIAL_BAUD_RATE,symbols_file=None,batch_journal=None,tx_gap=SERIAL_TX_GAP):
         #comm object device names/addresses
         self.socket_port=socket_port
         self.serial_port=serial_port
+        self.baud=baud #line rate the serial writer paces itself to (and the simulator runs at)
+        self.tx_gap=tx_gap #least time between packets to the microcontroller (see SerialThread)
+        self.resync_policy=resync_policy #what to do with queued packets after a serial reconnect (RESYNC_*)
+        self.symbols_file=symbols_file
 
         #comm object handles
         self.mc_com = None      #serial port object
+        self.mc_device = None   #the device it was opened on (serial_port, or the KL25Z "auto" found)
+        self.ports = None       #PortRegistry watching for hot-plug (real serial ports only)
+        self.port_events = collections.deque() #(added, removed) from the registry's thread
         self.listen_sock = None #connection source socket
-        self.api_sock = None    #active data socket
-        self.matlab=None        #matlab engine instance
-        #self.matlab.workspace['proc']=1
-
-        #for async implementation - not currently used
-        self.rsocks = []
-        self.wsocks = []
-        self.xsocks = []
+        self.clients = {}       #API connections: socket -> ClientSession
+        self.controller = None  #the ClientSession allowed to control the rig
+        self.client_ids = 0
+        self.notify_sink=notify_sink
+        self.notify=None        #NotifyDispatcher (to MATLAB or notify_sink)
+        self.log=None           #LogWriter
+
+        self.selector = None    #readiness for every channel above (created by run())
+        self.wake_r = None      #socketpair used by other threads to interrupt select()
+        self.wake_w = None
+        self.mc_thread = None   #SerialThread moving packets over mc_com
+        self.state = HardwareState()
+        self.prog_thread = None #running ProgramThread
+        self.pending_pt = None #ProgramThread to start once prog_thread has stopped (see start_pending())
+        self.programs = ProgramCache(log=lambda msg: self.print(msg,channel='seq'))
+        self.pg_delay = 0
+        self.batch = BatchScheduler(batch_journal,log=lambda msg: self.print(msg,channel='seq'))
+        self.state.symbols.log = lambda msg: self.print(msg,channel='seq',level=LOG_WARN)
+        self.batch_pt = None #ProgramThread running the batch's current stage
         
         #in/outbound message queues to/from various nodes (mc: microcontroller, ui: MATLAB)
-        self.mc_omsg = [] #microcontroller outbound
-        self.mc_imsg = [] # " " " inbound
-        self.ui_omsg = [] #matlab inbound
+        self.mc_omsg = PacketQueue(MC_QUEUE_SIZE) #microcontroller outbound
+        self.mc_imsg = collections.deque() # " " " inbound: (monotonic time, packet) from SerialThread
         self.ui_imsg = [] # "  " outbound
+        self.mc_backpressure = False #mc_omsg filled up and the API client has been told
         self.pt_omsg = queue.Queue() #program thread inbound
         self.pt_imsg = queue.Queue() # " " out
+        self.sym_batch = {} #symbol updates waiting for flush_symbols()
+        self.sym_persist = {} # " " to be kept across restarts
 
         #internal control vars
         self.done = False #main loop exit condition
-        self.cl_delay = 0 #connection retry delay counters (seconds)
-        self.sv_delay = 0
+        self.sv_delay = 0 #connection retry delay counters (seconds)
         self.mc_delay = 0
+        self.mc_plugged = False #our device just appeared, open it without waiting out RETRY_INTERVAL
+        self.mc_lost = None     #when the serial link dropped (monotonic), until resync()
+        self.mc_retry = RETRY_INTERVAL #serial re-open backoff, and this round's (jittered) wait
+        self.mc_wait = RETRY_INTERVAL
         self.api_delay = 0 #how long to wait to read indicated number of bytes (or at least four) before resetting
+        self.clock_offset = 0 #add to monotonic times for wall clock time
+
+        #instrumentation (see Metrics), served on metrics_port and/or appended to metrics_dump
+        self.metrics_port = metrics_port
+        self.metrics_dump = metrics_dump
+        self.metrics_server = None
+        self.mx_delay = 0
+        self.mc_bytes = [0,0] #in, out, of serial links already closed
+        mx = self.metrics = Metrics()
+        self.mx_forward = mx.histogram('mc_forward_seconds','packet accepted from the API or sequencer -> written to the serial port')
+        self.mx_dispatch = mx.histogram('mc_dispatch_seconds','packet read from the serial port -> state updated and posted to the UI')
+        self.mx_loop = mx.histogram('loop_busy_seconds','main loop work per iteration, select() wait excluded')
+        self.mx_step = mx.histogram('seq_step_seconds','sequencer instruction run time, waits excluded')
+        self.mx_wait = mx.histogram('seq_wait_seconds','sequencer wait instruction durations')
+        self.mx_stage = mx.histogram('batch_stage_seconds','batch stage (program) run time, all stages')
+        self.mx_notify = mx.histogram('notify_call_seconds','MATLAB (notify sink) call time')
+        self.mx_notify_latency = mx.histogram('notify_latency_seconds','event posted -> delivered to MATLAB')
+        self.mx_ui = mx.counter('ui_messages_total','messages received from API clients')
+        self.mx_symbols = mx.counter('symbol_updates_total','symbol values received from API clients')
+        self.mx_reconnects = mx.counter('serial_reconnects_total','serial links re-established after a drop')
+        mx.counter('serial_bytes_in_total','bytes read from the serial port',lambda: self.serial_bytes(0))
+        mx.counter('serial_bytes_out_total','bytes written to the serial port',lambda: self.serial_bytes(1))
+        mx.counter('mc_queue_dropped_total','packets refused by the full serial queue',lambda: self.mc_omsg.dropped)
+        mx.gauge('mc_queue_depth','packets waiting for the serial port',lambda: len(self.mc_omsg))
+        mx.gauge('mc_queue_peak','deepest the serial queue has been',lambda: self.mc_omsg.peak)
+        mx.gauge('serial_connected','1 while the serial port is open',lambda: 1 if self.mc_com else 0)
+        mx.gauge('clients','API connections',lambda: len(self.clients))
+        mx.gauge('notify_pending','events waiting for MATLAB',lambda: len(self.notify.pending) if self.notify else 0)
+        mx.counter('notify_dropped_total','events dropped while MATLAB was busy',lambda: self.notify.dropped if self.notify else 0)
+        mx.counter('notify_errors_total','failed MATLAB calls',lambda: self.notify.errors if self.notify else 0)
+        mx.counter('batch_specimens_total','specimens finished in the current batch',lambda: self.batch.done)
+        mx.gauge('batch_specimens_per_hour','current batch throughput (while running)',lambda: self.batch.rate(time.monotonic()))
 
-        self.logfile=open('rfis_proc.log','at')
+        levels = parse_log_levels(os.environ.get('RFIS_LOG',''))
+        levels.update(log_levels or {})
+        self.log=LogWriter(RFIS_PROCESS_LOG,levels,trace=trace)
         self.print("\nrfis.CommProcess.__init__\n")
 
     def __del__(self):
         self.print('rfis.CommProcess.__del__')
-        if self.matlab:
-                try:
-                    self.matlab.exit()
-                except Exception as e:
-                    self.print(str(e))
-                    self.matlab = None
+        self.close_matlab()
         if self.listen_sock:
             self.listen_sock.close()
             self.listen_sock = None
-        if self.api_sock:
-            self.api_sock.close()
-            self.api_sock = None
+        for sock in list(self.clients):
+            sock.close()
+        self.clients.clear()
         if self.mc_com:
             self.mc_com.close()
             self.mc_com = None
-        if self.logfile: #todo: is this needed?
-            self.logfile.flush()
-            self.logfile.close()
-        time.sleep(10)
-
-    def print(self,msg,end="\n"):
-        print(msg,end=end)
-        if self.logfile:
-            self.logfile.write(msg+end)
-        if self.matlab:
-            try:
-                self.matlab.RFIS_notify(MSG_TYPE_COM,'{"type":"log","message":"'+msg+'"}'+end)
-            except:
-                pass
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    #record an event (JSON) in the capture, if one is being written
+    def capture(self,kind,jd):
+        if self.log and self.log.trace_file:
+            self.log.trace('proc',kind,json.dumps(jd).encode())
+
+    def print(self,msg,end="\n",channel='proc',level=LOG_INFO):
+        if not self.log or not self.log.enabled(channel,level):
+            return
+        self.log.log(channel,level,msg,end)
+        if self.notify and level >= LOG_INFO:
+            self.notify.post(MSG_TYPE_COM,{'type':'log','message':msg})
 
     def open_serial(self):
-        pass
+        device = self.serial_device()
+        if device is None:
+            self.print('Serial: no KL25Z plugged in')
+            return False
+        try:
+            self.mc_com=open_transport(device,self.baud,SERIAL_READ_TIMEOUT)
+        except:
+            self.print('exception opening serial port \"%s\"' % device)
+            self.mc_com = None
+            return False
+        self.mc_device = device
+        self.mc_retry = self.mc_wait = RETRY_INTERVAL
+        if self.mc_lost is not None: #before the writer starts on the queue
+            self.resync()
+        self.mc_thread = SerialThread(self.mc_com,self.mc_imsg,self.mc_omsg,self.wake,self.log,self.baud,self.tx_gap)
+        self.mc_thread.latency = self.mx_forward
+        self.mc_thread.start()
+        return True
 
     def close_serial(self):
-        pass
+        if self.mc_thread:
+            self.mc_thread.stop()
+            self.mc_bytes[0] += self.mc_thread.bytes_in
+            self.mc_bytes[1] += self.mc_thread.bytes_out
+            if self.mc_thread.unsent: #may or may not have reached the board; resync() decides
+                shed = self.mc_omsg.requeue(self.mc_thread.unsent)
+                if shed:
+                    self.state.unsend(shed)
+            self.mc_thread = None
+        if self.mc_com:
+            try:
+                self.mc_com.close()
+            except OSError:
+                pass
+            self.mc_com = None
+        self.mc_device = None
+        self.mc_delay = 0
+
+    #bytes moved over every serial link so far, 0: in, 1: out
+    def serial_bytes(self,ii):
+        t = self.mc_thread
+        return self.mc_bytes[ii]+((t.bytes_in,t.bytes_out)[ii] if t else 0)
+
+    #the link failed (or the board was unplugged): keep what's queued and
+    #retry soon, backing off from RECONNECT_BACKOFF_MIN
+    def serial_lost(self):
+        self.close_serial()
+        if self.mc_lost is None:
+            self.mc_lost = time.monotonic()
+            event = {'type':'serial','state':'lost','queue':self.mc_omsg.stats()}
+            self.capture(TRACE_LINK,event)
+            self.broadcast(event)
+        self.mc_retry = RECONNECT_BACKOFF_MIN
+        self.backoff()
+
+    #next re-open wait, jittered so relays (or ports on a hub) that dropped
+    #together don't retry in lockstep
+    def backoff(self):
+        import random
+        self.mc_wait = self.mc_retry*random.uniform(0.5,1)
+        self.mc_retry = min(2*self.mc_retry,RETRY_INTERVAL)
+
+    #reopened after a drop: settle motor state (see HardwareState.resync()),
+    #then replay or abort what was queued meanwhile, per resync_policy.
+    #Abort only drops moves and calibrations; stops, resets, lights, pins
+    #and delays always go out. No motor has to be re-homed unless a queued
+    #calibration was aborted.
+    def resync(self):
+        now = time.monotonic()
+        outage = now-self.mc_lost
+        self.mc_lost = None
+        self.mx_reconnects.inc()
+        policy = self.resync_policy
+        if policy == RESYNC_AUTO:
+            policy = RESYNC_REPLAY if outage <= RESYNC_REPLAY_WINDOW else RESYNC_ABORT
+        aborted = []
+        if policy == RESYNC_ABORT:
+            aborted = self.mc_omsg.remove(b'MC')
+            for p in aborted:
+                self.state.unsend(p)
+            if aborted and self.prog_thread and self.prog_thread.is_alive():
+                self.print('SEQ: stopping program, its queued commands were aborted',channel='seq')
+                self.prog_thread.stop()
+        pending = set(p[1]-ord('1') for p in self.mc_omsg.pending() if p[0] == ord('M'))
+        motors = self.state.resync(now,pending)
+        numbers = dict((k,[m+1 for m in v]) for k, v in motors.items())
+        self.print('Serial: resynced after %.3f s, %s %d queued, aborted %d, motors %s'
+                   % (outage,policy,len(self.mc_omsg),len(aborted),json.dumps(numbers)))
+        event = {'type':'serial','state':'resynced','outage':outage,'policy':policy,
+                 'replayed':len(self.mc_omsg),'aborted':len(aborted),'motors':numbers}
+        self.capture(TRACE_LINK,event)
+        self.broadcast(event)
+
+    #port to open: serial_port, or for "auto" the first KL25Z (None if there isn't one)
+    def serial_device(self):
+        if self.serial_port != SERIAL_PORT_AUTO:
+            return self.serial_port
+        boards = (self.ports or port_registry()).kl25z()
+        return boards[0].device if boards else None
+
+    #False only when the port registry knows the port isn't plugged in
+    def serial_available(self):
+        if not self.ports:
+            return True
+        if self.serial_port == SERIAL_PORT_AUTO:
+            return bool(self.ports.kl25z())
+        return self.ports.present(self.serial_port) is not False
+
+    #PortRegistry watcher (its thread): hand the change to the main loop
+    def on_ports_changed(self,added,removed):
+        self.port_events.append((added,removed))
+        self.wake()
+
+    def handle_port_events(self):
+        while self.port_events:
+            added, removed = self.port_events.popleft()
+            for p in removed:
+                self.print('Serial: '+p.device+' unplugged')
+                if p.device == self.mc_device:
+                    self.serial_lost()
+            for p in added:
+                self.print('Serial: '+p.device+' plugged in'+(' (KL25Z)' if p.kl25z else ''))
+                if not self.mc_com and (p.device == self.serial_port or (p.kl25z and self.serial_port == SERIAL_PORT_AUTO)):
+                    self.mc_plugged = True
+            self.broadcast({'type':'ports','added':[p._asdict() for p in added],'removed':[p._asdict() for p in removed]})
 
     def open_socket(self):
-        pass
+        try:
+            self.listen_sock = socket.socket()
+            if os.name != 'nt': #allow a quick restart over TIME_WAIT (on windows this would allow port theft)
+                self.listen_sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+            self.listen_sock.setblocking(False)
+            self.listen_sock.bind(('localhost',self.socket_port))
+            self.listen_sock.listen()
+        except OSError as e:
+            self.print('exception creating listen socket: '+str(e))
+            if self.listen_sock:
+                self.listen_sock.close()
+            self.listen_sock = None
+            return False
+        self.selector.register(self.listen_sock,selectors.EVENT_READ,self.on_accept)
+        update_lockfile(self.socket_port,self.lock_info(True)) #clients can connect now
+        return True
 
     def close_socket(self):
-        pass
+        for s in list(self.clients.values()):
+            self.close_client(s)
+        if self.listen_sock:
+            try:
+                self.selector.unregister(self.listen_sock)
+            except (KeyError,ValueError):
+                pass
+            self.listen_sock.close()
+            self.listen_sock = None
+        self.sv_delay = 0
+
+    def close_client(self,s):
+        try:
+            self.selector.unregister(s.sock)
+        except (KeyError,ValueError):
+            pass
+        try:
+            s.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        s.sock.close()
+        self.clients.pop(s.sock,None)
+        if s is self.controller: #next client to connect (or ask) takes over
+            self.controller = None
+        self.update_watch()
 
     def open_matlab(self):
-        pass
+        if self.notify_sink is None:
+            self.notify_sink = MatlabSink() #connects when the first notification goes out
+        self.notify = NotifyDispatcher(self.notify_sink)
+        self.notify.call_time = self.mx_notify
+        self.notify.latency = self.mx_notify_latency
+        return True
 
     def close_matlab(self):
-        pass
+        if self.notify:
+            self.notify.close()
+            self.notify = None
+        close = getattr(self.notify_sink,'close',None)
+        if close:
+            close()
 
-    def run(self):
-        self.print('rfis.CommProcess.run: attempting to open serial port')
+    #thread-safe: queue a packet for the microcontroller and kick the main loop
+    #The state is updated right away, so the program sending it sees its own
+    #moves; on_wake() undoes that if the serial queue turns the packet away.
+    def send(self,packet):
+        packet = bytes(packet)
+        self.state.sent(packet)
+        self.pt_imsg.put((time.monotonic(),packet))
+        self.wake()
+
+    def wake(self):
         try:
-            self.mc_com=serial.Serial(self.serial_port,SERIAL_BAUD_RATE)
-        except:
-            self.print('exception opening serial port \"%s\"' % self.serial_port)
-            self.mc_com = None
-        self.print('rfis.CommProcess.run: attempting to create listen socket')
-        self.listen_sock = socket.socket()
-        self.listen_sock.settimeout(0.2)
-        self.listen_sock.bind(('localhost', self.socket_port))
-        self.listen_sock.listen()
-        self.print('rfis.CommProcess.run: attempting to connect to MATLAB')
+            self.wake_w.send(b'\x00')
+        except OSError: #already pending (buffer full) or closing
+            pass
+
+    # --- selector callbacks ---
+
+    def on_wake(self,sock,mask):
         try:
-            import matlab.engine #was getting an error when this was a global import (b/c nesting in matlab via api?)
-            #^seems to work ok here as this is only called in separate process
-            self.matlab = matlab.engine.connect_matlab(MATLAB_NAME)
-        except Exception as e:
-            self.print('rfis.CommProcess.run: failed to connect to MATLAB'+str(e))
+            while sock.recv(4096):
+                pass
+        except OSError:
+            pass
+        while True:
+            try:
+                t, p = self.pt_imsg.get_nowait()
+            except queue.Empty:
+                break
+            if not self.queue_mc(p,t):
+                self.state.unsend(p)
+        self.handle_port_events()
+        self.read_serial()
+
+    #listening stays open, so clients can (re)connect at any time
+    def on_accept(self,sock,mask):
+        while True:
+            try:
+                conn, addr = self.listen_sock.accept()
+            except (BlockingIOError,InterruptedError):
+                return
+            except OSError as e:
+                self.print('Socket: accept failed: '+str(e))
+                return
+            if len(self.clients) >= CLIENT_MAX:
+                self.print('Socket: refused '+str(addr)+', too many clients')
+                conn.close()
+                continue
+            conn.setblocking(False)
+            self.client_ids += 1
+            s = ClientSession(conn,addr,self.client_ids,ROLE_OBSERVER if self.controller else ROLE_CONTROLLER)
+            if not self.controller:
+                self.controller = s
+            self.clients[conn] = s
+            self.selector.register(conn,selectors.EVENT_READ,self.on_client_io)
+            self.print('Socket: accepted '+str(addr)+' as '+str(s))
+            self.notify_client({'type':'hello','client':s.id,'role':s.role,'version':PROTOCOL_VERSION,'pid':os.getpid()},s)
+
+    def on_client_io(self,sock,mask):
+        s = self.clients.get(sock)
+        if not s:
+            return
+        if mask & selectors.EVENT_WRITE:
+            self.flush_client(s)
+        if mask & selectors.EVENT_READ and sock in self.clients:
+            self.read_client(s)
+
+    def read_client(self,s):
+        try:
+            n=s.dec.recv_into(s.sock)
+        except (BlockingIOError,InterruptedError):
+            return
+        except OSError as e:
+            self.print('UI: '+str(s)+' read failed: '+str(e))
+            self.close_client(s)
+            return
+        if not n: #TODO: check for valid shutdown? or assume crash of some kind?
+            self.print('UI: '+str(s)+' disconnected (0-length recv)')
+            self.close_client(s)
+            return
+        self.print('GOT BYTES: '+str(n),channel='ui',level=LOG_DEBUG)
+        try:
+            for p in s.dec.frames():
+                self.handle_api_msg(p,s)
+                if self.done or s.sock not in self.clients:
+                    break
+        except ValueError as e: #framing is lost, nothing after this can be trusted
+            self.print('UI: '+str(s)+': '+str(e))
+            self.close_client(s)
+
+    #False (and tell the client) if s may not control the rig
+    def allowed(self,s,what):
+        if s is None or s is self.controller:
+            return True
+        self.print('UI: '+str(s)+' may not '+what,channel='ui',level=LOG_WARN)
+        self.notify_client({'type':'error','error':'not controller','request':what},s)
+        return False
+
+    #p is a memoryview into the decoder's buffer (don't hang on to it)
+    #s - ClientSession it came from (None: internal, always allowed)
+    def handle_api_msg(self,p,s=None):
+        self.mx_ui.inc()
+        if len(p) == 4 and p[0] < 0x80: #keep this special case for serial packets
+            self.log.trace('ui',TRACE_UI_IN,bytes(p))
+            if not self.allowed(s,'send '+chr(p[0])):
+                return
+            if chr(p[0]) in['C','D','L','M','P','R','S']: # got a message
+                p = bytes(p)
+                if self.queue_mc(p): #a dropped packet never changes the state
+                    self.state.sent(p)
+            elif p[0] == ord('X'):
+                self.print('UI: got SHUTDOWN')
+                self.done = True
+            else:
+                self.print('WTF: '+str(bytes(p)),channel='ui',level=LOG_WARN) #ignore garbage
+        else:
+            if self.log.enabled('ui',LOG_DEBUG):
+                self.print('UI: control message, '+str(len(p))+' bytes: '+str(bytes(p[:LOG_MSG_PREVIEW])),channel='ui',level=LOG_DEBUG)
+            if self.log.trace_file:
+                self.log.trace('ui',TRACE_UI_MSG,bytes(p))
+            try:
+                jd = decode_message(p)
+            except ValueError as e:
+                self.print('UI: undecodable '+str(len(p))+' byte message: '+str(e),channel='ui',level=LOG_WARN)
+                return
+            if s:
+                s.binary = is_binary_message(p)
+            if type(jd) == dict and jd.get('type') == MSG_TYPE_SEQ:
+                cmd = jd.get('command')
+                anyone = (cmd in ('list','get_symbols') or (cmd == 'symbols' and not jd.get('persist'))
+                          or (cmd == 'batch' and jd.get('action') == 'status'))
+                if anyone or self.allowed(s,'control the sequencer'):
+                    self.handle_seq(jd,s)
+            elif type(jd) == dict and jd.get('type') == MSG_TYPE_API:
+                self.handle_api_cmd(jd,s)
+
+    #sequencer control: {"type":MSG_TYPE_SEQ,"command":...}
+    #  "run"  - "name": catalog program, or "program": program array (or JSON string),
+    #           compiled by the program's thread so a big one doesn't hold up the relay
+    #           "override": stop any running program first
+    #           "overlap": false runs moves strictly in sequence
+    #  "list" - replies with the catalog
+    #  "symbols" - "symbols": {name:value} to define/update (ex. FORAM_PRESENT from the detector),
+    #           collected and applied together once per main loop pass (see flush_symbols());
+    #           observers may send these too, so a detector doesn't need control of the rig
+    #           "persist": keep these across restarts (ex. calibrated positions), controller only
+    #  "get_symbols" - "names": list (default all), "id": echoed back;
+    #           replies {"type":"symbols","id":...,"version":table version,"symbols":{name:value}}
+    #  "stop" - stop the running program
+    #  "batch" - "action": see handle_batch()
+    #  anything else is passed on to the running program (ex. "step", "clear")
+    def handle_seq(self,jd,s=None):
+        cmd = jd.get('command')
+        if cmd == 'symbols':
+            syms = jd.get('symbols')
+            if type(syms) == dict and all(_is_number(v) for v in syms.values()):
+                (self.sym_persist if jd.get('persist') else self.sym_batch).update(syms)
+                self.mx_symbols.inc(len(syms))
+            else:
+                self.print('SEQ: bad symbols '+str(syms)[:LOG_MSG_PREVIEW],channel='seq')
+            return
+        self.flush_symbols() #anything else sees every update sent before it
+        running = (self.prog_thread is not None and self.prog_thread.is_alive()) or self.pending_pt is not None
+        if cmd == 'run':
+            if running:
+                if not jd.get('override'):
+                    self.print('SEQ: blocked by active program',channel='seq')
+                    return
+                self.prog_thread.stop()
+                self.pending_pt = None
+            pt = self.program_thread(jd.get('autostep',True),jd.get('stepdelay',0),jd.get('overlap',True))
+            if 'name' in jd:
+                if not pt.load(str(jd['name']),True):
+                    self.print('SEQ: program rejected',channel='seq')
+                    return
+            else:
+                pt.source = jd.get('program')
+            self.pending_pt = pt
+            if not self.start_pending(): #never join() here, the old one may be mid-move
+                self.print('SEQ: starting once the running program stops',channel='seq')
+        elif cmd == 'stop':
+            if running:
+                self.prog_thread.stop()
+                self.pending_pt = None
+        elif cmd == 'batch':
+            self.handle_batch(jd,s)
+        elif cmd == 'list':
+            self.notify_client({'type':MSG_TYPE_SEQ,'programs':self.programs.listing(),'default':self.programs.default},s)
+        elif cmd == 'get_symbols':
+            names = jd.get('names')
+            snap = self.state.symbols.snapshot
+            if type(names) == list:
+                symbols = dict((n,snap.values[n]) for n in names if type(n) == str and n in snap.values)
+            else:
+                symbols = dict(snap.values)
+            self.notify_client({'type':'symbols','id':jd.get('id'),'version':snap.version,'symbols':symbols},s)
+        elif running and type(cmd) == str:
+            (self.pending_pt or self.prog_thread).post(cmd)
+
+    #start pending_pt if the program it replaces has ended; False if not yet
+    #the old thread wakes the relay as it finishes, the main loop polls for the rest
+    def start_pending(self):
+        if self.prog_thread and self.prog_thread.is_alive():
+            return False
+        pt = self.pending_pt
+        self.pending_pt = None
+        self.prog_thread = pt
+        pt.start()
+        self.print('SEQ: started',channel='seq')
+        return True
+
+    #batch runs: {"type":MSG_TYPE_SEQ,"command":"batch","action":...}, each answered with
+    #{"type":"batch","id":...} plus BatchScheduler.report() (and "error" if the action failed)
+    #  "start"  - the rest of the message is the batch (see BatchScheduler.start())
+    #  "status" - just the report
+    #  "pause"  - no new stages after the running one; "resume" carries on
+    #  "tray"   - the next tray is loaded
+    #  "skip"   - give up on the current specimen (while paused)
+    #  "cancel" - stop the running stage and end the batch
+    def handle_batch(self,jd,s=None):
+        action = jd.get('action')
+        now = time.monotonic()
+        b = self.batch
+        error = None
+        if action == 'start':
+            missing = [n for n in jd.get('stages') or [] if type(n) != str or not self.programs.get(n)]
+            if missing:
+                error = 'unavailable programs: '+', '.join(str(n) for n in missing)
+            else:
+                spec = dict((k,v) for k, v in jd.items() if k not in ('type','command','action','id'))
+                try:
+                    b.start(spec,now)
+                except ValueError as e:
+                    error = str(e)
+        elif action == 'pause':
+            if not b.pause('paused by '+str(s or 'relay'),now):
+                error = 'not running'
+        elif action == 'resume':
+            if not b.resume(now):
+                error = 'not paused'
+        elif action == 'tray':
+            if not b.tray_loaded(now):
+                error = 'not waiting for a tray'
+        elif action == 'skip':
+            if not b.skip(now):
+                error = 'a stage is running' if b.current else 'no batch'
+        elif action == 'cancel':
+            pt = self.batch_pt
+            if b.cancel(now) and pt and pt.is_alive():
+                pt.stop()
+        elif action != 'status':
+            error = 'unknown action '+str(action)
+        reply = dict(b.report(now),type='batch',id=jd.get('id'))
+        if error:
+            reply['error'] = error
+            self.print('SEQ: batch '+str(action)+': '+error,channel='seq')
+        self.notify_client(reply,s)
+
+    # --- end selector callbacks ---
+
+    #start the batch's next stage, or collect the one that ended; from the main loop
+    def run_batch(self,now):
+        b = self.batch
+        pt = self.batch_pt
+        if pt:
+            if pt.running or pt.result is None: #still going (or not started yet)
+                return
+            self.batch_pt = None
+            if b.current:
+                self.mx_stage.record(now-b.current[2])
+            b.stage_ended(pt.result,now)
+        if b.state != BATCH_RUNNING or not self.mc_com:
+            return
+        if (self.prog_thread and self.prog_thread.is_alive()) or self.pending_pt: #someone else's program
+            return
+        job = b.next_job()
+        if not job:
+            return
+        name, syms = job
+        self.flush_symbols()
+        self.state.set_symbols(syms)
+        pt = self.program_thread()
+        if not pt.load(name,True): #dropped from the catalog since the batch started
+            b.stage_started(now)
+            b.stage_ended('rejected',now)
+            return
+        self.batch_pt = self.prog_thread = pt
+        b.stage_started(now)
+        pt.start()
+        self.print('SEQ: batch '+str(b.name)+': specimen '+str(b.specimen+1)+'/'+str(b.count)+' '+name,channel='seq')
+
+    #a ProgramThread hooked up to this relay's instrumentation
+    def program_thread(self,autostep=True,stepdelay=0,overlap=True):
+        pt = ProgramThread(self,autostep,stepdelay,log=lambda msg: self.print(msg,channel='seq'))
+        pt.overlap = bool(overlap)
+        pt.watch = self.watching_program()
+        if self.log.trace_file:
+            pt.capture = lambda jd: self.capture(TRACE_SEQ,jd)
+        pt.step_time = self.mx_step
+        pt.wait_time = self.mx_wait
+        return pt
+
+    #apply the symbol updates received since the last call in one go:
+    #one lock, one state version and one wake-up for waiting programs
+    #however many updates a client streamed in
+    def flush_symbols(self):
+        if self.sym_persist:
+            syms = self.sym_persist
+            self.sym_persist = {}
+            self.state.set_symbols(syms,persist=True)
+        if self.sym_batch:
+            syms = self.sym_batch
+            self.sym_batch = {}
+            self.state.set_symbols(syms)
+
+    #SymbolTable watcher: subscribers hear about changes made by the
+    #sequencer as soon as those made through the API
+    def on_symbols(self,snap,changed):
+        if self.log.enabled('seq',LOG_DEBUG):
+            self.print('SEQ: symbols v'+str(snap.version)+' '+str(changed)[:LOG_MSG_PREVIEW],channel='seq',level=LOG_DEBUG)
+        self.wake()
+
+    #t - when the packet was accepted (default: now)
+    #returns False if the queue was full and the packet was dropped
+    def queue_mc(self,p,t=None):
+        if self.mc_omsg.put(p,t):
+            if self.mc_thread:
+                self.mc_thread.kick()
+            return True
+        if not self.mc_backpressure:
+            self.mc_backpressure = True
+            if self.mc_thread:
+                self.mc_thread.drain_wanted = True
+            self.print('MC: queue full, dropping packets')
+            self.broadcast({'type':'backpressure','state':True,'queue':self.mc_omsg.stats()})
+        return False
+
+    #handle whatever SerialThread has received
+    def read_serial(self):
+        times = []
+        while self.mc_imsg:
+            t, p = self.mc_imsg.popleft()
+            self.state.received(p,t)
+            self.notify.post(MSG_TYPE_MCU,{'type':'mcu','packet':list(p),'t':t,'time':t+self.clock_offset}) #send to UI
+            times.append(t)
+        if times:
+            now = time.monotonic()
+            for t in times:
+                self.mx_dispatch.record(now-t)
+
+    #best effort message to one API client (default: the controller)
+    def notify_client(self,jd,s=None):
+        s = s or self.controller
+        if not s:
+            return False
+        return self.send_client(s,frame(encode_message(jd,s.binary)))
+
+    #same message to every client, encoded once per encoding
+    def broadcast(self,jd):
+        data = {}
+        for s in list(self.clients.values()):
+            if s.binary not in data:
+                data[s.binary] = frame(encode_message(jd,s.binary))
+            self.send_client(s,data[s.binary])
+
+    #queue a whole frame for a client; False if it was dropped (client too far behind)
+    def send_client(self,s,data):
+        if len(s.wbuf)+len(data) > CLIENT_WBUF_MAX:
+            if not s.dropped:
+                self.print('UI: '+str(s)+' not reading, dropping messages',channel='ui',level=LOG_WARN)
+            s.dropped += 1
+            return False
+        was_empty = not s.wbuf
+        s.wbuf += data
+        if was_empty:
+            self.flush_client(s)
+        return True
+
+    def flush_client(self,s):
+        try:
+            n = s.sock.send(s.wbuf)
+        except (BlockingIOError,InterruptedError):
+            n = 0
+        except OSError as e:
+            self.print('UI: '+str(s)+' write failed: '+str(e))
+            self.close_client(s)
+            return
+        del s.wbuf[:n]
+        #only ask for write readiness while something is waiting
+        events = selectors.EVENT_READ|(selectors.EVENT_WRITE if s.wbuf else 0)
+        if self.selector.get_key(s.sock).events != events:
+            self.selector.modify(s.sock,events,self.on_client_io)
+
+    #send subscribers what changed, returns seconds until the next push is due (None: nothing pending)
+    #The state is turned into topic values once per call, however many
+    #subscribers are due; each then gets its own delta.
+    def push_state(self,now):
+        timeout = None
+        values = None
+        pt = self.prog_thread
+        symbols = self.state.symbols.snapshot
+        key = (self.state.snapshot.version,symbols.version,self.batch.version,id(pt),pt.pc if pt else None,pt.running if pt else None)
+        for s in list(self.clients.values()):
+            sub = s.subscription
+            if not sub or (key == sub.key and not sub.full):
+                continue
+            wait = sub.last_time+sub.interval-now
+            if wait > 0:
+                timeout = wait if timeout is None else min(timeout,wait)
+                continue
+            if values is None:
+                values = state_topics(self.state.snapshot,pt,symbols.values,self.batch.report(now))
+            sub.key = key
+            sub.last_time = now
+            msg = sub.delta(values,now+self.clock_offset)
+            if msg and not self.notify_client(msg,s):
+                sub.lost()
+        return timeout
+
+    #does any client want program progress (makes ProgramThread wake us every step)
+    def watching_program(self):
+        for s in self.clients.values():
+            if s.subscription and 'program' in s.subscription.topics:
+                return True
+        return False
+
+    def update_watch(self):
+        if self.prog_thread:
+            self.prog_thread.watch = self.watching_program()
+
+    #API control: {"type":MSG_TYPE_API,"command":...}
+    #  "subscribe"   - "topics": list of STATE_TOPICS (default all), "rate": pushes/second
+    #                  replies {"type":"subscribed","topics":[...],"rate":granted rate}
+    #  "unsubscribe"
+    #  "role"        - "role": ROLE_CONTROLLER or ROLE_OBSERVER, "force": take control from another client
+    #                  replies {"type":"role","role":role now held}
+    def handle_api_cmd(self,jd,s=None):
+        cmd = jd.get('command')
+        if s is None:
             return
-        self.matlab.RFIS_notify(MSG_TYPE_COM,'{"type":"log","message":"Well, here we are."}') #TODO: use api to build messages
+        if cmd == 'metrics':
+            self.notify_client({'type':'metrics','id':jd.get('id'),'metrics':self.metrics.snapshot()},s)
+        elif cmd == 'subscribe':
+            topics = jd.get('topics') or list(STATE_TOPICS)
+            try:
+                sub = StateSubscription(topics,jd.get('rate',STATE_DEFAULT_RATE))
+            except (TypeError,ValueError) as e:
+                self.print('UI: bad subscription: '+str(e),channel='ui')
+                return
+            s.subscription = sub
+            self.update_watch()
+            self.notify_client({'type':'subscribed','topics':sub.topics,'rate':sub.rate},s)
+        elif cmd == 'unsubscribe':
+            s.subscription = None
+            self.update_watch()
+        elif cmd == 'role':
+            role = jd.get('role')
+            if role == ROLE_CONTROLLER and s is not self.controller:
+                if self.controller is None or jd.get('force'):
+                    if self.controller:
+                        self.controller.role = ROLE_OBSERVER
+                        self.notify_client({'type':'role','role':ROLE_OBSERVER},self.controller)
+                    self.controller = s
+                    s.role = ROLE_CONTROLLER
+                    self.print('UI: '+str(s)+' took control',channel='ui')
+            elif role == ROLE_OBSERVER and s is self.controller:
+                self.controller = None
+                s.role = ROLE_OBSERVER
+            self.notify_client({'type':'role','role':s.role},s)
 
-        api_msg_size=0 #first four bytes of any message are size, big endian
-        api_msg_data=bytes() #current message
+    def check_serial(self):
+        if self.mc_thread and self.mc_thread.failed:
+            self.print('Serial: '+str(self.mc_thread.failed))
+            self.serial_lost()
+        if self.mc_backpressure and len(self.mc_omsg.normal) <= self.mc_omsg.maxlen//2:
+            self.mc_backpressure = False
+            self.print('MC: queue drained')
+            self.broadcast({'type':'backpressure','state':False,'queue':self.mc_omsg.stats()})
+
+    #retry anything that's down every RETRY_INTERVAL seconds,
+    #returns how long the selector may sleep (None: until something happens)
+    def service_links(self,t_delta):
+        timeout = None
+        if self.serial_port:
+            if not self.mc_com: #not open, but valid portname
+                self.mc_delay += t_delta
+                if self.mc_delay >= self.mc_wait or self.mc_plugged:
+                    if self.serial_available(): #known to be unplugged: wait for hot-plug instead
+                        self.print('Serial: re-open')
+                        self.open_serial()
+                    self.mc_delay = 0
+                    self.mc_plugged = False
+                    if not self.mc_com:
+                        self.backoff()
+            if not self.mc_com:
+                timeout = max(0,self.mc_wait-self.mc_delay)
+        if not self.listen_sock: #no listening socket
+            self.sv_delay += t_delta
+            if self.sv_delay > RETRY_INTERVAL:
+                self.print('Socket: re-create')
+                self.open_socket()
+                self.sv_delay = 0
+            if not self.listen_sock:
+                wait = RETRY_INTERVAL-self.sv_delay
+                timeout = wait if timeout is None else min(timeout,wait)
+        #pick up edited programs, but never touch the disk under a running one
+        self.pg_delay += t_delta
+        if self.pg_delay > PROGRAM_RESCAN_INTERVAL:
+            self.pg_delay = 0
+            if not (self.prog_thread and self.prog_thread.is_alive()):
+                self.programs.refresh()
+        wait = PROGRAM_RESCAN_INTERVAL-self.pg_delay
+        timeout = wait if timeout is None else min(timeout,wait)
+        if self.pending_pt and not self.start_pending():
+            timeout = min(timeout,PROGRAM_HANDOFF_POLL)
+        if self.batch.active_batch():
+            self.run_batch(time.monotonic())
+        if self.metrics_dump:
+            self.mx_delay += t_delta
+            if self.mx_delay >= METRICS_DUMP_INTERVAL:
+                self.mx_delay = 0
+                self.dump_metrics()
+            timeout = min(timeout,METRICS_DUMP_INTERVAL-self.mx_delay)
+        now = time.monotonic()
+        settled, deadline = self.state.settle(now)
+        if settled:
+            self.print('Serial: motors '+str([m+1 for m in settled])+' settled without a report')
+        if deadline is not None:
+            timeout = min(timeout,max(0,deadline-now))
+        wait = self.push_state(now)
+        if wait is not None:
+            timeout = min(timeout,wait)
+        return timeout
+
+    #one JSON line per call
+    def dump_metrics(self):
+        try:
+            with open(self.metrics_dump,'a') as fp:
+                fp.write(json.dumps(dict(self.metrics.snapshot(),time=time.time()))+'\n')
+        except OSError as e:
+            self.print('Metrics: '+str(e),level=LOG_WARN)
+
+    #contents of this relay's lockfile
+    def lock_info(self,ready):
+        return {'pid':os.getpid(),'port':self.socket_port,'version':PROTOCOL_VERSION,
+                'serial_port':str(self.serial_port),'ready':ready}
+
+    #returns False if another relay already serves this port
+    def run(self):
+        if not acquire_lockfile(self.socket_port,self.lock_info(False)):
+            held = read_lockfile(self.socket_port) or {}
+            self.print('rfis.CommProcess.run: relay '+str(held.get('pid'))+' already serves port '+str(self.socket_port))
+            return False
+        self.selector = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r,selectors.EVENT_READ,self.on_wake)
+        if type(self.serial_port) == str and self.serial_port not in (TRANSPORT_SIM,TRANSPORT_PTY,TRANSPORT_LOOP):
+            self.ports = port_registry()
+            self.ports.watch(self.on_ports_changed)
+            self.ports.start()
+        self.print('rfis.CommProcess.run: attempting to open serial port')
+        self.open_serial()
+        self.print('rfis.CommProcess.run: attempting to create listen socket')
+        self.open_socket()
+        self.print('rfis.CommProcess.run: compiling programs')
+        self.programs.refresh()
+        if self.symbols_file:
+            n = self.state.symbols.load(self.symbols_file)
+            self.print('rfis.CommProcess.run: '+str(n)+' persistent symbols from '+self.symbols_file)
+        self.state.symbols.watch(self.on_symbols)
+        if self.batch.recover(time.monotonic()):
+            self.print('rfis.CommProcess.run: batch '+str(self.batch.name)+' recovered at specimen '+str(self.batch.specimen+1)+'/'+str(self.batch.count))
+        if self.metrics_port:
+            try:
+                self.metrics_server = MetricsServer(self.metrics,self.metrics_port)
+                self.print('rfis.CommProcess.run: metrics at http://localhost:'+str(self.metrics_port)+'/metrics')
+            except OSError as e:
+                self.print('rfis.CommProcess.run: no metrics endpoint: '+str(e),level=LOG_WARN)
+        self.print('rfis.CommProcess.run: attempting to connect to MATLAB')
+        if not self.open_matlab():
+            release_lockfile(self.socket_port)
+            return False
+        self.notify.post(MSG_TYPE_COM,{'type':'log','message':'Well, here we are.'})
 
         t_delta = 0
         t_start = 0
-        t_end = time.time()
+        t_end = time.monotonic()
+        self.clock_offset = time.time()-t_end #monotonic -> wall clock
         self.print('rfis.CommProcess.run: main loop')
-        while not self.done: #pump messages over every channel
+        while not self.done: #sleep until some channel has something for us, then pump it
             t_start = t_end
-            #print('t_delta: '+str(t_delta))
-            if self.serial_port:
-                if self.mc_com: #open serial?
-                    if self.mc_com.inWaiting() >= 4:
-                        self.print('MC->',end="")
-                        self.ui_omsg.append(self.mc_com.read(4)) #add a message to be sent to UI
-                        self.print(' '.join("{:02X}".format(c) for c in self.ui_omsg[-1]))#str(self.ui_omsg[-1]))
-                    if len(self.mc_omsg):
-                        self.print('MC<-'+' '.join("{:02X}".format(c) for c in self.mc_omsg[0]))#)str(self.mc_omsg[0]))
-                        self.mc_com.write(self.mc_omsg.pop(0)) #post next message
-                else: #not open, but valid portname
-                    if self.mc_delay > 2:
-                        self.print('Serial: re-open')
-                        try:
-                            self.mc_com=serial.Serial(self.serial_port)
-                        except:
-                            self.mc_com = None
-                            #TODO: check to see that com port is still valid
-                        self.mc_delay = 0
-                    else:
-                        self.mc_delay += t_delta
-            if self.listen_sock: #can we try to re-accept?
-                if not self.api_sock or self.api_sock._closed: #do we need to re-accept?
-                    if self.cl_delay > 2:
-                        self.print('Socket: re-accept')
-                        try:
-                            self.api_sock, addr = self.listen_sock.accept()
-                            self.api_sock.settimeout(0) #WAS .2 - try 0?
-                        except OSError as e:
-                            self.api_sock = None
-                        self.cl_delay = 0
-                    else:
-                        self.cl_delay += t_delta
-                else: #have an API client
-                    recv_ok = True
-                    d = []
-                    try:
-                        d=self.api_sock.recv(4096) #get a bunch of bytes (is a larger buffer size better?)
-                    except socket.timeout as to:
-                        recv_ok = False
-                        pass #TODO: what goes here?
-                    except OSError as e:
-                        #self.print('Exception on read attempt: '+str(e))
-                        recv_ok = False
-                    #assume we have data (might have leftovers, so can't just check on reception of new bytes)
-                    #if len(api_msg_data):
-                    #    self.print('SIZE:'+str(api_msg_size)+' LEN:'+str(len(api_msg_data)))
-                    if not api_msg_size and len(api_msg_data) >= 4: #size not read yet, but have enough bytes to do it
-#                        self.print("NOT DEFINED")
-#                        self.print(str(type(api_msg_data)))
-#                        self.print(str(api_msg_data))
-                        api_msg_size=int.from_bytes(api_msg_data[0:4],'big')
-#                        self.print("DEFINED")
-                        api_msg_data = api_msg_data[4:] #keep only the data now
-#                        self.print('expecting '+str(api_msg_size)+' bytes')
-                        if len(api_msg_data) >= api_msg_size: #have a full message
-                            if api_msg_size == 4: #keep this special case for serial packets
-                                p=api_msg_data
-                                self.print('UI->'+' '.join("{:02X}".format(c) for c in p[0:4]))
-                                if chr(p[0]) in['C','D','L','M','P','R','S']: # got a message
-                                    self.mc_omsg.append(p[0:4])
-                                    api_msg_data=api_msg_data[4:] #lop off the data we just handled
-                                    api_msg_size = 0 #ready to process next bit of data
-                                elif p[0] == ord('X'):
-                                    self.print('UI: got SHUTDOWN')
-                                    self.done = True
-                                    api_msg_data = 0
-                                    api_msg_size = 0
-                                else:
-                                    self.print('WTF: '+str(p)) #ignore garbage
-                                    api_msg_data=api_msg_data[4:]
-                                    api_msg_size = 0
-                                #self.print('p[0]: '+str(p[0]))
-                                #if len(self.ui_omsg):
-                                #    self.print('UI<-'+' '.join("{:02X}".format(c) for c in self.ui_omsg[0]))#+str(self.ui_omsg[0]))
-                                #        self.api_sock.send(self.ui_omsg.pop(0))
-                            else:
-                                self.print('WHY AM I JSONING THIS: '+str(api_msg_data),str(api_msg_size))
-                                try:
-                                    self.print(str(api_msg_data[0:api_msg_size]))
-                                    jd = json.loads(api_msg_data[0:api_msg_size])
-                                except Exception as e:
-                                    self.print('Failed to decode JSON message')
-                                if jd['type'] == MSG_TYPE_SEQ:
-                                    pass
-                    if len(d): #got some bytes
-                        self.print('GOT BYTES: '+str(len(d))+' '+str(type(d)))
-                        api_msg_data += d #add to buffer
-                        self.print('HERE THEY ARE: '+str(api_msg_data)+'\n\t'+str(type(api_msg_data))+' '+str(len(api_msg_data)))
-                    elif recv_ok: #TODO: check for valid shutdown? or assume crash of some kind?
-                        self.print('UI: disconnected (0-length recv)')
-                        self.api_sock.shutdown(socket.SHUT_RDWR)
-                        self.api_sock.close()
-                        self.api_sock = None
-                        api_msg_size = 0
-                        api_msg_data = bytes()
-                            
-                    
-#                    d=[]
-#                    read=True #no exception on read
-#                    try:
-#                        #print('UI: try read')
-#                        d=self.api_sock.recv(4)
-#                    except socket.timeout as to:
-#                        #self.print('Timeout on read attempt')
-#                        read = False
-#                    except OSError as e:
-#                        self.print('Exception on read attempt'+str(dir(e))+"\n\t"+str(e.args)+' '+str(type(e.characters_written))+' '+str(e.errno)+' '+str(e.filename)+' '+str(e.filename)+' '+str(e.strerror)+' '+str(e.winerror)+' '+str(e.with_traceback)) #str(e.errno)+" "+str(e.strerror))
-#                        read = False
-#                    if len(d): #TODO: we're assuming we got 4 bytes - fix
-#                        self.print('UI->'+' '.join("{:02X}".format(c) for c in d))
-#                        if d[0] is ord('C') or d[0] is ord('L') or d[0] is ord('M') or d[0] is ord('P') or d[0] is ord('S'):
-#                        self.mc_omsg.append(d)
-#                        if d[0] == ord('X'):
-#                            self.print('UI: got SHUTDOWN')
-#                            self.done = True
-#                        else:
-#                            print('WTF: '+d) #ignore garbage
-#                        self.print('d[0]: '+str(d[0]))
-#                        if len(self.ui_omsg):
-#                            self.print('UI<-'+' '.join("{:02X}".format(c) for c in self.ui_omsg[0]))#+str(self.ui_omsg[0]))
-#                            self.api_sock.send(self.ui_omsg.pop(0))
-#                    elif read: #0 bytes
-#                        self.print('UI: disconnected (0-length recv)')
-#                        self.api_sock.shutdown(socket.SHUT_RDWR)
-#                        self.api_sock.close()
-#                        self.api_sock = None
-            else: #no listening socket
-                if self.sv_delay > 2:
-                    self.print('Socket: re-create')
-                    try:
-                        self.listen_sock = socket.socket()
-                        self.listen_sock.settimeout(0.2)
-                        self.listen_sock.bind(('localhost',self.socket_port))
-                        self.listen_sock.listen()
-                    except OSError as e:
-                        self.list_sock = None
-                    self.sv_delay = 0
-                else:
-                    self.sv_delay += t_delta
-            t_end = time.time()
+            timeout = self.service_links(t_delta)
+            t_wait = time.monotonic()
+            events = self.selector.select(timeout)
+            t_woke = time.monotonic()
+            for key, mask in events:
+                key.data(key.fileobj,mask)
+                if self.done:
+                    break
+            self.flush_symbols()
+            self.check_serial()
+            t_end = time.monotonic()
             t_delta=t_end-t_start
+            self.mx_loop.record(t_delta-(t_woke-t_wait))
+        if self.prog_thread:
+            self.prog_thread.stop()
+            self.prog_thread.join()
+        self.close_socket()
+        self.close_serial()
+        self.close_matlab()
+        if self.metrics_server:
+            self.metrics_server.close()
+            self.metrics_server = None
+        if self.metrics_dump:
+            self.dump_metrics()
+        if self.ports:
+            self.ports.unwatch(self.on_ports_changed)
+            self.ports.stop()
+            self.ports = None
+        self.selector.unregister(self.wake_r)
+        self.wake_r.close()
+        self.wake_w.close()
+        self.selector.close()
+        release_lockfile(self.socket_port)
+        return True
 
-    #TODO: asynchronous implementation using threads
-    def runX(self):
-        self.logfile.write("CommProcess.run\n")
-        self.mc_com=serial.Serial(self.serial_port)
-        self.listen_sock = socket.socket()
-        self.listen_sock.bind(('localhost', self.socket_port))
-        #self.listen_sock.setblocking(False)
-        self.listen_sock.listen() #TODO: leave blank when we can guarantee version >= 3.5
-        self.rsocks = [self.listen_sock]
-        self.wsocks = [self.listen_sock]
-        self.xsocks = [self.listen_sock]
-        while not self.done:
-            if self.mc_com:
-                if self.mc_com.inWaiting() != 0:
-                    msg=self.mc_com.read(4)
-    #        pass # handle serial messages from MC
-            [rs, ws, xs] = select.select(self.rsocks,self.wsocks,self.xsocks)
-            for s in rs: #handle all socket reads
-                if s is self.listen_sock: #new connection
-                    if self.api_sock is None: #only accept if we don't already have a connection?
-                        self.api_sock, addr = s.accept()
-                        self.rsocks.append(self.api_sock)
-                        self.wsocks.append(self.api_sock)
-                        self.xsocks.append(self.api_sock)
-                        self.logfile.write("CommProcess.run: client connected\n")
-                else: #only other possibility is the matlab/api connection
-                    msg = s.recv(1024)
-                    if msg:
-                        self.logfile.write("CommProcess.run: received data: \""+msg+"\"\n")
-                        if msg[0] is 'C' or msg[0] is 'L' or msg[0] is 'M' or msg[0] is 'P' or msg[0] is 'S':
-                            self.mc_com.write(msg) #forward packet to MC
-                        else: #TODO: check for more process-specific messages
-                            if msg[0] is 'X':
-                                self.logfile.write("CommProcess.run: shutting down...n")
-                                self.done = True
-                                #continue? TODO
-                            else:
-                                self.logfile.write("\t(invalid)\n")
-                    else: #empty message indicates closed connnection
-                        self.logfile.write("CommProcess.run: client closed connection\n")
-                        if s in self.rsocks:
-                            self.rsocks.remove(s)
-                        if s in self.wsocks:
-                            self.wsocks.remove(s)
-                        if s in self.xsocks:
-                            self.xsocks.remove(s)
-                        self.api_sock.close()
-                        self.api_sock = None
-            for s in ws: #handle all socket writes
-                pass
-            for s in xs: #handle all socket exceptions (on windows/winsock: connect failed (N/A for this, a server) or OOB data available
-                pass
-                    
-        #send serial to MC
-        #send socket to MATLAB
+
+# Client side of state subscriptions
+# Reads frames from the API socket (the comms process only writes to it
+# in reply to subscriptions and sequencer requests) and merges state
+# pushes into `state`, so API.query() is a local read. seq gaps are
+# counted in `gaps`; the process follows a lost push with a full one.
+# Anything that isn't a state push is kept in `messages`.
+class StateListener(threading.Thread):
+    def __init__(self,sock,keep=100):
+        threading.Thread.__init__(self,daemon=True)
+        self.sock = sock
+        self.dec = FrameDecoder()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock) #notified on every message, and when the connection ends
+        self.state = {} #topic -> {field:value}
+        self.seq = 0
+        self.gaps = 0
+        self.updates = 0
+        self.time = None #wall clock of the last push
+        self.messages = collections.deque(maxlen=keep) #everything but pushes, newest last (append/read under lock)
+        self.callback = None
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def get(self,topic=None):
+        with self.lock:
+            if topic is not None:
+                return dict(self.state.get(topic,{}))
+            return dict((t,dict(f)) for t, f in self.state.items())
+
+    def run(self):
+        while self.running:
+            try:
+                n = self.dec.recv_into(self.sock)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if not n:
+                break
+            try:
+                for p in self.dec.frames():
+                    self.handle(decode_message(p))
+            except ValueError: #lost framing or bad JSON, nothing more to trust
+                break
+        with self.changed:
+            self.running = False
+            self.changed.notify_all()
+
+    #newest message match(msg) is true for, waiting up to timeout seconds for one
+    #to arrive; None on timeout or if the connection ends
+    def wait_message(self,match,timeout):
+        end = time.monotonic()+timeout
+        with self.changed:
+            while True:
+                for m in reversed(self.messages):
+                    if match(m):
+                        return m
+                left = end-time.monotonic()
+                if left <= 0 or not self.running:
+                    return None
+                self.changed.wait(left)
+
+    def handle(self,msg):
+        if type(msg) != dict or msg.get('type') != 'state':
+            with self.changed:
+                self.messages.append(msg)
+                self.changed.notify_all()
+            return
+        with self.lock:
+            seq = msg['seq']
+            if self.seq and seq != self.seq+1:
+                self.gaps += 1
+            self.seq = seq
+            self.time = msg.get('time')
+            self.updates += 1
+            if msg.get('full'):
+                self.state = {}
+            for t in STATE_TOPICS:
+                if t in msg:
+                    self.state.setdefault(t,{}).update(msg[t])
+        if self.callback:
+            self.callback(msg)
+
+
+# Relay discovery
+# A running CommProcess owns rfis_<port>.lock in the temp directory:
+#   {"pid","port","version","serial_port","ready"}
+# It is locked (flock/msvcrt.locking on an fd held for the relay's life)
+# before the relay opens anything, so a second relay for the same port gives
+# up instead of fighting over the serial port, and rewritten in place with
+# "ready": true once the listen socket is up. The OS drops the lock when its
+# holder exits, however it exits, so a lock file left behind is just taken.
+_LOCK_OFFSET=1<<20 #msvcrt locks are mandatory: lock a byte past the JSON so readers still work
+_lock_fds={} #port -> fd of each lock this process holds
+
+def lockfile_path(port):
+    import tempfile
+    return os.path.join(tempfile.gettempdir(),'rfis_'+str(port)+'.lock')
+
+#lock contents, None if there's no (readable) lock
+def read_lockfile(port):
+    try:
+        with open(lockfile_path(port)) as fp:
+            info = json.load(fp)
+    except (OSError,ValueError):
+        return None
+    return info if type(info) == dict else None
+
+#False if another process holds the lock
+def acquire_lockfile(port,info):
+    port = str(port)
+    if port in _lock_fds:
+        update_lockfile(port,info)
+        return True
+    path = lockfile_path(port)
+    while True:
+        fd = os.open(path,os.O_RDWR|os.O_CREAT,0o644)
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                os.lseek(fd,_LOCK_OFFSET,os.SEEK_SET)
+                msvcrt.locking(fd,msvcrt.LK_NBLCK,1)
+            else:
+                import fcntl
+                fcntl.flock(fd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        try: #the last holder may have unlinked it between our open and lock
+            same = os.name == 'nt' or os.stat(path).st_ino == os.fstat(fd).st_ino
+        except OSError:
+            same = False
+        if same:
+            break
+        os.close(fd)
+    _lock_fds[port] = fd
+    update_lockfile(port,info)
+    return True
+
+#rewritten through the held fd: replacing the file would leave the lock on an orphan
+def update_lockfile(port,info):
+    fd = _lock_fds.get(str(port))
+    if fd is None:
+        return
+    data = json.dumps(info).encode()
+    os.lseek(fd,0,os.SEEK_SET)
+    os.write(fd,data)
+    os.ftruncate(fd,len(data))
+
+def release_lockfile(port):
+    port = str(port)
+    fd = _lock_fds.pop(port,None)
+    if fd is None:
+        return
+    path = lockfile_path(port)
+    if os.name == 'nt': #can't remove an open file; whoever locks it next just rewrites it
+        os.close(fd)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return
+    try: #unlink while still locked so nobody can lock the name we're removing
+        os.remove(path)
+    except OSError:
+        pass
+    os.close(fd)
+
+#locks of every relay that's still running
+def find_relays():
+    import tempfile
+    out = []
+    try:
+        names = os.listdir(tempfile.gettempdir())
+    except OSError:
+        return out
+    for name in names:
+        if name.startswith('rfis_') and name.endswith('.lock'):
+            info = read_lockfile(name[5:-5])
+            if info and _pid_alive(info.get('pid')):
+                out.append(info)
+    return out
+
+def _pid_alive(pid):
+    if type(pid) != int or pid <= 0:
+        return False
+    if os.name == 'nt':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x00100000|0x1000,False,pid) #SYNCHRONIZE|PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        try:
+            return kernel32.WaitForSingleObject(handle,0) == 0x102 #WAIT_TIMEOUT: still running
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: #exists, someone else's
+        return True
+    except OSError:
+        return False
+    return True
+
+#interpreter to run the relay with (inside MATLAB sys.executable is MATLAB itself)
+def _python_executable():
+    for exe in (getattr(sys,'_base_executable',None),sys.executable):
+        if exe and os.path.basename(exe).lower().startswith('python'):
+            return exe
+    return 'python'
 
 
 # API implementation
@@ -614,76 +4941,124 @@ class API:
     def __init__(self,serial_port=SERIAL_PORT_DEFAULT,socket_port=SOCKET_PORT_DEFAULT):
         self.serial_port=serial_port
         self.socket_port=socket_port
-        self.serial_ports=[]
+        self.serial_ports=[] #last detect_serial_ports() result
         self.socket=None #value indicates connection state (None = no connection)
         self.process=None
+        self.prog_thread=None
         self.send_lock=False
+        self.verbose=True #debug printing in send() (can also be turned off per call)
+        self.listener=None #StateListener, once subscribed
+        self.client_id=None #from the relay's hello
+        self.role=None
+        self.request_id=0 #matches replies to requests (ex. metrics())
+        self.binary=False #control messages in msgpack rather than JSON (see encode_message())
         #WHY SOCKETS: how to re-acquire stdin/stdout of process if matlab crashes? easy to get channel if a socket
 
     def __del__(self):
         print('rfis.API.__del__')
         self.shutdown(True)
 
-    def detect_serial_ports(self):
-        ports = list_ports.comports()
-        for port, desc, addr in ports:
-            self.serial_ports.append((port,desc,addr))
+    #(port, desc, addr) for each serial port, KL25Zs first; answered from the
+    #shared PortRegistry's cache (refresh=True waits for a new scan)
+    def detect_serial_ports(self,refresh=False):
+        ports = port_registry().refresh(True) if refresh else port_registry().get()
+        self.serial_ports = [(p.device,p.description,p.hwid) for p in ports or []]
         return self.serial_ports
 
+    #port names of the plugged in KL25Zs (by USB VID/PID)
+    def find_kl25z(self):
+        return [p.device for p in port_registry().kl25z()]
+
     #NOTE: do not call connect if this api instance isn't in MATLAB
-    def connect(self,serial_port=None,socket_port=None):
+    #Connects to the relay serving socket_port, starting one if none is
+    #running (per its lockfile), retrying with exponential backoff until
+    #it answers, then checks its hello: protocol version and our role.
+    def connect(self,serial_port=None,socket_port=None,timeout=CONNECT_TIMEOUT):
         if serial_port is not None:
             self.serial_port = serial_port
         if socket_port is not None:
             self.socket_port = socket_port
-        #TODO: see if process is running by checking process list/args
-        #attempt connection to process:
-        if not self.socket:
-            print("1 rfis.API.connect: no socket")
-            try:
-                self.socket=socket.socket()
-            except OSError as e:
-                self.socket = None
-                print("2 rfis.API.connect: failed to create socket: "+e.strerror)
-                return False
-            self.socket.settimeout(0.2)
-        try:
-            print("3 "+str(self.socket_port))
-            self.socket.connect(('localhost',self.socket_port))
-        except socket.timeout as e:
-            print("3 rfis.API.connect: connect timed out")
-        except OSError as e:
-            print("3 rfis.API.connect: failed to connect to communications process: "+e.strerror)
-            self.socket.close()
-            self.socket=None
-        else:
+        if self.socket:
             return True
-        if not self.process:
-            #not running or can't connect, start new process
-            print("4 rfis.API.connect: attempting to launch new process")
-            self.process=subprocess.Popen(["python", "-m", "rfis", ">", "debug.txt"])#),shell=True)#,stdout=subprocess.PIPE)
-            if not self.process:
-                print("5 rfis.API.connect: failed to open process")
-                self.process=None
+        deadline = time.monotonic()+timeout
+        sock = self.try_connect()
+        if not sock:
+            lock = read_lockfile(self.socket_port)
+            if lock and _pid_alive(lock.get('pid')):
+                print('rfis.API.connect: waiting for relay '+str(lock['pid']))
+            elif not self.spawn():
                 return False
-        if not self.socket:
-            print("6 rfis.API.connect: no socket")
-            try:
-                self.socket=socket.socket()
-                #self.socket.setblocking(False)
-            except OSError as e:
-                self.socket = None
-                print("7 rfis.API.connect: failed to create socket: "+e.strerror)
+        delay = CONNECT_BACKOFF_MIN
+        while not sock:
+            if self.process and self.process.poll() is not None:
+                #it quit: lost a race with another relay (which we'll find), or failed
+                lock = read_lockfile(self.socket_port)
+                if not (lock and _pid_alive(lock.get('pid'))):
+                    print('rfis.API.connect: relay exited with code '+str(self.process.returncode)+' (see debug.txt)')
+                    self.process = None
+                    return False
+                self.process = None
+            if time.monotonic()+delay > deadline:
+                print('rfis.API.connect: no relay on port '+str(self.socket_port)+' after '+str(timeout)+' s')
                 return False
-            self.socket.settimeout(0.2)
+            time.sleep(delay)
+            delay = min(delay*2,CONNECT_BACKOFF_MAX)
+            sock = self.try_connect()
+        hello = self.handshake(sock)
+        if not hello:
+            sock.close()
+            return False
+        sock.settimeout(0.2)
+        self.socket = sock
+        print('rfis.API.connect: connected to relay '+str(hello.get('pid'))+' as '+str(hello.get('role')))
+        return True
+
+    def try_connect(self):
+        try:
+            return socket.create_connection(('localhost',self.socket_port),timeout=HELLO_TIMEOUT)
+        except OSError:
+            return None
+
+    #start a relay for our ports, output in debug.txt
+    def spawn(self):
+        import subprocess
+        args = [_python_executable(),'-u',os.path.abspath(__file__),
+                '--serial-port',str(self.serial_port),'--socket-port',str(self.socket_port)]
+        print('rfis.API.connect: starting relay: '+' '.join(args))
         try:
-            print("8 "+str(self.socket_port))
-            self.socket.connect(('localhost',self.socket_port))
+            with open('debug.txt','ab') as out:
+                self.process = subprocess.Popen(args,stdout=out,stderr=subprocess.STDOUT)
         except OSError as e:
-            print("8 rfis.API.connect: failed to connect to communications process: "+e.strerror)
-        print("9 rfis.API.connect: success")
+            print('rfis.API.connect: failed to start relay: '+str(e))
+            self.process = None
+            return False
         return True
 
+    #first frame from the relay: {"type":"hello","client","role","version","pid"}
+    def handshake(self,sock):
+        dec = FrameDecoder(1024)
+        end = time.monotonic()+HELLO_TIMEOUT
+        try:
+            while time.monotonic() < end:
+                sock.settimeout(max(end-time.monotonic(),0.001))
+                if not dec.recv_into(sock,1024):
+                    break
+                for p in dec.frames():
+                    hello = decode_message(p)
+                    if type(hello) != dict or hello.get('type') != 'hello':
+                        break
+                    if hello.get('version') != PROTOCOL_VERSION:
+                        print('rfis.API.connect: relay speaks protocol '+str(hello.get('version'))+', need '+str(PROTOCOL_VERSION))
+                        return None
+                    self.client_id = hello.get('client')
+                    self.role = hello.get('role')
+                    return hello
+        except (OSError,ValueError) as e:
+            print('rfis.API.connect: handshake failed: '+str(e))
+            return None
+        print('rfis.API.connect: no hello from relay')
+        return None
+
     #DO NOT USE
     def status(self):
         if self.socket:
@@ -726,125 +5101,155 @@ class API:
             return self.msgs.pop(0)
         return None
 
-    def query(self):
-        pass #get state
+    #latest state pushed by the comms process (see subscribe()), no round trip
+    #topic - one of STATE_TOPICS, None for {topic:{field:value}} of all subscribed topics
+    def query(self,topic=None):
+        if not self.listener:
+            print('rfis.API.query: not subscribed')
+            return None
+        return self.listener.get(topic)
+
+    #ask the comms process to push state changes, at most `rate` times a second
+    #topics - list of STATE_TOPICS (or a single name), None for all
+    #callback - optional, called (from the listener thread) with each push as a dict
+    def subscribe(self,topics=None,rate=STATE_DEFAULT_RATE,callback=None):
+        if not self.socket:
+            print('rfis.API.subscribe: no socket')
+            return False
+        if type(topics) == str:
+            topics = [topics]
+        if not self.listener:
+            self.listener = StateListener(self.socket)
+            self.listener.start()
+        self.listener.callback = callback
+        return self.control({'type':MSG_TYPE_API,'command':'subscribe','topics':list(topics or STATE_TOPICS),'rate':rate})
+
+    #role - ROLE_CONTROLLER or ROLE_OBSERVER; the first client to connect controls,
+    #later ones watch until they ask (force takes control from the current controller)
+    def set_role(self,role,force=False):
+        return self.control({'type':MSG_TYPE_API,'command':'role','role':role,'force':bool(force)})
+
+    #the relay's counters and latency percentiles (see Metrics.snapshot()), None if it doesn't answer
+    def metrics(self,timeout=1):
+        reply = self.request({'type':MSG_TYPE_API,'command':'metrics'},'metrics',timeout)
+        return reply.get('metrics') if reply else None
+
+    #send msg tagged with a fresh id and wait for the relay's reply of type reply_type, None if it doesn't answer
+    def request(self,msg,reply_type,timeout=1):
+        if not self.socket:
+            print('rfis.API.request: no socket')
+            return None
+        if not self.listener: #replies come back through it
+            self.listener = StateListener(self.socket)
+            self.listener.start()
+        self.request_id += 1
+        rid = msg['id'] = self.request_id
+        if not self.control(msg):
+            return None
+        return self.listener.wait_message(lambda m: type(m) == dict and m.get('type') == reply_type and m.get('id') == rid,timeout)
+
+    def unsubscribe(self):
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        return self.control({'type':MSG_TYPE_API,'command':'unsubscribe'})
 
     def shutdown(self,safe=None):
         print('API shutdown')
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
         if self.socket:
             #TODO: check for safe shutdown vs crash (only send shutdown to process if GUI shuts down cleanly)
             print('\tsending shutdown and closing socket')
-            self.socket.send(b'{"type":"message","message":"shutdown"}')
-            time.sleep(1) #give it a second to think
-            self.socket.shutdown(socket.SHUT_RDWR)
+            try: #only the controller's is honoured; the relay closes us either way once it's done
+                self.socket.sendall(_PACKET_FRAME_HEADER+encode_shutdown())
+                self.socket.shutdown(socket.SHUT_WR)
+                self.socket.settimeout(API_SHUTDOWN_TIMEOUT)
+                while self.socket.recv(65536): #drain until the relay hangs up
+                    pass
+            except OSError:
+                pass
             self.socket.close()
             self.socket=None
 
 # Message filters - --  -- -  - 
-    def msg_calibrate(self,motor):
+    def blocked(self,name):
         if self.prog_thread:
-            print('rfis.API.calibrate: blocked by active program')
+            print('rfis.API.'+name+': blocked by active program')
+            return True
+        return False
+
+    def msg_calibrate(self,motor):
+        if self.blocked('calibrate'):
             return False
-        if ord(motor) < ord('1') or ord(motor) > ord('5'):
-            print('rfis.API.calibrate: invalid motor number')
+        try:
+            return self.send(encode_calibrate(motor))
+        except ValueError as e:
+            print('rfis.API.calibrate: '+str(e))
             return False
-#        return ([b'C',motor,b'\x00',b'\x00'])
-        return b'["C"]'
 
     def msg_delay(self,motor,delay):
-        if self.prog_thread:
-            print('rfis.API.calibrate: blocked by active program')
+        if self.blocked('delay'):
             return False
-        if ord(motor) < ord('1') or ord(motor) > ord('5'):
-            print('rfis.API.delay: invalid motor number')
+        try:
+            return self.send(encode_delay(motor,delay))
+        except ValueError as e:
+            print('rfis.API.delay: '+str(e))
             return False
-#        return self.send([b'D',motor,(delay>>8)&0xff,delay&0xff])
-        return b'["M"]'
 
     # lightnum 0-16, rgb tuple of 3 bytes
     def msg_light(self,lightnum,rgb):
-        if self.prog_thread:
-            print('rfis.API.calibrate: blocked by active program')
+        if self.blocked('light'):
             return False
-        if lightnum < 0 or lightnum > 16:
-            print('rfis.API.light: invalid light number')
+        try:
+            return self.send(encode_light(lightnum,rgb))
+        except ValueError as e:
+            print('rfis.API.light: '+str(e))
             return False
-        print((bytearray([ord('L'), (lightnum<<2)&0xfc|((rgb[0]>>6)&3), (rgb[2]>>2)&0xff, rgb[2]&0xcf])))
-        return self.send((bytearray([ord('L'), (lightnum<<2)&0xfc|((rgb[0]>>6)&3), (rgb[2]>>2)&0xff, rgb[2]&0xcf]))) #TODO: review
 
     def msg_move(self,motor,steps):
-        if self.prog_thread:
-            print('rfis.API.calibrate: blocked by active program')
+        if self.blocked('move'):
             return False
-        if motor < '1' or motor > '5':
-            print('rfis.API.move: invalid motor number')
+        try:
+            return self.send(encode_move(motor,steps))
+        except ValueError as e:
+            print('rfis.API.move: '+str(e))
             return False
-        if steps > 0:
-            sign=0
-        else:
-            sign=0x80
-            steps = -steps
-        return self.send([b'M', motor, ((steps>>8)&0xff)|sign, steps&0xff])#b'M'+bytes(motor,'utf-8')+((steps>>8)&0xff00).to_bytes(1))
 
     def msg_pin(self,pin,state):
-        if self.prog_thread:
-            print('rfis.API.calibrate: blocked by active program')
+        if self.blocked('pin'):
             return False
-        if pin < '0' or pin > '2':
-            print('rfis.API.pin: invalid function number')
+        try:
+            return self.send(encode_pin(pin,state))
+        except ValueError as e:
+            print('rfis.API.pin: '+str(e))
             return False
-        #TODO: validate pin and state
-#        return self.send([b'P',pinbytes(state,'utf-8'),b'\x00'])
-        return [b"P",pin&0xff]
 
     def msg_reset(self):
-        if self.prog_thread:
-            print('rfis.API.calibrate: blocked by active program')
+        if self.blocked('reset'):
             return False
-        #return self.send(bytes([b'R',b'\x00',b'\x00',b'\x00']))
-        return b'["R"]'
+        return self.send(encode_reset())
 
-    def msg_stop(self):
-        if self.prog_thread:
-            print('rfis.API.calibrate: blocked by active program')
-            return False
-        #return bytes([b'S',b'\x00',b'\x00',b'\x00'])
-        return b'["S"]'
+    def msg_stop(self): #never blocked - stopping is always allowed
+        return self.send(encode_stop())
 
 # End message filters - - - - - - 
 
-    def send(self,rawmsg): #sends string of bytes, no 4-byte enforcement (just checks that bytes are sent by comparing rawmsg list size to num bytes sent by socket.send)
-        #This is all really gross, but this is what i get for trying to redesign internal communications at 4:42am the morning of design day
-        print('rfis.API.send: '+str(rawmsg))
-        msglen = len(rawmsg)&0xffffffff
-        print('MSGLEN: '+str(msglen))
-        msg=[(msglen>>24)&0xff,(msglen>>16)&0xff,(msglen>>8)&0xff,msglen&0xff]
-        print('LEN: '+str(msg))
-        msg.append(rawmsg)
-        print('LEN+MSG: '+str(msg))
-        outmsg=[]
-        for ii in range(len(msg)):
-            if type(msg[ii]) == str or type(msg[ii]) == bytes:
-                for jj in range(len(msg[ii])):
-                    print(msg[ii][jj])
-                    outmsg.append(ord(msg[ii][jj]))
-            else:
-                outmsg.append(msg[ii])
-        print('OUTMSG: '+str(outmsg))
-        msg=outmsg
-        if self.socket:
-            print('rfis.API.send: attempting')
+    #sends one message (a serial packet, or JSON for the process), prefixed with its size
+    #rawmsg - bytes, str of byte-valued chars, or a list of those and ints
+    #verbose - override self.verbose for this call
+    def send(self,rawmsg,verbose=None):
+        if type(rawmsg) == str and len(rawmsg) == 4: #a packet from MATLAB, the common case
+            msg = _PACKET_FRAME_HEADER+rawmsg.encode('latin-1')
+        else:
+            msg = frame(to_bytes(rawmsg))
+        if verbose or (verbose is None and self.verbose):
+            print('rfis.API.send: '+' '.join("{:02X}".format(c) for c in msg))
+        sock = self.socket
+        if sock:
             try:
-                n=self.socket.send(bytearray(msg))
-                if n is not len(msg):
-                    print('rfis.API.send: sent only '+n+' of '+str(len(msg))+' bytes')
-                    return False
-                #n=self.socket.send(ord(rawmsg[0]).to_bytes(1,sys.byteorder)+ord(rawmsg[1]).to_bytes(1,sys.byteorder)+ord(rawmsg[2]).to_bytes(1,sys.byteorder)+ord(rawmsg[3]).to_bytes(1,sys.byteorder))#bytes(rawmsg[0],'ascii')+bytes(rawmsg[1],'ascii')+bytes(rawmsg[2],'ascii')+bytes(rawmsg[3],'ascii'))
-#                if n is not len(rawmsg):
-#                    print(type(rawmsg),type(n))
-#                    print('rfis.API.send: sent only '+n+' of '+str(len(rawmsg))+'bytes')
-#                    return False
-                print('rfis.API.send: success')
+                sock.sendall(msg)
                 return True
             except Exception as e:
                 print('rfis.API.send: exception: '+str(e))
@@ -852,76 +5257,171 @@ class API:
         print('rfis.API.send: no socket')
         return False
 
-    #sends json message containing symbols and their values to be defined/updated
-    def set_symbols(self,symbols):
-        #create message
+    #sends a control message (dict), JSON or msgpack per self.binary
+    def control(self,msg):
+        data = encode_message(msg,self.binary)
+        if self.verbose:
+            print('rfis.API.control: '+str(msg.get('command'))+', '+str(len(data))+' bytes')
+        return self.send(data,False)
+
+    #sends many messages with a single syscall (ex. every move of a stage scan)
+    #msgs - iterable of anything send() accepts
+    def send_batch(self,msgs,verbose=False):
+        out=[]
+        for m in msgs:
+            m=to_bytes(m)
+            out.append(_FRAME_HEADER.pack(len(m)))
+            out.append(m)
+        if verbose:
+            print('rfis.API.send_batch: '+str(len(out)//2)+' messages')
         if self.socket:
             try:
-                n=self.socket.send(symbols)
+                self.socket.sendall(b''.join(out))
                 return True
-            except:
-                pass
+            except Exception as e:
+                print('rfis.API.send_batch: exception: '+str(e))
                 return False
+        print('rfis.API.send_batch: no socket')
+        return False
 
-    #sends json message requesting specified symbol defs to comm process
-    def get_symbols(self,symbols):
-        #create message {"type"
-        if self.socket:
+    #defines/updates symbols for programs; any number in one message, applied together
+    #symbols - dict, or JSON object string (from MATLAB's jsonencode)
+    #persist - the relay keeps these across restarts (ex. calibrated positions)
+    def set_symbols(self,symbols,persist=False):
+        if type(symbols) == str:
             try:
-                n=self.socket.send(symbols)
-                return True
-            except:
-                pass
+                symbols = json.loads(symbols)
+            except ValueError as e:
+                print('rfis.API.set_symbols: '+str(e))
                 return False
+        msg = {'type':MSG_TYPE_SEQ,'command':'symbols','symbols':dict(symbols)}
+        if persist:
+            msg['persist'] = True
+        return self.control(msg)
+
+    #{name:value} of the relay's symbols, None if it doesn't answer
+    #symbols - list of names (or a single name), None for all; unknown names are left out
+    def get_symbols(self,symbols=None,timeout=1):
+        if type(symbols) == str:
+            symbols = [symbols]
+        msg = {'type':MSG_TYPE_SEQ,'command':'get_symbols'}
+        if symbols is not None:
+            msg['names'] = list(symbols)
+        reply = self.request(msg,'symbols',timeout)
+        return reply.get('symbols') if reply else None
 
     #upload a string (or specify a file) for the process to execute as a sequencing program
-    #prog - filename or json string
+    #prog - filename, json string of the commands, or a whole program (list)
+    #Programs go as JSON text either way: the relay passes the string on
+    #untouched and the program's own thread parses and compiles it.
     #isfile - boolean indicating whether prog represents a file name or json
     #override - abort any running program
     #returns sending success (nothing about validity of program)
-    def do_program(self,prog,isfile,override): #spawns a thread on the process to execute the given action sequence, blocking other UI->MC commands
-        print('do_program: '+str(prog))
-        if isfile:
-            return False # not implemented yet
+    def do_program(self,prog,isfile,override,autostep=True): #spawns a thread on the process to execute the given action sequence, blocking other UI->MC commands
+        print('do_program: '+str(prog)[:LOG_MSG_PREVIEW])
+        if isfile: #name from the catalog, already compiled by the comms process
+            return self.control({'type':MSG_TYPE_SEQ,'command':'run','name':prog,'override':bool(override),'autostep':bool(autostep)})
+        if type(prog) == str: #MATLAB's program box holds just the commands - wrap them with empty metadata
+            prog = '[{},'+prog+']'
         else:
-            wrap = [ord('['),ord('{'),ord('}'),ord(',')]
-            for ii in range(len(prog)):
-                wrap.append(ord(prog[ii]))
-            wrap.append(ord(']'))
-            print('RESULT: '+str(wrap))
-            bytearray(wrap)
-        if self.socket:
-            try:
-                n=self.socket.send(bytearray(wrap))
-            except Exception as e:
-                print('rfis.API.do_program: failed to send program: '+str(e))
-                return False
-        return True
-        #purge incoming messages before starting (after every command, listen for response?)
-        #passing None (null) in prog stops active program
-        #if self.prog_thread:
-        #    if self.prog_thread.running:
-        #        if not override: #program not active?
-        #            print('rfis.API.do_program: blocked by active program with override disabled')
-        #            return False
-        #        else:
-        #            pass
-        #            #stop program
-        #else:
-        #    self.prog_thread = ProgramThread()
-        #ret=self.prog_thread.load(prog,isfile)
-        #if not ret(0):
-        #    print('rfis.API.do_program: failed to load \"'+prog+'.json')
-        #    return ret
-        #try:
-        #    self.prog_thread.start()
-        #except:
-        #    return False
-        #return True
+            prog = json.dumps(prog)
+        return self.control({'type':MSG_TYPE_SEQ,'command':'run','program':prog,'override':bool(override),'autostep':bool(autostep)})
+
+    #stop the running program (motors aren't stopped, use msg_stop() too for that)
+    def stop_program(self):
+        return self.control({'type':MSG_TYPE_SEQ,'command':'stop'})
 
+    #unattended run of count specimen cycles, each running the catalog programs in stages in turn
+    #(see BatchScheduler); returns the relay's report (with "error" if it refused), None if no answer
+    #tray_size - specimens per tray, the batch waits for batch('tray') after each (0: one tray)
+    #symbols - set before every stage; specimens - optional list of per-specimen {symbol:value}
+    #on_error - "pause" (resume re-runs the failed stage) or "skip" (on to the next specimen)
+    #autoresume - after a relay restart carry on by itself instead of waiting for batch('resume')
+    def start_batch(self,stages,count=None,tray_size=0,symbols=None,specimens=None,on_error='pause',autoresume=False,name=None,timeout=1):
+        if type(stages) == str:
+            stages = [stages]
+        msg = {'type':MSG_TYPE_SEQ,'command':'batch','action':'start','stages':list(stages),'tray_size':int(tray_size),
+               'symbols':dict(symbols or {}),'on_error':on_error,'autoresume':bool(autoresume)}
+        if count is not None:
+            msg['count'] = int(count)
+        if specimens is not None:
+            msg['specimens'] = [dict(s) for s in specimens]
+        if name:
+            msg['name'] = str(name)
+        return self.request(msg,'batch',timeout)
 
+    #action - "status", "pause", "resume", "tray" (next tray loaded), "skip" (current specimen) or "cancel"
+    #returns the batch report (with "error" if the action didn't apply), None if no answer
+    def batch(self,action='status',timeout=1):
+        return self.request({'type':MSG_TYPE_SEQ,'command':'batch','action':action},'batch',timeout)
 
 
+#command line for the comms process, ex. a hardware-free relay:
+#  python -m rfis --serial-port sim --no-matlab
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='rfis',description='RFIS communication process')
+    parser.add_argument('--serial-port',default=SERIAL_PORT_DEFAULT,help='serial port, "auto" (first KL25Z), or "sim", "pty" or "loop" (see open_transport())')
+    parser.add_argument('--socket-port',type=int,default=None,help='default %d (%d for --replay)' % (SOCKET_PORT_DEFAULT,SOCKET_PORT_DEFAULT+1))
+    parser.add_argument('--no-matlab',action='store_true',help="don't connect to MATLAB, print notifications instead")
+    parser.add_argument('--log',default='',help='channel levels, ex. "mc=debug,ui=debug"')
+    parser.add_argument('--trace',default=None,nargs='?',const=RFIS_TRACE_LOG,help='capture all relay traffic to a binary trace')
+    parser.add_argument('--metrics-port',type=int,default=None,help='serve Prometheus metrics on http://localhost:PORT/metrics')
+    parser.add_argument('--metrics-dump',metavar='FILE',default=None,help='append a JSON metrics snapshot every %d s' % METRICS_DUMP_INTERVAL)
+    parser.add_argument('--dump',metavar='TRACE',help='print a binary trace and exit')
+    parser.add_argument('--replay',metavar='TRACE',help='run a binary trace through a relay in this process and exit')
+    parser.add_argument('--speed',type=float,default=1.0,help='replay speed, 0 for as fast as possible')
+    parser.add_argument('--resync',default=RESYNC_AUTO,choices=(RESYNC_AUTO,RESYNC_REPLAY,RESYNC_ABORT),
+                        help='queued commands after a serial reconnect: replay, abort, or auto (replay after short outages)')
+    parser.add_argument('--symbols',metavar='FILE',default=RFIS_SYMBOLS_FILE,help='persistent symbols (calibrated positions), "" to not keep any')
+    parser.add_argument('--tx-gap',type=float,default=SERIAL_TX_GAP,help='least seconds between packets to the microcontroller (default %g)' % SERIAL_TX_GAP)
+    parser.add_argument('--batch-journal',metavar='FILE',default=RFIS_BATCH_JOURNAL,help='batch run progress, resumed after a restart ("" to not keep it)')
+    parser.add_argument('--list-ports',action='store_true',help='list serial ports (KL25Zs marked) and exit')
+    parser.add_argument('--dry-run',metavar='PROGRAM',help='print estimated cycle times for a program (catalog name or .json file) and exit')
+    args, extra = parser.parse_known_args(argv) #tolerate leftovers from older launchers
+    if args.dump:
+        with TraceReader(args.dump) as reader:
+            reader.dump()
+        return 0
+    if args.replay:
+        with TraceReader(args.replay) as reader:
+            records = list(reader.records())
+        report = TraceReplayer(records,args.speed,args.socket_port or SOCKET_PORT_DEFAULT+1).run()
+        print(json.dumps(report,indent=1))
+        return 0 if not report.get('error') and not report['mismatches'] else 1
+    if args.list_ports:
+        for p in scan_serial_ports():
+            print(('* ' if p.kl25z else '  ')+p.device+'  '+str(p.description)+'  '+str(p.hwid))
+        return 0
+    if args.dry_run:
+        if os.path.isfile(args.dry_run):
+            with open(args.dry_run) as fp:
+                name = os.path.splitext(os.path.basename(args.dry_run))[0]
+                program = compile_program(json.load(fp),name)
+        else:
+            cache = ProgramCache()
+            cache.refresh()
+            program = cache.get(args.dry_run)
+            if not program:
+                print('program "'+args.dry_run+'" unavailable')
+                return 1
+        symbols = SymbolTable()
+        if args.symbols:
+            symbols.load(args.symbols)
+        print(dry_run_report(program,symbols=dict(symbols.snapshot.values)))
+        return 0
+    ok = CommProcess(args.serial_port,args.socket_port or SOCKET_PORT_DEFAULT,
+                     log_levels=parse_log_levels(args.log),
+                     trace=args.trace,
+                     notify_sink=LocalSink(echo=True) if args.no_matlab else None,
+                     resync_policy=args.resync,
+                     metrics_port=args.metrics_port,
+                     metrics_dump=args.metrics_dump,
+                     symbols_file=args.symbols or None,
+                     batch_journal=args.batch_journal or None,
+                     tx_gap=args.tx_gap).run()
+    return 0 if ok else 1
+
 #api runs this module as a script (in api.connect()) to start the comms process
 if __name__ == '__main__':
-    CommProcess().run()
+    sys.exit(main())
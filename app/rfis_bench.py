@@ -0,0 +1,505 @@
+# rfis_bench.py
+# Benchmarks for the Python side of the Robotic Foram Imaging System
+#
+# Run from the app directory:
+#   python rfis_bench.py <benchmark> [options]
+#
+# Each benchmark prints a short human-readable summary. Nothing here
+# needs the rig (or MATLAB).
+#
+# "suite" runs the API -> relay -> serial benchmarks against a simulated
+# KL25Z in this process and can save its results as JSON (--json) or
+# compare them with a saved baseline (--baseline, exit status 1 on a
+# regression):
+#   python rfis_bench.py suite --json baseline.json
+#   python rfis_bench.py suite --baseline baseline.json
+
+import argparse
+import collections
+import contextlib
+import json
+import os
+import platform
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import rfis
+
+
+#reference: the parser CommProcess.run() used before FrameDecoder
+#(bytes concatenation and re-slicing, one frame per pass)
+def legacy_parse(chunks):
+    count = 0
+    data = bytes()
+    size = 0
+    for d in chunks:
+        data += d
+        while True:
+            if not size:
+                if len(data) < 4:
+                    break
+                size = int.from_bytes(data[0:4],'big')
+                data = data[4:]
+            if len(data) < size:
+                break
+            p = data[0:size]
+            data = data[size:]
+            size = 0
+            count += 1
+    return count
+
+
+def decoder_parse(chunks):
+    count = 0
+    dec = rfis.FrameDecoder()
+    for d in chunks:
+        dec.feed(d)
+        for p in dec.frames():
+            count += 1
+    return count
+
+
+#mixed stream: mostly 4-byte motor packets with the odd JSON control message,
+#cut into chunks the way recv() would hand them over
+def make_stream(megabytes,json_ratio,chunk,seed):
+    rnd = random.Random(seed)
+    frames = []
+    total = 0
+    njson = 0
+    while total < megabytes*1024*1024:
+        if rnd.random() < json_ratio:
+            body = json.dumps({'type':rfis.MSG_TYPE_SEQ,'command':'syms','symbols':{'FORAM_PRESENT':rnd.randint(0,1)}}).encode()
+            njson += 1
+        else:
+            body = struct.pack('>cBH',b'M',ord('1')+rnd.randrange(rfis.MOTOR_COUNT),rnd.randrange(65536))
+        frames.append(len(body).to_bytes(4,'big')+body)
+        total += len(frames[-1])
+    stream = b''.join(frames)
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        n = rnd.randint(1,chunk)
+        chunks.append(stream[pos:pos+n])
+        pos += n
+    return chunks, len(frames), njson, len(stream)
+
+
+def bench_decoder(args):
+    chunks, nframes, njson, nbytes = make_stream(args.megabytes,args.json_ratio,args.chunk,args.seed)
+    print('stream: %.1f MB, %d frames (%d JSON), %d chunks' % (nbytes/1048576,nframes,njson,len(chunks)))
+    parsers = [('FrameDecoder',decoder_parse)]
+    if not args.skip_legacy:
+        parsers.append(('legacy',legacy_parse))
+    for name, parse in parsers:
+        best = None
+        for ii in range(args.repeat):
+            t0 = time.perf_counter()
+            count = parse(chunks)
+            t = time.perf_counter()-t0
+            best = t if best is None else min(best,t)
+        if count != nframes:
+            print(name+': decoded '+str(count)+' of '+str(nframes)+' frames')
+            return 1
+        print('%-14s %8.3f s %8.1f MB/s %10.0f frames/s' % (name,best,nbytes/1048576/best,nframes/best))
+    return 0
+
+
+#reference: API.send() before the struct encoder (list building, per-byte
+#ord() and printing, one socket.send per message)
+def legacy_send(sock,rawmsg):
+    msglen = len(rawmsg)&0xffffffff
+    print('MSGLEN: '+str(msglen))
+    msg=[(msglen>>24)&0xff,(msglen>>16)&0xff,(msglen>>8)&0xff,msglen&0xff]
+    msg.append(rawmsg)
+    print('LEN+MSG: '+str(msg))
+    outmsg=[]
+    for ii in range(len(msg)):
+        if type(msg[ii]) == str or type(msg[ii]) == bytes:
+            for jj in range(len(msg[ii])):
+                print(msg[ii][jj])
+                outmsg.append(ord(msg[ii][jj]))
+        else:
+            outmsg.append(msg[ii])
+    print('OUTMSG: '+str(outmsg))
+    n=sock.send(bytearray(outmsg))
+    return n == len(outmsg)
+
+
+#counts bytes arriving at the far end of the API socket
+class Drain(threading.Thread):
+    def __init__(self,sock):
+        threading.Thread.__init__(self,daemon=True)
+        self.sock = sock
+        self.count = 0
+
+    def run(self):
+        while True:
+            try:
+                d = self.sock.recv(65536)
+            except OSError: #closed under us
+                break
+            if not d:
+                break
+            self.count += len(d)
+
+
+def bench_send(args):
+    #what MATLAB hands over for a move: a char array
+    packets = [chr(ord('M'))+chr(ord('1')+ii%rfis.MOTOR_COUNT)+chr(ii>>8&0x7f)+chr(ii&0xff) for ii in range(args.packets)]
+    api = rfis.API()
+    api.verbose = False
+    variants = [('legacy send',lambda s: [legacy_send(s,p) for p in packets]),
+                ('send',lambda s: [api.send(p) for p in packets]),
+                ('send_batch',lambda s: api.send_batch(packets))]
+    devnull = open(os.devnull,'w')
+    base = None
+    for name, fn in variants:
+        a, b = socket.socketpair()
+        drain = Drain(b)
+        drain.start()
+        api.socket = a
+        with contextlib.redirect_stdout(devnull):
+            t0 = time.perf_counter()
+            fn(a)
+            t = time.perf_counter()-t0
+        a.shutdown(socket.SHUT_WR)
+        drain.join()
+        api.socket = None
+        a.close()
+        b.close()
+        if drain.count != 8*len(packets):
+            print(name+': received '+str(drain.count)+' of '+str(8*len(packets))+' bytes')
+            return 1
+        rate = len(packets)/t
+        base = base or rate
+        print('%-12s %10.0f packets/s %6.1fx' % (name,rate,rate/base))
+    devnull.close()
+    return 0
+
+
+#modules `import rfis` must not load (the relay's dependencies, see rfis.py)
+IMPORT_FORBIDDEN=('serial','numpy','subprocess','tempfile','hashlib','datetime','argparse','matlab','msgpack')
+IMPORT_BUDGET_MS=60 #cumulative `import rfis` time, best of --repeat runs
+
+#child interpreter that can import rfis (and whatever rfis finds on our path), with bytecode caching on
+def child_env():
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE',None)
+    here = os.path.dirname(os.path.abspath(rfis.__file__))
+    env['PYTHONPATH'] = os.pathsep.join([here]+[p for p in sys.path if p])
+    return env
+
+#[(self us, cumulative us, depth, module)] from `python -X importtime -c "import <module>"`
+def importtime(module,env):
+    r = subprocess.run([sys.executable,'-X','importtime','-c','import '+module],
+                       env=env,stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,universal_newlines=True)
+    out = []
+    for line in r.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cum, name = line[len('import time:'):].split('|')
+        out.append((int(own),int(cum),(len(name)-len(name.lstrip()))//2,name.strip()))
+    return out
+
+def bench_importtime(args):
+    env = child_env()
+    importtime('rfis',env) #warm up: write bytecode, fill the OS cache
+    best = None
+    for ii in range(args.repeat):
+        rows = importtime('rfis',env)
+        total = [r for r in rows if r[3] == 'rfis']
+        if not total:
+            print('import rfis failed')
+            return 1
+        if best is None or total[0][1] < best[0]:
+            best = (total[0][1],rows)
+    total, rows = best
+    print('import rfis: %.1f ms (best of %d, budget %.0f ms)' % (total/1000.0,args.repeat,args.budget_ms))
+    #what rfis itself pulled in (its direct imports), heaviest first
+    start = rows.index([r for r in rows if r[3] == 'rfis'][0])
+    mine = []
+    for r in reversed(rows[:start]): #children are listed before their parent
+        if r[2] == 0:
+            break
+        if r[2] == 1:
+            mine.append(r)
+    for own, cum, depth, name in sorted(mine,reverse=True,key=lambda r: r[1])[:args.top]:
+        print('  %-24s %8.1f ms' % (name,cum/1000.0))
+    r = subprocess.run([sys.executable,'-c','import sys, json, rfis; print(json.dumps(sorted(sys.modules)))'],
+                       env=env,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL,universal_newlines=True)
+    loaded = set(json.loads(r.stdout))
+    bad = sorted(m for m in loaded if m.split('.')[0] in args.forbid.split(','))
+    status = 0
+    if bad:
+        print('FAIL: import rfis loads '+', '.join(bad))
+        status = 1
+    if total/1000.0 > args.budget_ms:
+        print('FAIL: over budget')
+        status = 1
+    return status
+
+
+#a captured session (rfis.py --trace) through an in-process relay, as fast as it will go
+def bench_replay(args):
+    with rfis.TraceReader(args.trace) as reader:
+        records = list(reader.records())
+    best = None
+    for ii in range(args.repeat):
+        report = rfis.TraceReplayer(records,0,args.socket_port).run()
+        if report.get('error'):
+            print(report['error'])
+            return 1
+        if report['mismatches']:
+            print('relay output differs from the capture, first at packet %d: expected %s, got %s' % report['first_mismatch'])
+            return 1
+        best = report if best is None or report['elapsed'] < best['elapsed'] else best
+    packets = best['mc_written']+best['mc_delivered']+best['ui_sent']
+    print('%d records (%.1f s captured) in %.3f s, %.0f messages/s' % (len(records),best['captured'],best['elapsed'],packets/best['elapsed']))
+    return 0
+
+
+SUITE_FORMAT=1 #version of the --json layout
+SUITE_NOISE={'%':2.0,'ms':0.05} #absolute change (by unit) too small to call a regression
+SUITE_BAUD=10**9 #serial pacing off, so the relay (not the line rate) is what's measured
+
+#simulated board that notes when each packet arrives and finishes moves at once;
+#it takes packets as fast as they come, since the rig's relay doesn't space them (tx_gap=0)
+class BenchBoard(rfis.SimulatedKL25Z):
+    def __init__(self,port,baud):
+        rfis.SimulatedKL25Z.__init__(self,port,baud,step_rates=(10**6,)*rfis.MOTOR_COUNT,strict_framing=False,loop_time=0)
+        self.seen = collections.deque(maxlen=100000) #monotonic time each packet was handled
+
+    def handle(self,p):
+        self.seen.append(time.monotonic())
+        rfis.SimulatedKL25Z.handle(self,p)
+
+#relay, board and an API client, all in this process
+class Rig:
+    def __init__(self,socket_port,baud=SUITE_BAUD):
+        a, b = rfis.LoopbackTransport.pair(rfis.SERIAL_READ_TIMEOUT)
+        self.board = BenchBoard(b,baud)
+        self.board.start()
+        quiet = dict((c,rfis.LOG_WARN) for c in rfis.LOG_LEVELS_DEFAULT)
+        self.relay = rfis.CommProcess(a,socket_port,log_levels=quiet,notify_sink=rfis.LocalSink(),baud=baud,tx_gap=0)
+        self.thread = threading.Thread(target=self.relay.run,daemon=True)
+        self.thread.start()
+        self.api = rfis.API(socket_port=socket_port)
+        self.api.verbose = False
+        end = time.monotonic()+rfis.CONNECT_TIMEOUT
+        while not self.api.socket:
+            try:
+                self.api.socket = socket.create_connection(('localhost',socket_port))
+            except OSError:
+                if time.monotonic() > end or not self.thread.is_alive():
+                    raise
+                time.sleep(rfis.CONNECT_BACKOFF_MIN)
+        self.api.socket.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        self.drain = Drain(self.api.socket) #hello, state pushes
+        self.drain.start()
+
+    def close(self):
+        self.relay.done = True
+        self.relay.wake()
+        self.thread.join(5)
+        self.api.socket.close()
+        self.api.socket = None
+
+    #block until the board has handled n packets since start (False on timeout)
+    def handled(self,start,n,timeout=30):
+        end = time.monotonic()+timeout
+        while self.board.commands-start < n:
+            if time.monotonic() > end:
+                return False
+            time.sleep(0.0005)
+        return True
+
+def percentile(values,q):
+    values = sorted(values)
+    return values[min(len(values)-1,int(q*len(values)))]
+
+#packets/s API -> relay -> board, keeping at most window packets in flight
+#(a well-behaved client; the relay's queue would shed anything past MC_QUEUE_SIZE)
+def suite_throughput(rig,n,batch,window=rfis.MC_QUEUE_SIZE//2):
+    packets = [rfis.encode_light(1+ii%rfis.LIGHT_COUNT,(ii&0xff,0,0)) for ii in range(n)]
+    start = rig.board.commands
+    cpu = time.process_time()
+    t0 = time.perf_counter()
+    for ii in range(0,n,batch):
+        while ii-(rig.board.commands-start) > window:
+            time.sleep(0.0002)
+        if batch == 1:
+            rig.api.send(packets[ii])
+        else:
+            rig.api.send_batch(packets[ii:ii+batch])
+    if not rig.handled(start,n):
+        raise RuntimeError('board got '+str(rig.board.commands-start)+' of '+str(n)+' packets')
+    t = time.perf_counter()-t0
+    return n/t, 100*(time.process_time()-cpu)/t
+
+#one move at a time: API.send() -> board (one way) and -> arrival back in the relay's state (round trip), ms
+def suite_latency(rig,n):
+    state = rig.relay.state
+    oneway = []
+    rtt = []
+    for ii in range(n):
+        m = ii%rfis.MOTOR_COUNT
+        want = 0 if state.snapshot.pos[m] else 1
+        seen = len(rig.board.seen)
+        t0 = time.monotonic()
+        rig.api.send(rfis.encode_move(m+1,1 if want else -1))
+        with state.changed:
+            ok = state.changed.wait_for(lambda: state.snapshot.pos[m] == want and not state.snapshot.running[m],5)
+        t = time.monotonic()
+        if not ok:
+            raise RuntimeError('no arrival for motor '+str(m+1))
+        rtt.append((t-t0)*1000)
+        oneway.append((rig.board.seen[seen]-t0)*1000)
+    return oneway, rtt
+
+#a program that uses every kind of command, commands long
+def make_program(commands,seed=1):
+    rnd = random.Random(seed)
+    doc = [{'description':'benchmark program','symbols':{'POS_A':100,'POS_B':-50,'FORAM_PRESENT':0}}]
+    for ii in range(commands):
+        name = 'c'+str(ii)
+        kind = ii%6
+        if kind == 0:
+            motors = rnd.sample(range(1,rfis.MOTOR_COUNT+1),rnd.randint(1,3))
+            doc.append([name,'M',motors,rnd.choice(['POS_A','POS_B',rnd.randint(-500,500)])])
+        elif kind == 1:
+            doc.append([name,'w',5])
+        elif kind == 2:
+            doc.append([name,'L',1+ii%rfis.LIGHT_COUNT,[rnd.randrange(256) for c in range(3)]])
+        elif kind == 3:
+            doc.append({'name':name,'command':'wait','conditions':{'symbol_values':{'FORAM_PRESENT':1}},
+                        'timeout':1,'timeout_action':'CONTINUE'})
+        elif kind == 4:
+            doc.append([name,'P',ii%2,1])
+        else:
+            doc.append([name,'s',{'POS_A':ii}])
+    doc.append(['again','g','c0'])
+    return json.dumps(doc)
+
+#ms to parse, compile and pipeline a program text
+def suite_compile(text,repeat):
+    best = None
+    for ii in range(repeat):
+        t0 = time.perf_counter()
+        rfis.compile_program(json.loads(text),'bench').runnable()
+        t = time.perf_counter()-t0
+        best = t if best is None or t < best else best
+    return best*1000
+
+def bench_suite(args):
+    quick = args.quick
+    results = {}
+    def add(name,value,unit,better):
+        results[name] = {'value':value,'unit':unit,'better':better}
+        print('%-28s %12.3f %s' % (name,value,unit))
+    text = make_program(60)
+    add('compile_60_ms',suite_compile(text,20 if quick else 200),'ms','lower')
+    text = make_program(1200)
+    add('compile_1200_ms',suite_compile(text,3 if quick else 20),'ms','lower')
+    rig = Rig(args.socket_port)
+    try:
+        n = 2000 if quick else 20000
+        rate, cpu = suite_throughput(rig,n,1)
+        add('send_packets_per_s',rate,'packets/s','higher')
+        add('send_cpu',cpu,'%','lower')
+        rate, cpu = suite_throughput(rig,n,32)
+        add('send_batch_packets_per_s',rate,'packets/s','higher')
+        add('send_batch_cpu',cpu,'%','lower')
+        oneway, rtt = suite_latency(rig,200 if quick else 2000)
+        for q in (0.5,0.99):
+            add('command_latency_p%g_ms' % (q*100),percentile(oneway,q),'ms','lower')
+            add('arrival_rtt_p%g_ms' % (q*100),percentile(rtt,q),'ms','lower')
+        cpu = time.process_time()
+        t0 = time.perf_counter()
+        time.sleep(args.idle)
+        add('idle_cpu',100*(time.process_time()-cpu)/(time.perf_counter()-t0),'%','lower')
+        dropped = rig.relay.mc_omsg.dropped
+    finally:
+        rig.close()
+    if dropped:
+        print('relay dropped '+str(dropped)+' packets, throughput figures are suspect')
+    report = {'format':SUITE_FORMAT,'time':time.time(),'python':platform.python_version(),
+              'platform':platform.platform(),'quick':quick,'results':results}
+    if args.json:
+        with open(args.json,'w') as fp:
+            json.dump(report,fp,indent=1)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        return suite_compare(results,baseline,args.tolerance)
+    return 0
+
+#prints the change from baseline for each result; 1 if any got worse by more than tolerance
+def suite_compare(results,baseline,tolerance):
+    if baseline.get('format') != SUITE_FORMAT:
+        print('baseline format '+str(baseline.get('format'))+', expected '+str(SUITE_FORMAT))
+        return 1
+    print('\n%-28s %12s %12s %8s' % ('vs baseline','baseline','now','change'))
+    worse = []
+    for name, r in results.items():
+        b = baseline['results'].get(name)
+        if not b:
+            print('%-28s %12s %12.3f %8s' % (name,'-',r['value'],'new'))
+            continue
+        change = (r['value']-b['value'])/b['value'] if b['value'] else 0.0
+        loss = -change if r['better'] == 'higher' else change
+        flag = ''
+        if loss > tolerance and abs(r['value']-b['value']) > SUITE_NOISE.get(r['unit'],0):
+            worse.append(name)
+            flag = '  WORSE'
+        print('%-28s %12.3f %12.3f %+7.1f%%%s' % (name,b['value'],r['value'],100*change,flag))
+    if worse:
+        print('regressed (>%g%%): %s' % (100*tolerance,', '.join(worse)))
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='RFIS Python benchmarks')
+    sub = parser.add_subparsers(dest='bench')
+    sub.required = True
+    p = sub.add_parser('decoder',help='API stream frame decoding')
+    p.add_argument('--megabytes',type=float,default=4)
+    p.add_argument('--json-ratio',type=float,default=0.01,help='fraction of frames that are JSON')
+    p.add_argument('--chunk',type=int,default=rfis.FRAME_RECV_SIZE,help='largest simulated recv() size')
+    p.add_argument('--repeat',type=int,default=3)
+    p.add_argument('--seed',type=int,default=1)
+    p.add_argument('--skip-legacy',action='store_true',help="don't time the old parser (it's quadratic)")
+    p.set_defaults(func=bench_decoder)
+    p = sub.add_parser('send',help='API.send packet rate into a local socket')
+    p.add_argument('--packets',type=int,default=20000)
+    p.set_defaults(func=bench_send)
+    p = sub.add_parser('importtime',help='cold import cost of rfis (python -X importtime), fails over budget')
+    p.add_argument('--repeat',type=int,default=5)
+    p.add_argument('--budget-ms',type=float,default=IMPORT_BUDGET_MS)
+    p.add_argument('--forbid',default=','.join(IMPORT_FORBIDDEN),help='comma-separated modules import rfis must not load')
+    p.add_argument('--top',type=int,default=8,help='direct imports to list')
+    p.set_defaults(func=bench_importtime)
+    p = sub.add_parser('replay',help='replay a capture through the relay at full speed, fails if its output differs')
+    p.add_argument('trace')
+    p.add_argument('--repeat',type=int,default=3)
+    p.add_argument('--socket-port',type=int,default=rfis.SOCKET_PORT_DEFAULT+1)
+    p.set_defaults(func=bench_replay)
+    p = sub.add_parser('suite',help='API/relay/sequencer benchmarks against a simulated board, JSON results and baseline comparison')
+    p.add_argument('--quick',action='store_true',help='fewer iterations (noisier)')
+    p.add_argument('--json',metavar='FILE',help='write results here (ex. to use as a baseline)')
+    p.add_argument('--baseline',metavar='FILE',help='compare with results saved by --json')
+    p.add_argument('--tolerance',type=float,default=0.15,help='fractional loss that counts as a regression')
+    p.add_argument('--idle',type=float,default=2,help='seconds to measure idle CPU over')
+    p.add_argument('--socket-port',type=int,default=rfis.SOCKET_PORT_DEFAULT+2)
+    p.set_defaults(func=bench_suite)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+#rfis is a single module in app/, not an installed package
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'app'))
+
+import rfis
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost',0))
+        return s.getsockname()[1]
+
+#a relay in this process, talking to a simulated board; client() connects API clients
+class Rig:
+    def __init__(self):
+        self.port = free_port()
+        a, b = rfis.LoopbackTransport.pair(rfis.SERIAL_READ_TIMEOUT)
+        self.board = rfis.SimulatedKL25Z(b,time_scale=0)
+        self.board.start()
+        quiet = dict((c,rfis.LOG_WARN) for c in rfis.LOG_LEVELS_DEFAULT)
+        self.relay = rfis.CommProcess(a,self.port,log_levels=quiet,notify_sink=rfis.LocalSink(),tx_gap=0)
+        self.thread = threading.Thread(target=self.relay.run,daemon=True)
+        self.thread.start()
+        self.clients = []
+        end = time.monotonic()+rfis.CONNECT_TIMEOUT
+        while not self.relay.listen_sock: #or API.connect() would start a relay of its own
+            assert self.thread.is_alive() and time.monotonic() < end
+            time.sleep(0.01)
+
+    #the first client to connect is the controller
+    def client(self):
+        api = rfis.API(socket_port=self.port)
+        api.verbose = False
+        assert api.connect(timeout=3)
+        self.clients.append(api)
+        return api
+
+    def close(self):
+        for api in self.clients:
+            if api.listener:
+                api.listener.stop()
+            if api.socket: #shutdown() already closed it
+                api.socket.close()
+                api.socket = None
+        self.relay.done = True
+        self.relay.wake()
+        self.thread.join(5)
+
+#the relay writes its log to the current directory
+@pytest.fixture
+def rig(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    r = Rig()
+    yield r
+    r.close()
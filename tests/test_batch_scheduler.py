@@ -0,0 +1,64 @@
+import json
+
+import rfis
+
+
+def scheduler(path,msgs=None):
+    return rfis.BatchScheduler(str(path),log=(msgs.append if msgs is not None else lambda msg: None))
+
+def run_stage(batch,result,now):
+    job = batch.next_job()
+    batch.stage_started(now)
+    batch.stage_ended(result,now+1)
+    return job
+
+SPEC = {'name':'b','stages':['A','B'],'count':3,'symbols':{'SPEED':2},'specimens':[{'X':1},{},{'X':3}]}
+
+
+def test_restart_resumes_at_first_unfinished_stage(tmp_path):
+    journal = tmp_path/'batch.jsonl'
+    batch = scheduler(journal)
+    batch.start(SPEC,0.0)
+    assert run_stage(batch,'done',0.0) == ('A',{'X':1,'SPEED':2,'SPECIMEN':1})
+    run_stage(batch,'done',2.0)
+    run_stage(batch,'done',4.0) #specimen 2, stage A; then the relay dies
+    msgs = []
+    restarted = scheduler(journal,msgs)
+    assert restarted.recover(10.0)
+    assert restarted.state == rfis.BATCH_PAUSED
+    assert (restarted.specimen,restarted.stage,restarted.done) == (1,1,1)
+    assert restarted.resume(10.0)
+    assert restarted.next_job() == ('B',{'X':0,'SPEED':2,'SPECIMEN':2})
+    assert any('recovered' in m for m in msgs)
+
+def test_torn_last_line_is_ignored(tmp_path):
+    journal = tmp_path/'batch.jsonl'
+    batch = scheduler(journal)
+    batch.start(dict(SPEC,autoresume=True),0.0)
+    run_stage(batch,'done',0.0)
+    with open(str(journal),'a') as fp:
+        fp.write('{"event":"stage","spec')
+    restarted = scheduler(journal)
+    assert restarted.recover(5.0)
+    assert restarted.state == rfis.BATCH_RUNNING
+    assert (restarted.specimen,restarted.stage) == (0,1)
+
+def test_finished_batch_is_not_recovered(tmp_path):
+    journal = tmp_path/'batch.jsonl'
+    batch = scheduler(journal)
+    batch.start(dict(SPEC,count=1),0.0)
+    run_stage(batch,'done',0.0)
+    run_stage(batch,'done',2.0)
+    assert batch.state == rfis.BATCH_DONE
+    with open(str(journal)) as fp:
+        assert json.loads(fp.readlines()[-1])['event'] == 'end'
+    assert not scheduler(journal).recover(5.0)
+
+def test_skipped_specimen_stays_skipped(tmp_path):
+    journal = tmp_path/'batch.jsonl'
+    batch = scheduler(journal)
+    batch.start(dict(SPEC,on_error='skip'),0.0)
+    run_stage(batch,'error',0.0)
+    restarted = scheduler(journal)
+    assert restarted.recover(5.0)
+    assert restarted.specimen == 1 and restarted.failed == [0]
@@ -0,0 +1,79 @@
+import socket
+
+import rfis
+
+
+def relay(tmp_path,monkeypatch,queue_size):
+    monkeypatch.chdir(tmp_path) #the relay's log goes to the current directory
+    cp = rfis.CommProcess(rfis.TRANSPORT_LOOP,0,notify_sink=rfis.LocalSink())
+    cp.mc_omsg = rfis.PacketQueue(queue_size)
+    return cp
+
+def motor(cp,m):
+    snap = cp.state.snapshot
+    return snap.target[m], snap.running[m]
+
+
+#a move the full queue turns away must not leave the motor heading somewhere
+def test_dropped_api_move_leaves_state_alone(tmp_path,monkeypatch):
+    cp = relay(tmp_path,monkeypatch,1)
+    cp.handle_api_msg(memoryview(rfis.encode_move(1,10)))
+    cp.handle_api_msg(memoryview(rfis.encode_move(2,20)))
+    assert motor(cp,0) == (10,True)
+    assert motor(cp,1) == (0,False)
+    assert cp.mc_omsg.dropped == 1
+
+def test_dropped_program_move_is_undone(tmp_path,monkeypatch):
+    cp = relay(tmp_path,monkeypatch,1)
+    cp.wake_w, cp.wake_r = socket.socketpair()
+    cp.wake_r.setblocking(False)
+    try:
+        cp.send(rfis.encode_move(1,10))
+        cp.send(rfis.encode_move(1,5)) #same motor: relative to the first
+        cp.on_wake(cp.wake_r,None)
+    finally:
+        cp.wake_w.close()
+        cp.wake_r.close()
+    assert motor(cp,0) == (10,True)
+    assert len(cp.mc_omsg) == 1
+
+#a program that takes its time to notice stop() (ex. mid-move)
+class Stubborn(rfis.threading.Thread):
+    def __init__(self):
+        rfis.threading.Thread.__init__(self,daemon=True)
+        self.release = rfis.threading.Event()
+        self.running = True
+
+    def stop(self):
+        pass
+
+    def run(self):
+        self.release.wait(5)
+        self.running = False
+
+#an override must not block the main loop waiting for the old program
+def test_override_run_waits_off_the_loop(tmp_path,monkeypatch):
+    cp = relay(tmp_path,monkeypatch,8)
+    cp.wake_w, cp.wake_r = socket.socketpair()
+    old = cp.prog_thread = Stubborn()
+    old.start()
+    try:
+        t = rfis.time.monotonic()
+        cp.handle_seq({'command':'run','override':True,'program':[{'description':'next'},
+            {'name':'a','command':'w','conditions':{'symbol_values':{'X':1}},'timeout':0.05}]})
+        assert rfis.time.monotonic()-t < 0.5
+        new = cp.pending_pt
+        assert new is not None and cp.prog_thread is old
+        cp.handle_seq({'command':'run','program':[{'description':'blocked'}]})
+        assert cp.pending_pt is new
+        assert not cp.start_pending()
+        old.release.set()
+        old.join(5)
+        assert cp.start_pending()
+        assert cp.prog_thread is new and cp.pending_pt is None
+        new.join(5)
+        assert new.result == 'timeout'
+    finally:
+        old.release.set()
+        cp.wake_w.close()
+        cp.wake_r.close()
@@ -0,0 +1,27 @@
+import pytest
+
+import rfis
+
+
+@pytest.mark.parametrize('doc,error',[
+    ('x','program must be an array'),
+    ([],'program is empty'),
+    ([1],'first element must be an object'),
+    ([{'symbols':{'A':'x'}}],'default for symbol "A" must be numeric'),
+    ([{},['a','zz']],'command 0 ("a"): unknown command "zz"'),
+    ([{},['a','w',1],['a','w',1]],'command 1 ("a"): duplicate name'),
+    ([{},['a','g','nowhere']],'command 0 ("a"): unknown label "nowhere"'),
+    ([{},['a','T']],'command 0 ("a"): "trigger" is not supported by the firmware'),
+    ([{},['a','m',[9],[1]]],'command 0 ("a"): invalid motor 9'),
+    ([{},['a','w','soon']],'command 0 ("a"): "timeout" must be a number of seconds'),
+    ([{},{'command':'w'}],'command 0: verbose form needs a "name"'),
+])
+def test_errors(doc,error):
+    with pytest.raises(rfis.ProgramError) as e:
+        rfis.compile_program(doc,'t')
+    assert str(e.value) == error
+
+def test_goto_resolves_to_index():
+    program = rfis.compile_program([{},['a','w',1],['b','g','a']],'t')
+    assert len(program) == 2
+    assert program.code[1].args == (0,)
@@ -0,0 +1,59 @@
+import socket
+
+import pytest
+
+import rfis
+
+
+def frames(dec):
+    return [bytes(f) for f in dec.frames()]
+
+def test_frames_split_across_feeds():
+    msgs = [b'M1\x00\x10',b'{"type":"seq"}',b'',b'x'*1000]
+    stream = b''.join(rfis.frame(m) for m in msgs)
+    dec = rfis.FrameDecoder(size=64)
+    got = []
+    for ii in range(len(stream)): #worst case: a byte at a time
+        dec.feed(stream[ii:ii+1])
+        got += frames(dec)
+    assert got == msgs
+    assert len(dec) == 0
+
+def test_partial_frame_waits_for_the_rest():
+    dec = rfis.FrameDecoder()
+    data = rfis.frame(b'hello')+rfis.frame(b'world')
+    dec.feed(data[:12]) #the first frame and 3 bytes of the second's size
+    assert frames(dec) == [b'hello']
+    assert len(dec) == 3
+    dec.feed(data[12:])
+    assert frames(dec) == [b'world']
+
+def test_buffer_grows_for_a_big_frame():
+    big = bytes(range(256))*100
+    dec = rfis.FrameDecoder(size=16)
+    dec.feed(rfis.frame(b'a'))
+    dec.feed(rfis.frame(big)[:10])
+    assert frames(dec) == [b'a']
+    dec.feed(rfis.frame(big)[10:])
+    assert frames(dec) == [big]
+
+def test_oversized_frame_is_an_error():
+    dec = rfis.FrameDecoder(max_frame=100)
+    dec.feed(rfis.frame(b'x'*101))
+    with pytest.raises(ValueError):
+        frames(dec)
+
+def test_recv_into_from_socket():
+    a, b = socket.socketpair()
+    try:
+        dec = rfis.FrameDecoder(size=32)
+        msg = b'y'*5000
+        a.sendall(rfis.frame(msg)+rfis.frame(b'S000'))
+        got = []
+        while len(got) < 2:
+            assert dec.recv_into(b,16)
+            got += frames(dec)
+        assert got == [msg,b'S000']
+    finally:
+        a.close()
+        b.close()
@@ -0,0 +1,45 @@
+import rfis
+
+
+def moved(state,steps,t):
+    state.sent(rfis.encode_move(1,steps),t)
+    return state.eta[0]
+
+def test_arrival_reaches_target():
+    state = rfis.HardwareState()
+    moved(state,1000,0.0)
+    state.received(b'A100')
+    snap = state.snapshot
+    assert snap.pos[0] == 1000 and not snap.running[0] and not snap.stale[0]
+
+#after a stop the firmware still reports "A100", wherever the motor ended up
+def test_arrival_after_stop_is_not_the_target():
+    state = rfis.HardwareState()
+    eta = moved(state,-1000,0.0)
+    state.sent(rfis.encode_stop(),eta/2)
+    state.received(b'A100',eta/2)
+    snap = state.snapshot
+    assert snap.pos[0] == -500
+    assert not snap.running[0]
+    assert snap.stale[0]
+    moved(state,100,eta) #relative to the estimate, still unconfirmed
+    state.received(b'A100')
+    assert state.snapshot.pos[0] == -400 and state.snapshot.stale[0]
+    state.sent(rfis.encode_calibrate(1))
+    assert state.snapshot.pos[0] == 0 and not state.snapshot.stale[0]
+
+def test_stop_after_move_ended_keeps_target():
+    state = rfis.HardwareState()
+    eta = moved(state,200,0.0)
+    state.sent(rfis.encode_stop(),eta+1)
+    state.received(b'A100',eta+1)
+    snap = state.snapshot
+    assert snap.pos[0] == 200 and not snap.stale[0]
+
+def test_resync_keeps_stopped_motor_stale():
+    state = rfis.HardwareState()
+    eta = moved(state,1000,0.0)
+    state.sent(rfis.encode_stop(),eta/4)
+    motors = state.resync(eta)
+    assert motors['derived'] == [0]
+    assert state.snapshot.pos[0] == 250 and state.snapshot.stale[0]
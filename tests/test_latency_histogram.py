@@ -0,0 +1,26 @@
+import rfis
+
+
+#bucket upper edges: never below the true quantile, at most one bucket width above
+def test_quantiles_within_bucket_error():
+    h = rfis.LatencyHistogram('t')
+    for us in range(1,100001):
+        h.record(us/1000000.0)
+    err = 1.0/(1<<(rfis.HIST_SUB_BITS-1))
+    for q, v in zip((0.5,0.9,0.99,0.999),h.quantiles((0.5,0.9,0.99,0.999))):
+        true = q*100000/1000000.0
+        assert true <= v <= true*(1+err)
+    assert h.quantiles((1.0,)) == [0.1] #capped at the max seen
+
+def test_small_values_are_exact():
+    h = rfis.LatencyHistogram('t')
+    for us in range(1<<rfis.HIST_SUB_BITS):
+        h.record(us/1000000.0)
+    assert h.quantiles((0.5,)) == [15/1000000.0]
+
+#the worst case: a value just past a bucket's lower edge reports that bucket's upper edge
+def test_worst_case_error():
+    h = rfis.LatencyHistogram('t')
+    h.record(1024/1000000.0)
+    h.record(1.0) #so the max doesn't cap the first
+    assert round(h.quantiles((0.5,))[0]*1000000) == 1024+1024//16-1
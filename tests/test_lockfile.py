@@ -0,0 +1,68 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+import rfis
+
+#takes the lock in a separate process, says whether it got it, holds it until stdin closes
+HOLDER = '''
+import sys
+sys.path.insert(0,sys.argv[1])
+import tempfile
+tempfile.tempdir = sys.argv[2]
+import rfis
+got = rfis.acquire_lockfile(sys.argv[3],{'pid':__import__('os').getpid()})
+print(got,flush=True)
+sys.stdin.read()
+'''
+
+@pytest.fixture
+def tmpdir_locks(tmp_path,monkeypatch):
+    monkeypatch.setattr(tempfile,'tempdir',str(tmp_path))
+    monkeypatch.setattr(rfis,'_lock_fds',{})
+    return tmp_path
+
+def holder(tmp_path,port):
+    return subprocess.Popen([sys.executable,'-c',HOLDER,os.path.dirname(rfis.__file__),str(tmp_path),str(port)],
+                            stdin=subprocess.PIPE,stdout=subprocess.PIPE,text=True)
+
+
+def test_acquire_update_release(tmpdir_locks):
+    assert rfis.acquire_lockfile(5000,{'pid':os.getpid(),'ready':False})
+    rfis.update_lockfile(5000,{'pid':os.getpid(),'ready':True})
+    assert rfis.read_lockfile(5000) == {'pid':os.getpid(),'ready':True}
+    rfis.release_lockfile(5000)
+    assert not os.path.exists(rfis.lockfile_path(5000))
+
+#only the OS lock counts, not the pid someone left in the file
+def test_leftover_lock_is_taken(tmpdir_locks):
+    with open(rfis.lockfile_path(5001),'w') as fp:
+        json.dump({'pid':os.getpid(),'ready':True},fp)
+    assert rfis.acquire_lockfile(5001,{'pid':os.getpid(),'ready':False})
+    assert rfis.read_lockfile(5001)['ready'] is False
+    rfis.release_lockfile(5001)
+
+def test_held_lock_refused_until_holder_exits(tmpdir_locks):
+    p = holder(tmpdir_locks,5002)
+    try:
+        assert p.stdout.readline().strip() == 'True'
+        assert not rfis.acquire_lockfile(5002,{'pid':os.getpid()})
+    finally:
+        p.kill()
+        p.wait()
+    assert rfis.acquire_lockfile(5002,{'pid':os.getpid()})
+    rfis.release_lockfile(5002)
+
+def test_one_of_many_relays_wins(tmpdir_locks):
+    ps = [holder(tmpdir_locks,5003) for i in range(6)]
+    try:
+        got = [p.stdout.readline().strip() for p in ps]
+    finally:
+        for p in ps:
+            p.kill()
+            p.wait()
+    assert got.count('True') == 1 and got.count('False') == 5
@@ -0,0 +1,88 @@
+import threading
+
+import rfis
+
+
+def packet(c,n):
+    return bytes([ord(c),0x31+n%4,n//256%256,n%256])
+
+
+#relay thread puts while the serial writer gets: every packet comes out once, with its own put time
+def test_put_get_two_threads():
+    q = rfis.PacketQueue(64)
+    total = 5000
+    got = []
+    done = threading.Event()
+
+    def writer():
+        while not done.is_set() or len(q):
+            p = q.get()
+            if p is not None:
+                got.append((p,q.taken))
+
+    th = threading.Thread(target=writer)
+    th.start()
+    sent = {}
+    n = 0
+    while n < total:
+        p = packet('S' if n%50 == 0 else 'M',n)
+        if q.put(p,float(n)):
+            sent[p] = float(n)
+            n += 1
+    done.set()
+    th.join(10)
+    assert not th.is_alive()
+    assert len(got) == total
+    assert all(sent[p] == t for p, t in got)
+    assert q.queued == total
+
+
+def test_stop_overtakes_moves():
+    q = rfis.PacketQueue(8)
+    for n in range(3):
+        q.put(packet('M',n))
+    q.put(rfis.encode_stop())
+    assert q.get() == rfis.encode_stop()
+    assert [q.get() for n in range(3)] == [packet('M',n) for n in range(3)]
+    assert q.get() is None
+
+def test_full_normal_lane_refuses():
+    q = rfis.PacketQueue(2)
+    assert q.put(packet('M',0)) and q.put(packet('M',1))
+    assert q.full()
+    assert not q.put(packet('M',2))
+    assert q.put(rfis.encode_stop()) #the priority lane has its own room
+    assert q.stats()['dropped'] == 1
+    assert q.stats()['peak'] == 3
+
+def test_full_priority_lane_sheds_oldest():
+    q = rfis.PacketQueue(2)
+    for n in range(3):
+        assert q.put(packet('S',n))
+    assert q.dropped == 1
+    assert [q.get(),q.get()] == [packet('S',1),packet('S',2)]
+
+def test_requeue_and_remove():
+    q = rfis.PacketQueue(8)
+    q.put(packet('M',0),1.0)
+    q.put(packet('L',1),2.0)
+    q.put(packet('C',2),3.0)
+    p = q.get()
+    assert q.taken == 1.0
+    q.requeue(p)
+    assert q.remove(b'MC') == [packet('M',0),packet('C',2)]
+    assert q.get() == packet('L',1) and q.taken == 2.0
+    assert len(q) == 0
+
+def test_requeue_keeps_the_bound():
+    q = rfis.PacketQueue(2)
+    q.put(packet('M',0))
+    p = q.get()
+    q.put(packet('M',1))
+    q.put(packet('M',2)) #filled while p was out
+    assert q.requeue(p) == packet('M',2)
+    assert q.pending() == [packet('M',0),packet('M',1)]
+    for n in range(2):
+        q.put(packet('S',n))
+    assert q.requeue(packet('S',9)) == packet('S',9)
+    assert len(q.urgent) == 2 and q.dropped == 2
@@ -0,0 +1,29 @@
+import rfis
+
+
+class Relay:
+    def __init__(self):
+        self.state = rfis.HardwareState()
+        self.sent = []
+
+    def send(self,p):
+        self.sent.append(bytes(p))
+
+
+def test_invalid_program_is_logged():
+    msgs = []
+    pt = rfis.ProgramThread(Relay(),log=msgs.append)
+    assert not pt.load('[{},["a","zz"]]',False)
+    assert not pt.load('["a",',False)
+    assert msgs[0] == 'SEQ: invalid program: command 0 ("a"): unknown command "zz"'
+    assert msgs[1].startswith('SEQ: invalid program JSON: ')
+
+def test_timeout_is_logged():
+    msgs = []
+    pt = rfis.ProgramThread(Relay(),log=msgs.append)
+    pt.source = [{'description':'waits for X'},
+                 {'name':'a','command':'w','conditions':{'symbol_values':{'X':1}},'timeout':0.05,'timeout_message':'no X'}]
+    pt.start()
+    pt.join(5)
+    assert pt.result == 'timeout'
+    assert msgs == ['SEQ: waits for X','SEQ: timeout: no X']
@@ -0,0 +1,90 @@
+import collections
+import time
+
+import rfis
+
+
+def board(time_scale=0,**kw):
+    a, b = rfis.LoopbackTransport.pair(rfis.SERIAL_READ_TIMEOUT)
+    sim = rfis.SimulatedKL25Z(b,time_scale=time_scale,**kw)
+    sim.start()
+    return a, sim
+
+#the relay's serial writer in front of a board with real timing
+def writer(gap):
+    port, sim = board(1.0,step_rates=(100,)*rfis.MOTOR_COUNT)
+    q = rfis.PacketQueue(16)
+    st = rfis.SerialThread(port,collections.deque(),q,lambda: None,gap=gap)
+    for m in (1,2,3):
+        q.put(rfis.encode_move(m,50))
+    st.start()
+    return st, sim
+
+def wait_for(cond,timeout=5):
+    end = time.monotonic()+timeout
+    while not cond():
+        assert time.monotonic() < end
+        time.sleep(0.001)
+
+def read_packet(port):
+    port.timeout = 5
+    return port.read(4)
+
+
+#kl25z/src/main.c: a set direction bit moves forward, the encoder counts up
+def test_move_sign_follows_firmware():
+    port, sim = board(report_positions=True)
+    port.write(rfis.encode_move(1,-100))
+    p = read_packet(port)
+    assert sim.positions()[0] == 100
+    assert p == rfis._PACKET_STEPS.pack(b'A',ord('1'),0x8000|100) #reported as the relay's -100
+    port.close()
+
+#the firmware only reads its Rx queue when exactly 4 bytes are waiting
+def test_two_packets_at_once_wedge_board():
+    port, sim = board()
+    port.write(rfis.encode_move(1,10)+rfis.encode_move(2,10))
+    wait_for(lambda: sim.overruns)
+    assert sim.wedged
+    assert sim.commands == 0
+    port.close()
+
+def test_lenient_board_counts_overruns():
+    port, sim = board(strict_framing=False)
+    port.write(rfis.encode_move(1,10)+rfis.encode_move(2,10))
+    wait_for(lambda: sim.commands == 2)
+    assert sim.overruns == 1
+    assert not sim.wedged
+    port.close()
+
+def test_packets_one_at_a_time():
+    port, sim = board()
+    for m in (1,2,3):
+        port.write(rfis.encode_move(m,5))
+        wait_for(lambda: sim.commands == m)
+        read_packet(port)
+    assert sim.overruns == 0
+    port.close()
+
+#a packet arriving while the board is busy stepping merges with the one before
+def test_packet_while_busy_wedges_board():
+    port, sim = board(1.0,step_rates=(100,)*rfis.MOTOR_COUNT)
+    port.write(rfis.encode_move(1,50))
+    wait_for(lambda: sim.commands == 1)
+    port.write(rfis.encode_move(2,50)) #well within loop_time
+    port.write(rfis.encode_move(3,50))
+    wait_for(lambda: sim.overruns)
+    assert sim.wedged and sim.commands == 1
+    port.close()
+
+def test_line_rate_alone_overruns_firmware():
+    st, sim = writer(0)
+    wait_for(lambda: sim.overruns)
+    st.stop()
+    assert sim.wedged
+
+def test_tx_gap_lets_firmware_keep_up():
+    st, sim = writer(rfis.SERIAL_TX_GAP)
+    wait_for(lambda: sim.commands == 3)
+    st.stop()
+    assert sim.overruns == 0
@@ -0,0 +1,33 @@
+import socket
+import threading
+import time
+
+import rfis
+
+
+def listener():
+    a, b = socket.socketpair()
+    lst = rfis.StateListener(b)
+    lst.start()
+    return a, lst
+
+
+#replies are looked for while the listener keeps appending other messages
+def test_wait_message_while_messages_arrive():
+    a, lst = listener()
+    noise = b''.join(rfis.frame(rfis.encode_message({'type':'log','n':n},False)) for n in range(2000))
+    sender = threading.Thread(target=lambda: a.sendall(noise+rfis.frame(rfis.encode_message({'type':'symbols','id':7},False))))
+    try:
+        sender.start()
+        m = lst.wait_message(lambda m: m.get('type') == 'symbols' and m.get('id') == 7,5)
+        assert m == {'type':'symbols','id':7}
+    finally:
+        sender.join()
+        a.close()
+
+def test_wait_message_returns_when_connection_ends():
+    a, lst = listener()
+    t0 = time.monotonic()
+    threading.Timer(0.1,a.close).start()
+    assert lst.wait_message(lambda m: True,5) is None
+    assert time.monotonic()-t0 < 2
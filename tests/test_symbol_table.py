@@ -0,0 +1,79 @@
+import json
+import threading
+
+import rfis
+
+
+def saved(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+#saves from many updating threads: the file ends on the newest version
+def test_concurrent_saves_end_on_newest(tmp_path):
+    path = str(tmp_path/'symbols.json')
+    table = rfis.SymbolTable(path=path)
+
+    def updates(k):
+        for ii in range(200):
+            table.update({'X_'+str(k):ii},persist=True)
+
+    threads = [threading.Thread(target=updates,args=(k,)) for k in range(4)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    doc = saved(path)
+    assert doc['version'] == table.snapshot.version
+    assert doc['symbols'] == dict(('X_'+str(k),199) for k in range(4))
+
+def test_save_skips_what_is_already_written(tmp_path):
+    path = str(tmp_path/'symbols.json')
+    table = rfis.SymbolTable(path=path)
+    table.update({'Z_HOME':5},persist=True)
+    assert not table.save()
+    table.update({'Z_HOME':6})
+    assert saved(path)['symbols'] == {'Z_HOME':6}
+
+def test_errors_go_to_log(tmp_path):
+    path = str(tmp_path/'symbols.json')
+    with open(path,'w') as fp:
+        fp.write('{not json')
+    msgs = []
+    table = rfis.SymbolTable(log=msgs.append)
+    assert table.load(path) == 0
+    assert len(msgs) == 1 and path in msgs[0]
+    table.path = str(tmp_path/'missing'/'symbols.json')
+    table.update({'A':1},persist=True)
+    assert len(msgs) == 2 and 'missing' in msgs[1]
+
+
+def test_one_version_per_update():
+    seen = []
+    table = rfis.SymbolTable()
+    table.watch(lambda snap, changed: seen.append((snap.version,changed)))
+    table.update({'A':1,'B':2})
+    old = table.snapshot
+    assert table.update({'A':1}) == {} #no change, no new version
+    table.update({'A':3,'B':2})
+    assert table.snapshot.version == 2
+    assert seen == [(1,{'A':1,'B':2}),(2,{'A':3})]
+    assert old.values['A'] == 1 #snapshots don't change under readers
+
+def test_defaults_only_keeps_defined():
+    table = rfis.SymbolTable()
+    table.update({'A':1})
+    assert table.update({'A':5,'B':2},defaults_only=True) == {'B':2}
+    assert table.get('A') == 1 and table.get('C',7) == 7
+
+def test_persistent_symbols_survive_restart(tmp_path):
+    path = str(tmp_path/'symbols.json')
+    table = rfis.SymbolTable(path=path)
+    table.update({'Z_HOME':5},persist=True)
+    table.update({'FORAM_PRESENT':1}) #not persistent
+    table.update({'Z_HOME':6})
+    restarted = rfis.SymbolTable()
+    assert restarted.load(path) == 1
+    assert dict(restarted.snapshot.values) == {'Z_HOME':6}
+    restarted.update({'Z_HOME':7},defaults_only=True) #a program's default doesn't override it
+    assert restarted.get('Z_HOME') == 6
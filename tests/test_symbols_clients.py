@@ -0,0 +1,40 @@
+import time
+
+import rfis
+
+
+def wait_for(cond,timeout=5):
+    end = time.monotonic()+timeout
+    while not cond():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+#the image analysis worker connects after the GUI, so it's an observer
+def test_observer_sends_symbol_updates(rig):
+    gui = rig.client()
+    worker = rig.client()
+    assert wait_for(lambda: len(rig.relay.clients) == 2)
+    assert rig.relay.controller is not None
+    worker.set_symbols({'FORAM_PRESENT':1})
+    assert wait_for(lambda: rig.relay.state.symbols.get('FORAM_PRESENT') == 1)
+    worker.set_symbols({'Z_HOME':5},persist=True) #persisting still takes control
+    assert worker.get_symbols() == {'FORAM_PRESENT':1}
+    assert gui.get_symbols() == {'FORAM_PRESENT':1}
+
+#the relay only stops for the controller, and doesn't keep either client waiting
+def test_shutdown_stops_relay_for_controller_only(rig):
+    gui = rig.client()
+    worker = rig.client()
+    assert wait_for(lambda: len(rig.relay.clients) == 2)
+    t = time.monotonic()
+    worker.shutdown()
+    assert time.monotonic()-t < rfis.API_SHUTDOWN_TIMEOUT
+    assert not rig.relay.done
+    t = time.monotonic()
+    gui.shutdown()
+    assert time.monotonic()-t < rfis.API_SHUTDOWN_TIMEOUT
+    rig.thread.join(5)
+    assert not rig.thread.is_alive()